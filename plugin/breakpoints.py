@@ -0,0 +1,570 @@
+# -*- mode: python; coding: utf-8 -*-
+# Persistent breakpoint store, so a program's breakpoints survive across
+# debugging sessions.
+#
+# The store is a text file with one JSON object per line, appended to as
+# breakpoint events arrive:
+#   {"id": <breakpoint ID>, "bp": <breakpoint spec>}
+#   {"id": <breakpoint ID>, "removed": true}
+# Breakpoints which weren't created (yet) are kept under "saved.<n>" IDs.
+# Loading the store rewrites it with just its specs.
+# Breakpoint specs use the same format as dictionaries in the
+# lldb.breakpoints setting: one of
+#   {"file": <file>, "line": <line>}, {"name": <symbol>},
+#   {"address": <address>}, {"regex": <symbol regex>} or
+#   {"source_regex": <regex>, "file": <file>}
+# with optional "condition", "ignore_count" and "enabled" keys.
+
+import os
+import re
+import json
+import hashlib
+import threading
+
+import lldb
+import lldbutil
+import sublime
+
+from debug import debug, debugDriver
+from utilities import SettingsManager, monotonic
+
+# Keys which tell breakpoints apart. The others are options.
+_kind_keys = ('file', 'line', 'name', 'address', 'regex', 'source_regex')
+
+_desc_re_addr = re.compile('address = ([^,]+)')
+_desc_re_name = re.compile("name = '(([^'\\\\]|\\\\.)+)'")
+_desc_re_file_line = re.compile("file =\\s*'(([^'\\\\]|\\\\.)+)', line = (\\d+)")
+_desc_re_source_regex = re.compile('source regex = "(([^"\\\\]|\\\\.)*)"')
+_desc_re_regex = re.compile("regex = '(([^'\\\\]|\\\\.)*)'")
+
+
+def spec_from_description(bp_desc):
+    """
+    Parse breakpoint descriptions from lldb, returning a breakpoint spec
+    without options, or None if we couldn't tell the breakpoint's kind.
+
+    Example descriptions:
+
+    Current breakpoints:
+    1: name = 'main', locations = 1
+      1.1: where = tests`main + 36 at tests.c:15, address = tests[0x0000000100000824], unresolved, hit count = 0
+
+    2: name = 'atoi', locations = 2
+      2.1: where = tests`atoi + 13 at atoi.c:10, address = tests[0x000000010000154d], unresolved, hit count = 0
+      2.2: where = libsystem_c.dylib`atoi, address = libsystem_c.dylib[0x0000000000080bba], unresolved, hit count = 0
+
+    3: name = 'itoa', locations = 1
+      3.1: where = tests`itoa + 11 at atoi.c:56, address = tests[0x000000010000175b], unresolved, hit count = 0
+
+    4: file ='tests.c', line = 42, locations = 1
+      4.1: where = tests`main + 1786 at tests.c:43, address = tests[0x0000000100000efa], unresolved, hit count = 0
+
+    """
+    # Only look at the breakpoint's line. Its locations have addresses too.
+    bp_desc = bp_desc.split('\n')[0]
+
+    m = _desc_re_addr.search(bp_desc)
+    if m:
+        return {'address': m.group(1)}
+
+    m = _desc_re_name.search(bp_desc)
+    if m:
+        return {'name': m.group(1)}
+
+    m = _desc_re_file_line.search(bp_desc)
+    if m:
+        return {'file': m.group(1), 'line': int(m.group(3))}
+
+    m = _desc_re_source_regex.search(bp_desc)
+    if m:
+        return {'source_regex': m.group(1)}
+
+    m = _desc_re_regex.search(bp_desc)
+    if m:
+        return {'regex': m.group(1)}
+
+    return None
+
+
+def breakpoint_spec(bp, kind=None):
+    """Returns the spec for an SBBreakpoint, or None if we couldn't tell its
+        kind. If kind is given (a spec), its kind is used instead of parsing
+        the breakpoint's description."""
+    if kind is None:
+        kind = spec_from_description(lldbutil.get_description(bp))
+        if kind is None:
+            return None
+
+    spec = dict((k, v) for (k, v) in kind.iteritems() if k in _kind_keys)
+    condition = bp.GetCondition()
+    if condition:
+        spec['condition'] = condition
+    if bp.GetIgnoreCount() > 0:
+        spec['ignore_count'] = bp.GetIgnoreCount()
+    if not bp.IsEnabled():
+        spec['enabled'] = False
+    return spec
+
+
+def spec_kind(spec):
+    """Hashable value which tells breakpoint specs apart, ignoring their
+        options."""
+    return tuple([spec.get(k) for k in _kind_keys])
+
+
+def create_breakpoint(target, spec):
+    """Creates a breakpoint on target from a spec. Returns the
+        SBBreakpoint, or None if the spec wasn't valid."""
+    if 'file' in spec and 'line' in spec:
+        bp = target.BreakpointCreateByLocation(str(spec['file']), int(spec['line']))
+    elif 'name' in spec:
+        bp = target.BreakpointCreateByName(str(spec['name']))
+    elif 'address' in spec:
+        address = spec['address']
+        if isinstance(address, basestring):
+            try:
+                address = int(address, 0)
+            except ValueError:
+                debug(debugDriver, 'invalid breakpoint address: ' + str(spec))
+                return None
+        bp = target.BreakpointCreateByAddress(address)
+    elif 'regex' in spec:
+        bp = target.BreakpointCreateByRegex(str(spec['regex']))
+    elif 'source_regex' in spec:
+        filespec = lldb.SBFileSpec(str(spec['file'])) if 'file' in spec else lldb.SBFileSpec()
+        bp = target.BreakpointCreateBySourceRegex(str(spec['source_regex']), filespec)
+    else:
+        debug(debugDriver, 'unrecognized breakpoint type: ' + str(spec))
+        return None
+
+    if not bp.IsValid():
+        return None
+    if spec.get('condition'):
+        bp.SetCondition(str(spec['condition']))
+    if spec.get('ignore_count'):
+        bp.SetIgnoreCount(int(spec['ignore_count']))
+    if not spec.get('enabled', True):
+        bp.SetEnabled(False)
+    return bp
+
+
+def breakpoint_store_path(executable):
+    """Path of the breakpoint store for an executable. Stores live in the
+        breakpoints.store_dir setting's directory (by default,
+        Packages/User/lldb-breakpoints)."""
+    sm = SettingsManager.getSM()
+    store_dir = sm.get_default('breakpoints.store_dir', None)
+    if not store_dir:
+        store_dir = os.path.join(sublime.packages_path(), 'User', 'lldb-breakpoints')
+    store_dir = os.path.expanduser(store_dir)
+
+    executable = os.path.abspath(executable)
+    digest = hashlib.md5(executable).hexdigest()[:8]
+    return os.path.join(store_dir, '%s-%s.jsonl' % (os.path.basename(executable), digest))
+
+
+class BreakpointStore(object):
+    """Breakpoints of a program's target, written to a file as breakpoint
+        events arrive. Can be used from any thread."""
+    def __init__(self, path, target):
+        self.__path = path
+        self.__target = target
+        self.__lock = threading.Lock()
+        self.__file = None
+        # Breakpoint ID (or 'saved.<n>' key) -> spec
+        self.__bps = {}
+
+    @property
+    def path(self):
+        return self.__path
+
+    @property
+    def target(self):
+        return self.__target
+
+    def load(self):
+        """Returns the stored breakpoints as a list of (key, spec), and
+            rewrites the store with just those. Each spec is kept under a
+            'saved.<n>' key until a breakpoint gets created from it (and is
+            stored under its ID), so the specs which fail to be created are
+            still there for the next session."""
+        specs = {}
+        order = []
+        try:
+            with open(self.__path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    bp_id = record.get('id')
+                    if record.get('removed'):
+                        specs.pop(bp_id, None)
+                    elif 'bp' in record:
+                        if bp_id not in order:
+                            order.append(bp_id)
+                        specs[bp_id] = record['bp']
+        except IOError, e:
+            debug(debugDriver, "couldn't read the breakpoint store %s: %s" % (self.__path, repr(e)))
+
+        # Keep a single spec of each kind (the last one stored).
+        by_kind = {}
+        for bp_id in order:
+            if bp_id in specs:
+                by_kind[spec_kind(specs[bp_id])] = bp_id
+        loaded = []
+        for bp_id in order:
+            if bp_id in specs and by_kind[spec_kind(specs[bp_id])] == bp_id:
+                loaded.append(('saved.%d' % len(loaded), specs[bp_id]))
+
+        with self.__lock:
+            self.__bps = {}
+            self.__open('w')
+            for (key, spec) in loaded:
+                self.__bps[key] = spec
+                self.__write({'id': key, 'bp': spec})
+        return loaded
+
+    def spec_for(self, bp_id):
+        """Returns the stored spec for a breakpoint ID, or None."""
+        with self.__lock:
+            return self.__bps.get(bp_id)
+
+    def saved(self):
+        """Returns a list of (key, spec) for the loaded specs which no
+            breakpoint was created from."""
+        with self.__lock:
+            return sorted((key, spec) for (key, spec) in self.__bps.iteritems()
+                          if isinstance(key, basestring) and key.startswith('saved.'))
+
+    def add(self, key, spec):
+        """Stores a spec under key (a breakpoint ID, or any other key for
+            breakpoints lldb doesn't know about yet). Other specs of the same
+            kind are removed."""
+        kind = spec_kind(spec)
+        with self.__lock:
+            for (other, other_spec) in self.__bps.items():
+                if other != key and spec_kind(other_spec) == kind:
+                    del self.__bps[other]
+                    self.__write({'id': other, 'removed': True})
+            if self.__bps.get(key) != spec:
+                self.__bps[key] = spec
+                self.__write({'id': key, 'bp': spec})
+
+    def remove(self, key):
+        with self.__lock:
+            if self.__bps.pop(key, None) is not None:
+                self.__write({'id': key, 'removed': True})
+
+    def breakpoint_event(self, ev):
+        """Updates the store from a breakpoint event. Events for other
+            targets' breakpoints are ignored, since their IDs would clash
+            with ours."""
+        if not ev.BroadcasterMatchesRef(self.__target.GetBroadcaster()):
+            return
+
+        type = lldb.SBBreakpoint.GetBreakpointEventTypeFromEvent(ev)
+        bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
+        bp_id = bp.GetID()
+        if type & lldb.eBreakpointEventTypeRemoved:
+            self.remove(bp_id)
+        elif type & lldb.eBreakpointEventTypeAdded            \
+            or type & lldb.eBreakpointEventTypeEnabled        \
+            or type & lldb.eBreakpointEventTypeDisabled       \
+            or type & lldb.eBreakpointEventTypeConditionChanged \
+            or type & lldb.eBreakpointEventTypeIgnoreChanged:
+            # Breakpoints we created have their spec stored already. Only
+            # the others (e.g: from lldb commands) need their description
+            # parsed.
+            spec = breakpoint_spec(bp, self.spec_for(bp_id))
+            if spec is None:
+                debug(debugDriver, "couldn't tell the kind of breakpoint %d" % bp_id)
+                return
+            self.add(bp_id, spec)
+
+    def close(self):
+        with self.__lock:
+            if self.__file:
+                self.__file.close()
+                self.__file = None
+
+    def __open(self, mode):
+        if self.__file:
+            self.__file.close()
+        self.__file = None
+        try:
+            if not os.path.isdir(os.path.dirname(self.__path)):
+                os.makedirs(os.path.dirname(self.__path))
+            self.__file = open(self.__path, mode)
+        except (IOError, OSError), e:
+            debug(debugDriver, "couldn't open the breakpoint store %s: %s" % (self.__path, repr(e)))
+
+    def __write(self, record):
+        # Must be called with self.__lock held.
+        if self.__file:
+            self.__file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.__file.flush()
+
+
+# Phases of a launch, as reported by PendingBreakpoints.launch_summary.
+_launch_phases = ('target', 'breakpoints', 'launch')
+
+# Extensions of the files compile units are made from. Breakpoints on other
+# files (e.g: headers) can't be looked for by compile unit.
+_source_extensions = ('.c', '.cc', '.cp', '.cpp', '.cxx', '.c++', '.m', '.mm', '.s')
+
+
+def deferred_kind(spec):
+    """How a breakpoint spec can be looked for in a single module: 'file'
+        (by its compile units' files), 'name' (by its functions), or None if
+        it can't. Follows the same order as create_breakpoint."""
+    in_source = 'file' in spec and os.path.splitext(spec['file'])[1].lower() in _source_extensions
+    if 'file' in spec and 'line' in spec:
+        return 'file' if in_source else None
+    elif 'name' in spec:
+        return 'name'
+    elif 'address' in spec or 'regex' in spec:
+        return None
+    elif 'source_regex' in spec and in_source:
+        return 'file'
+    return None
+
+
+def module_path(module):
+    filespec = module.GetFileSpec()
+    return os.path.join(filespec.GetDirectory() or '', filespec.GetFilename() or '')
+
+
+def module_source_files(module):
+    """Set with the base names of the files a module's compile units were
+        made from."""
+    return set([cu.GetFileSpec().GetFilename() for cu in module.compile_unit_iter()])
+
+
+class PendingBreakpoints(object):
+    """
+    Breakpoints which haven't been created yet.
+
+    Creating a breakpoint on the whole target makes lldb look for it in
+    every module it has (including every shared library it preloaded), and
+    again in each module that gets loaded. Instead, breakpoints on symbol
+    names and on lines of a source file are pending until a module which
+    has them is loaded. We only look for them in the modules which were
+    loaded since we last looked:
+      - Breakpoints on a symbol name, with the module's FindFunctions().
+      - Breakpoints on file lines (or on source regexes in a file), in the
+        files the module's compile units were made from.
+    On the first match, the breakpoint is created on the whole target (so
+    it gets its locations in every module) and stops being pending. Other
+    breakpoints (on addresses, symbol regexes, or lines in headers) can't
+    be told apart by module, and are created straight away.
+
+    Specs are added (e.g: from the UI thread), and looked for on the driver
+    thread. Pending specs which came from the breakpoint store stay there,
+    so they're still around next session if they never get created. We
+    keep how long each breakpoint took to resolve, and how long each phase
+    of the launch took. Can be used from any thread.
+    """
+    def __init__(self, target, store=None):
+        self.__target = target
+        self.__store = store
+        self.__lock = threading.Lock()
+        # [(store key, spec)] which weren't looked at yet.
+        self.__specs = []
+        # [(store key, spec, time spent looking for it, modules searched)]
+        self.__pending = []
+        # Paths of the modules we already looked at.
+        self.__modules = set()
+        # [(breakpoint ID, spec, module, time spent looking for it, modules searched)]
+        self.__resolved = []
+        # [(phase, time spent)]
+        self.__launch_times = []
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pending)
+
+    @property
+    def target(self):
+        return self.__target
+
+    def add(self, spec, key=None):
+        """Adds a breakpoint spec, which may be in the store under key.
+            Specs of a kind we already have are dropped."""
+        kind = spec_kind(spec)
+        with self.__lock:
+            if kind in [spec_kind(s) for (k, s) in self.__specs] or \
+                    kind in [spec_kind(p[1]) for p in self.__pending]:
+                return
+            self.__specs.append((key, spec))
+
+    def create(self):
+        """Creates the breakpoints which can't wait, and looks for the
+            others in the modules the target already has. Should be called
+            from the driver thread. Returns the number of breakpoints
+            created."""
+        store = self.__store
+        with self.__lock:
+            specs = self.__specs
+            self.__specs = []
+
+        # Startup commands may have created some of them already.
+        # Kind -> SBBreakpoint
+        existing = {}
+        for bp in self.__target.breakpoint_iter():
+            spec = breakpoint_spec(bp, store and store.spec_for(bp.GetID()))
+            if spec is not None:
+                existing[spec_kind(spec)] = bp
+
+        n = 0
+        deferred = []
+        for (key, spec) in specs:
+            bp = existing.get(spec_kind(spec))
+            if bp is not None:
+                if store:
+                    store.add(bp.GetID(), breakpoint_spec(bp, spec))
+            elif deferred_kind(spec) is not None:
+                deferred.append((key, spec, 0.0, 0))
+            elif self.__create(spec):
+                n += 1
+            else:
+                # Its spec stays in the store, if it came from there.
+                debug(debugDriver, "couldn't create breakpoint %s" % json.dumps(spec))
+
+        with self.__lock:
+            self.__pending += deferred
+        return n + self.modules_loaded()
+
+    def modules_loaded(self):
+        """Looks for the pending breakpoints in the modules which were
+            loaded since the last call, creating the ones we find. Should be
+            called from the driver thread. Returns the number of
+            breakpoints created."""
+        # The bundled lldb can't tell us which modules an event loaded.
+        new_modules = []
+        with self.__lock:
+            if not self.__pending:
+                return 0
+            for module in self.__target.module_iter():
+                path = module_path(module)
+                if path not in self.__modules:
+                    self.__modules.add(path)
+                    new_modules.append(module)
+            pending = list(self.__pending)
+
+        # Look for them without the lock, so the UI can list them meanwhile.
+        found = []
+        for module in new_modules:
+            if not pending:
+                break
+            (pending, module_found) = self.__look_in(module, pending)
+            found += module_found
+
+        n = 0
+        for (key, spec, module_name, elapsed, searched) in found:
+            with self.__lock:
+                # It may have been removed meanwhile.
+                if spec_kind(spec) not in [spec_kind(p[1]) for p in self.__pending]:
+                    continue
+            bp = self.__create(spec)
+            if not bp:
+                debug(debugDriver, "couldn't create breakpoint %s" % json.dumps(spec))
+                continue
+            n += 1
+            with self.__lock:
+                self.__resolved.append((bp.GetID(), spec, module_name, elapsed, searched))
+            debug(debugDriver, 'breakpoint %d %s found in %s after %.3fms (%d modules searched)' %
+                               (bp.GetID(), json.dumps(spec), module_name, elapsed * 1000, searched))
+
+        # Keep the search times of the ones we didn't find.
+        searched = dict((spec_kind(p[1]), p) for p in pending)
+        found = set(spec_kind(f[1]) for f in found)
+        with self.__lock:
+            self.__pending = [searched.get(spec_kind(p[1]), p) for p in self.__pending
+                              if spec_kind(p[1]) not in found]
+        return n
+
+    def pending(self):
+        """Returns a list of (store key, spec) for the pending breakpoints.
+            Specs from the lldb.breakpoints setting have no key."""
+        with self.__lock:
+            return self.__specs + [(p[0], p[1]) for p in self.__pending]
+
+    def discard(self, spec):
+        """Stops looking for the breakpoint of the same kind as spec (e.g:
+            because it was removed, or created by someone else). Returns
+            True if it was pending."""
+        kind = spec_kind(spec)
+        with self.__lock:
+            gone = [p for p in self.__specs + self.__pending if spec_kind(p[1]) == kind]
+            self.__specs = [p for p in self.__specs if spec_kind(p[1]) != kind]
+            self.__pending = [p for p in self.__pending if spec_kind(p[1]) != kind]
+        if self.__store:
+            for p in gone:
+                if p[0] is not None:
+                    self.__store.remove(p[0])
+        return len(gone) > 0
+
+    def launch_phase_done(self, phase, elapsed):
+        """Records the time spent in a launch phase (one of _launch_phases)."""
+        with self.__lock:
+            self.__launch_times.append((phase, elapsed))
+
+    def launch_summary(self):
+        """One line summary of the launch, with the time spent in each
+            phase."""
+        with self.__lock:
+            times = sorted(self.__launch_times, key=lambda p: _launch_phases.index(p[0]))
+            total = sum(t for (phase, t) in times)
+            return 'launched in %.3fs (%s), %d breakpoints found, %d pending, %d modules searched\n' % \
+                (total, ', '.join(['%s: %.3fs' % p for p in times]),
+                 len(self.__resolved), len(self.__pending), len(self.__modules))
+
+    def report(self):
+        """Text report of the launch, and of how long each breakpoint took
+            to resolve."""
+        summary = self.launch_summary()
+        with self.__lock:
+            lines = [summary]
+            for (bp_id, spec, module, elapsed, searched) in \
+                    sorted(self.__resolved, key=lambda r: r[3], reverse=True):
+                lines.append('  %4d %-40s %8.3fms in %s (%d modules searched)\n' %
+                             (bp_id, json.dumps(spec), elapsed * 1000, module, searched))
+            for (key, spec, elapsed, searched) in self.__pending:
+                lines.append('     - %-40s %8.3fms, not found (%d modules searched)\n' %
+                             (json.dumps(spec), elapsed * 1000, searched))
+            return ''.join(lines)
+
+    def __create(self, spec):
+        bp = create_breakpoint(self.__target, spec)
+        if bp and self.__store:
+            # The one under the spec's store key has the same kind, and goes
+            # away.
+            self.__store.add(bp.GetID(), breakpoint_spec(bp, spec))
+        return bp
+
+    def __look_in(self, module, pending):
+        """Looks for the pending specs in a module. Returns the ones we
+            didn't find (with their search times updated), and a list of
+            (store key, spec, module name, time spent, modules searched)
+            for the ones we found."""
+        module_name = module.GetFileSpec().GetFilename()
+        source_files = None
+        still_pending = []
+        found = []
+        for (key, spec, elapsed, searched) in pending:
+            start = monotonic()
+            if deferred_kind(spec) == 'file':
+                if source_files is None:
+                    source_files = module_source_files(module)
+                is_there = os.path.basename(spec['file']) in source_files
+            else:
+                is_there = module.FindFunctions(str(spec['name']),
+                                                lldb.eFunctionNameTypeAuto).GetSize() > 0
+            elapsed += monotonic() - start
+            searched += 1
+            if is_there:
+                found.append((key, spec, module_name, elapsed, searched))
+            else:
+                still_pending.append((key, spec, elapsed, searched))
+        return (still_pending, found)
@@ -1,6 +1,8 @@
 import sys
+import time
 import threading
 
+from collections import deque
 from multiprocessing import Lock
 
 DFILE = sys.__stderr__
@@ -15,8 +17,12 @@ debugDriver = 1 << 4
 debugRoot = 1 << 5
 debugPlugin = 1 << 6
 debugSettings = 1 << 7
+debugLatency = 1 << 8  # Doesn't print anything. Feeds the latency tracer.
 
-debugAll = 0xff
+debugAll = 0x1ff
+
+# Python 2 doesn't have a monotonic clock. The wall clock will have to do.
+monotonic = getattr(time, 'monotonic', time.time)
 
 # Mutex to lock our debug function.
 mutex = Lock()
@@ -28,6 +34,10 @@ def debug(level, thing):
             print >> DFILE, threading.current_thread().name, str(thing)
 
 
+def debug_is_active(level):
+    return _active & level == level
+
+
 def toggle_debug(level):
     global _active
     _active = _active ^ level
@@ -46,3 +56,73 @@ def unset_debug(level):
 def clear_debug():
     global _active
     _active = 0
+
+
+class LatencyTracer(object):
+    """Keeps the latency (since the process stopped) at which each stage of
+    the stop -> UI refresh pipeline was reached, for the last few stops."""
+    __max_pending = 64
+
+    def __init__(self, window=1000):
+        self.__lock = threading.Lock()
+        self.__window = window
+        self.__starts = {}
+        self.__stages = []
+        self.__samples = {}
+
+    def start(self, stop_id):
+        with self.__lock:
+            if len(self.__starts) >= self.__max_pending:
+                # Stops that never made it to the UI. Forget the oldest one.
+                del self.__starts[min(self.__starts)]
+            self.__starts[stop_id] = monotonic()
+
+    def stamp(self, stop_id, stage, last=False):
+        now = monotonic()
+        with self.__lock:
+            if last:
+                start = self.__starts.pop(stop_id, None)
+            else:
+                start = self.__starts.get(stop_id)
+            if start is None:
+                return
+
+            if stage not in self.__samples:
+                self.__stages.append(stage)
+                self.__samples[stage] = deque(maxlen=self.__window)
+            self.__samples[stage].append(now - start)
+
+    def clear(self):
+        with self.__lock:
+            self.__starts.clear()
+            self.__stages = []
+            self.__samples = {}
+
+    def report(self):
+        with self.__lock:
+            stages = [(stage, sorted(self.__samples[stage]))
+                        for stage in self.__stages]
+
+        def percentile(samples, p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+
+        lines = ['%-16s %8s %10s %10s %10s' % ('stage', 'samples', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')]
+        for stage, samples in stages:
+            lines.append('%-16s %8d %10.2f %10.2f %10.2f' %
+                (stage, len(samples), percentile(samples, 0.5),
+                 percentile(samples, 0.95), percentile(samples, 0.99)))
+        return '\n'.join(lines) + '\n'
+
+tracer = LatencyTracer()
+
+
+# The tracing functions are called for every stop, so they only check a bit
+# when debugLatency isn't active.
+def trace_stop(stop_id):
+    if _active & debugLatency:
+        tracer.start(stop_id)
+
+
+def trace_stage(stop_id, stage, last=False):
+    if _active & debugLatency and stop_id is not None:
+        tracer.stamp(stop_id, stage, last)
@@ -0,0 +1,133 @@
+# -*- mode: python; coding: utf-8 -*-
+# Journal of the events handled by LldbDriver.run, for replaying (and
+# benchmarking) debugging sessions with replay.py.
+#
+# The journal is a text file with one JSON object per line:
+#   {"t": <monotonic timestamp>, "dur": <handling time, in seconds>,
+#    "kind": <"process", "breakpoint", "interpreter" or "other">,
+#    "event": <description of the event, depending on its kind>}
+# The first line of every session has kind "session" and no event.
+
+import json
+import threading
+
+import lldb
+
+from debug import debug, debugDriver
+from utilities import monotonic
+
+eKindSession = 'session'
+eKindProcess = 'process'
+eKindBreakpoint = 'breakpoint'
+eKindInterpreter = 'interpreter'
+eKindOther = 'other'
+
+_stopped_states = (lldb.eStateStopped, lldb.eStateCrashed, lldb.eStateSuspended)
+
+
+def filespec_path(filespec):
+    if not filespec:
+        return None
+    return filespec.GetDirectory() + '/' + filespec.GetFilename()
+
+
+def describe_thread(thread, with_frames):
+    result = {'tid': thread.GetThreadID(),
+              'stop_reason': thread.GetStopReason()}
+    if with_frames:
+        frames = []
+        for frame in thread:
+            line_entry = frame.GetLineEntry()
+            if line_entry:
+                frames.append([filespec_path(line_entry.GetFileSpec()), line_entry.GetLine()])
+            else:
+                frames.append([None, 0])
+        result['frames'] = frames
+    return result
+
+
+def describe_process_event(ev):
+    result = {'type': ev.GetType()}
+    if ev.GetType() & lldb.SBProcess.eBroadcastBitStateChanged:
+        state = lldb.SBProcess.GetStateFromEvent(ev)
+        result['state'] = state
+        result['restarted'] = bool(lldb.SBProcess.GetRestartedFromEvent(ev))
+
+        process = lldb.SBProcess.GetProcessFromEvent(ev)
+        if process.IsValid():
+            result['pid'] = process.GetProcessID()
+            if state in _stopped_states:
+                # Frames are only needed for the selected thread. Processes
+                # can have thousands of threads.
+                selected = process.GetSelectedThread().GetThreadID()
+                result['selected_thread'] = selected
+                result['threads'] = [describe_thread(t, t.GetThreadID() == selected) for t in process]
+    return result
+
+
+def describe_breakpoint_event(ev):
+    bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
+    locations = []
+    for loc in bp:
+        path = None
+        line = 0
+        if loc and loc.GetAddress():
+            line_entry = loc.GetAddress().GetLineEntry()
+            if line_entry:
+                path = filespec_path(line_entry.GetFileSpec())
+                line = line_entry.GetLine()
+        locations.append([path, line, bool(loc.IsEnabled())])
+
+    return {'type': lldb.SBBreakpoint.GetBreakpointEventTypeFromEvent(ev),
+            'id': bp.GetID(),
+            'enabled': bool(bp.IsEnabled()),
+            'new_locations': lldb.SBBreakpoint.GetNumBreakpointLocationsFromEvent(ev),
+            'locations': locations}
+
+
+def describe_interpreter_event(ev):
+    return {'type': ev.GetType(),
+            'data': lldb.SBEvent.GetCStringFromEvent(ev)}
+
+
+class EventJournal(object):
+    """Line-delimited JSON journal of the events handled by the driver.
+        record() can be called from any thread."""
+    def __init__(self, path):
+        self.__path = path
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'a')
+        self.__write({'t': monotonic(), 'kind': eKindSession,
+                      'version': lldb.SBDebugger.GetVersionString()})
+        debug(debugDriver, 'journaling events to %s' % path)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def record(self, kind, start, duration, ev):
+        """Records an event of the given kind, which started being handled
+            at start and took duration seconds."""
+        if kind == eKindProcess:
+            description = describe_process_event(ev)
+        elif kind == eKindBreakpoint:
+            description = describe_breakpoint_event(ev)
+        elif kind == eKindInterpreter:
+            description = describe_interpreter_event(ev)
+        else:
+            description = {'type': ev.GetType()}
+
+        self.__write({'t': start, 'dur': duration, 'kind': kind, 'event': description})
+
+    def close(self):
+        with self.__lock:
+            if self.__file:
+                self.__file.close()
+                self.__file = None
+
+    def __write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.__lock:
+            if self.__file:
+                self.__file.write(line + '\n')
+                self.__file.flush()
@@ -2,16 +2,21 @@
 
 import os
 import lldb
+import Queue
 import lldbutil
 import sublime
 import threading
 
-from debug import debug, debugDriver
-from utilities import stderr_msg, stdout_msg
-from root_objects import set_driver_instance, lldb_view_send, LldbInputDelegate, ui_updater
+from collections import deque
+
+from debug import debug, debugDriver, trace_stop, trace_stage
+from journal import EventJournal, eKindProcess, eKindBreakpoint, eKindInterpreter, eKindOther
+from utilities import stderr_msg, stdout_msg, monotonic, canonical_path, SettingsManager
+from root_objects import set_driver_instance, lldb_view_send, LldbInputDelegate, ui_updater, \
+                         lldb_process_output_send, lldb_prompt, current_session, set_thread_session, \
+                         session_callback, run_on_ui_thread
 
 BIG_TIMEOUT = 42000000
-START_LLDB_TIMEOUT = 5
 
 
 def version():
@@ -22,56 +27,189 @@ def thread_created(string):
     lldb.SBHostOS.ThreadCreated(string)
 
 
+def breakpoint_location_line(loc):
+    """Returns the (file name, line) for a breakpoint location, or None
+        if it doesn't have line information."""
+    if loc and loc.GetAddress():
+        line_entry = loc.GetAddress().GetLineEntry()
+        if line_entry:
+            filespec = line_entry.GetFileSpec()
+            if filespec:
+                return (filespec.GetDirectory() + '/' + filespec.GetFilename(), line_entry.GetLine())
+    return None
+
+
+def breakpoint_lines_by_file(bp):
+    """Resolves a breakpoint's locations to a dictionary from file name to
+        a list of (line, is_enabled) tuples. Locations without line
+        information are skipped."""
+    result = {}
+    for loc in bp:
+        entry = breakpoint_location_line(loc)
+        if entry:
+            result.setdefault(entry[0], []).append((entry[1], loc.IsEnabled()))
+    return result
+
+
+def subtract_breakpoint_lines(a, b):
+    """Returns the lines in a which aren't in b, with a and b being
+        breakpoint_lines_by_file() results."""
+    result = {}
+    for (filename, lines) in a.iteritems():
+        remaining = list(lines)
+        for line in b.get(filename, []):
+            if line in remaining:
+                remaining.remove(line)
+        if remaining:
+            result[filename] = remaining
+    return result
+
+
+# lldb.SBDebugger.Initialize() and Terminate() act on the whole process,
+# which every session's driver shares. lldb is terminated when the last
+# driver is gone.
+__lldb_users = 0
+__lldb_users_lock = threading.Lock()
+
+
+def initialize_lldb():
+    """Initializes lldb, unless another driver already did."""
+    global __lldb_users
+    with __lldb_users_lock:
+        if __lldb_users == 0:
+            lldb.SBDebugger.Initialize()
+        __lldb_users += 1
+
+
+def terminate_lldb():
+    """Terminates lldb, if no other driver is using it."""
+    global __lldb_users
+    with __lldb_users_lock:
+        __lldb_users -= 1
+        if __lldb_users == 0:
+            debug(debugDriver, 'no drivers left, terminating lldb')
+            lldb.SBDebugger.Terminate()
+
+
+def send_command_output(future):
+    """Completion callback which writes a command's output and error to
+        the lldb i/o view."""
+    (result, r) = future.result()
+    if result.GetOutputSize() > 0:
+        lldb_view_send(stdout_msg(result.GetOutput()))
+    if result.GetErrorSize() > 0:
+        lldb_view_send(stderr_msg(result.GetError()))
+
+
+def send_command_and_output(future):
+    """Like send_command_output, but echoes the command first."""
+    lldb_view_send(lldb_prompt() + future.command + '\n')
+    send_command_output(future)
+
+
 class LldbDriver(threading.Thread):
     eBroadcastBitThreadShouldExit = 1 << 0
     eBroadcastBitThreadDidStart = 1 << 1
     eBroadcastBitReadyForInput = 1 << 2
+    eBroadcastBitCreateBreakpoints = 1 << 3
 
     __is_done = False
     __io_channel = None
     __broadcaster = None
     __input_reader = None
+    __command_worker = None
+    __journal = None
     __waiting_for_command = False
+    __stop_id = 0
+    __thread_index = None
+    __bp_index = None
+    __bp_store = None
+    # Target whose breakpoints are in __bp_index.
+    __bp_target = None
+    __pending_bps = None
+    __snapshot = None
+    __starting = True
+    # Whether we called initialize_lldb() (and still have to terminate it).
+    __lldb_initialized = False
 
     # FIXME: This should be configurable
     __max_instructions = 200
 
     ##########################################
     # Python object functions.
-    def __init__(self, window, log_callback=None, process_stopped_callback=None, on_exit_callback=None):
+    def __init__(self, window, log_callback=None, process_stopped_callback=None, on_exit_callback=None,
+                 startup_commands=[]):
         super(LldbDriver, self).__init__(name='sublime.lldb.driver')
+        self.__session = current_session()
         self.__window = window
-        lldb.SBDebugger.Initialize()
         self.__broadcaster = lldb.SBBroadcaster('Driver')
         self.__process_stopped_callback = process_stopped_callback
         self.__on_exit_callback = on_exit_callback
 
-        # if log_callback:
-            # self._debugger = lldb.SBDebugger.Create(False, log_callback)
-        # else:
-        self._debugger = lldb.SBDebugger.Create(False)
-        self.__listener = self._debugger.GetListener()
+        # The SBDebugger is only created by the driver thread, so we don't
+        # make whoever is starting us (usually the UI thread) wait for it.
+        self._debugger = None
+        self.__listener = None
+        self.__debugger_created = threading.Event()
+        self.__snapshot_lock = threading.Lock()
         set_driver_instance(self)
-        r, w = os.pipe()
-        self.__io_channel_r_fh = os.fdopen(r, 'r', 0)
-        self.__io_channel_w_fh = os.fdopen(w, 'w', 0)
-        self.__io_channel = IOChannel(self, self.__io_channel_r_fh, lldb_view_send)
+        self.__input_queue = InputCommandQueue()
+        self.__io_channel = IOChannel(self, self.__input_queue, lldb_view_send)
         # self._debugger.SetCloseInputOnEOF(False)
         self.__input_reader = lldb.SBInputReader()
+        self.__command_worker = LldbCommandWorker(self)
+
+        # The init files and startup commands are the first thing the
+        # command worker will run. User commands will have to wait for them.
+        self.__startup_times = []
+        self.__startup = [SourceInitFilesFuture()] + [CommandFuture(cmd) for cmd in startup_commands]
+        self.__startup[0].add_done_callback(send_command_output)
+        self.__startup[0].add_done_callback(lambda f: self.__startup_phase_done('init files'))
+        for f in self.__startup[1:]:
+            f.add_done_callback(send_command_and_output)
+        if len(self.__startup) > 1:
+            self.__startup[-1].add_done_callback(lambda f: self.__startup_phase_done('startup commands'))
+        self.__startup[-1].add_done_callback(self.__startup_done)
+        self.__command_worker.submit(self.__startup)
+
+        sm = SettingsManager.getSM()
+        self.__process_output_read_size = sm.get_default('i/o.process_output.read_size', 65536)
+        self.__journal_path = sm.get_default('journal.path', None)
+        self.__thread_index = ThreadStopIndex(sm.get_default('threads.scan_limit', 1024))
+        self.__bp_index = BreakpointLocationIndex()
+        self.__bp_target_lock = threading.Lock()
+        # (PendingBreakpoints, callback, time requested) for the driver thread
+        # to create.
+        self.__bp_requests = Queue.Queue()
 
     def __del__(self):
-        # del self.__io_channel
-        # del self.__broadcaster
-        # del self._debugger
-        lldb.SBDebugger.Terminate()
+        # In case we never got to the end of our run loop.
+        self.__destroy_debugger()
 
     ##########################################
     # Driver properties.
     @property
     def debugger(self):
-        """The low-level SBDebugger for this driver."""
+        """The low-level SBDebugger for this driver, or None if the driver
+            thread didn't create it yet (see tried_creating_debugger)."""
         return self._debugger
 
+    @property
+    def tried_creating_debugger(self):
+        """True once the driver thread tried to create the SBDebugger. If
+            debugger is None by then, it failed (or is already gone)."""
+        return self.__debugger_created.is_set()
+
+    @property
+    def session(self):
+        """The LldbSession this driver belongs to."""
+        return self.__session
+
+    @property
+    def is_starting(self):
+        """True until the init files and startup commands have been run."""
+        return self.__starting
+
     @property
     def broadcaster(self):
         return self.__broadcaster
@@ -80,6 +218,40 @@ class LldbDriver(threading.Thread):
     def listener(self):
         return self.__listener
 
+    @property
+    def breakpoint_store(self):
+        """The BreakpointStore where we keep this target's breakpoints (or
+            None)."""
+        return self.__bp_store
+
+    @breakpoint_store.setter
+    def breakpoint_store(self, store):
+        if self.__bp_store and self.__bp_store is not store:
+            self.__bp_store.close()
+        self.__bp_store = store
+
+    @property
+    def pending_breakpoints(self):
+        """The PendingBreakpoints we created the default breakpoints with
+            (or None)."""
+        return self.__pending_bps
+
+    def create_breakpoints(self, pending, on_done=None):
+        """Creates pending's breakpoints on the driver thread (the ones it
+            can find, see PendingBreakpoints), and looks for the others as
+            modules are loaded. Then calls on_done(number of breakpoints
+            created) on the UI thread."""
+        self.__pending_bps = pending
+        if on_done:
+            on_done = session_callback(on_done)
+        self.__bp_requests.put((pending, on_done, monotonic()))
+        self.broadcaster.BroadcastEventByType(LldbDriver.eBroadcastBitCreateBreakpoints)
+
+    @property
+    def command_worker(self):
+        """The thread which runs every command we send to lldb."""
+        return self.__command_worker
+
     @property
     def io_channel(self):
         """The IO channel for this driver."""
@@ -98,10 +270,35 @@ class LldbDriver(threading.Thread):
     def is_done(self, done):
         self.__is_done = done
 
+    @property
+    def stop_id(self):
+        """Counter bumped on every process state transition we react to.
+            This lldb version doesn't have SBProcess.GetStopID(), so we keep
+            our own to tell stale UI refreshes apart."""
+        return self.__stop_id
+
     ##########################################
     # Process queries.
+    def snapshot(self):
+        """The StopSnapshot for the current stop ID."""
+        with self.__snapshot_lock:
+            if self.__snapshot is None or self.__snapshot.stop_id != self.__stop_id:
+                self.__snapshot = StopSnapshot(self.__stop_id, self.current_process(), self)
+            return self.__snapshot
+
+    def invalidate_snapshot(self):
+        """Makes snapshot() fetch everything again (e.g: after a command
+            which may have selected another thread or frame)."""
+        with self.__snapshot_lock:
+            if self.__snapshot is not None:
+                debug(debugDriver, 'invalidating %s' % repr(self.__snapshot))
+            self.__snapshot = None
+
     def current_target(self):
-        target = self.debugger.GetSelectedTarget()
+        debugger = self.debugger
+        if debugger is None:
+            return None
+        target = debugger.GetSelectedTarget()
         return target
 
     def current_process(self):
@@ -207,39 +404,29 @@ class LldbDriver(threading.Thread):
 
         return result
 
-    def get_breakpoint_locations_for_file(self, filename):
-        bp_iter = self.current_target().breakpoint_iter()
-
-        def filter(bp_loc):
-            addr = bp_loc.GetAddress()
-            if addr:
-                line_entry = addr.GetLineEntry()
-                if line_entry:
-                    filespec = line_entry.GetFileSpec()
-                    if filespec:
-                        filespec_path = filespec.GetDirectory() + '/' + filespec.GetFilename()
-                        return filespec_path == filename
-
-        lst = [bp_loc for bp in bp_iter for bp_loc in bp if filter(bp_loc)]
-        return lst
+    def get_breakpoint_lines_for_file(self, filename):
+        """Returns a list of (line, is_enabled) tuples, one per breakpoint
+            location in filename."""
+        self.check_selected_target()
+        return self.__bp_index.lines_for_file(filename)
 
     ##########################################
     # Process I/O methods.
     def get_process_stdout(self):
-        string = stdout_msg(self.debugger.GetSelectedTarget(). \
-            GetProcess().GetSTDOUT(1024))
+        process = self.current_process()
+        size = self.__process_output_read_size
+        string = process.GetSTDOUT(size)
         while len(string) > 0:
-            lldb_view_send(string)
-            string = stdout_msg(self.debugger.GetSelectedTarget(). \
-                GetProcess().GetSTDOUT(1024))
+            lldb_process_output_send(stdout_msg(string))
+            string = process.GetSTDOUT(size)
 
     def get_process_stderr(self):
-        string = stderr_msg(self.debugger.GetSelectedTarget(). \
-            GetProcess().GetSTDOUT(1024))
+        process = self.current_process()
+        size = self.__process_output_read_size
+        string = process.GetSTDERR(size)
         while len(string) > 0:
-            lldb_view_send(string)
-            string = stderr_msg(self.debugger.GetSelectedTarget(). \
-                GetProcess().GetSTDOUT(1024))
+            lldb_process_output_send(stderr_msg(string))
+            string = process.GetSTDERR(size)
 
     ##########################################
     # Driver input methods.
@@ -262,19 +449,33 @@ class LldbDriver(threading.Thread):
             self.broadcaster.BroadcastEventByType(LldbDriver.eBroadcastBitReadyForInput, False)
 
     def send_input(self, cmd):
-        """Send a command asynchronously to the IO channel."""
-        self.__to_debugger_fh_w.write(bytes(cmd) + '\n')
-        self.__to_debugger_fh_w.flush()
-        # event = lldb.SBEvent(IOChannel.eBroadcastBitHasUserInput, str(cmd))
-        # self.io_channel.broadcaster.BroadcastEvent(event)
+        """Send a command asynchronously to the IO channel. Commands are
+            queued if the debugger is busy."""
+        if self.debugger.InputReaderIsTopReader(self.__input_reader):
+            self.__input_queue.put(str(cmd))
+        else:
+            # Another input reader is active (e.g: 'script'). Let lldb
+            # dispatch the input to it.
+            self.__to_debugger_fh_w.write(bytes(cmd) + '\n')
+            self.__to_debugger_fh_w.flush()
+
+    def cancel_pending_input(self):
+        """Drops any commands that were queued but haven't started running.
+            Returns the number of cancelled commands."""
+        return self.__input_queue.cancel()
+
+    def handle_user_input(self, command_string):
+        """Runs a command typed by the user. Called by the IO channel."""
+        debug(debugDriver, 'waiting_for_command = False')
+        self.__waiting_for_command = False
+        self.interpret_command_async(command_string, self.__user_command_done, True)
 
     def __input_reader_callback(self, input_reader, notification, bytes):
         if (notification == lldb.eInputReaderReactivate):
             self.ready_for_command()
         elif (notification == lldb.eInputReaderGotToken):
             # We're using a Line granularity. We don't receive the \n
-            self.__io_channel_w_fh.write(bytes + '\n')
-            self.__io_channel_w_fh.flush()
+            self.__input_queue.put(bytes)
         elif (notification == lldb.eInputReaderAsynchronousOutputWritten):
             io_channel = self.io_channel
             if io_channel:
@@ -290,7 +491,7 @@ class LldbDriver(threading.Thread):
             if io_channel:
                 io_channel.out_write('^D\n', io_channel.NO_ASYNC)
                 # io_channel.refresh_prompt()
-            self.__io_channel_w_fh.write(b'quit\n')
+            self.__input_queue.put('quit')
         elif (notification == lldb.eInputReaderActivate):
             pass
         elif (notification == lldb.eInputReaderDeactivate):
@@ -319,13 +520,17 @@ class LldbDriver(threading.Thread):
     # Driver run loop.
     def run(self):
         thread_created('<' + self.name + '>')
+        set_thread_session(self.__session)
 
+        self.__create_debugger()
         sb_interpreter = self._debugger.GetCommandInterpreter()
         #listener = self._debugger.GetListener()
         listener = self.__listener
         listener.StartListeningForEventClass(self._debugger,
                      lldb.SBTarget.GetBroadcasterClassName(),
-                     lldb.SBTarget.eBroadcastBitBreakpointChanged)
+                     lldb.SBTarget.eBroadcastBitBreakpointChanged |   \
+                     lldb.SBTarget.eBroadcastBitModulesLoaded)
+        listener.StartListeningForEvents(self.broadcaster, LldbDriver.eBroadcastBitCreateBreakpoints)
         # This isn't in Driver.cpp. Check why it listens to those events (because it uses SBDebugger's listener?)
         # listener.StartListeningForEventClass(self._debugger,
         #              lldb.SBProcess.GetBroadcasterClassName(),
@@ -334,6 +539,9 @@ class LldbDriver(threading.Thread):
         #              lldb.SBProcess.eBroadcastBitSTDOUT |           \
         #              lldb.SBProcess.eBroadcastBitSTDERR)
 
+        if self.__journal_path:
+            self.__journal = EventJournal(os.path.expanduser(self.__journal_path))
+
         # Warn whoever started us that we can start working
         self.broadcaster.BroadcastEventByType(LldbDriver.eBroadcastBitThreadDidStart)
 
@@ -369,7 +577,6 @@ class LldbDriver(threading.Thread):
         if listener.IsValid():
             iochannel_thread_exited = False
             listener.StartListeningForEvents(self.io_channel.broadcaster,
-                        IOChannel.eBroadcastBitHasUserInput |      \
                         IOChannel.eBroadcastBitUserInterrupt |     \
                         IOChannel.eBroadcastBitThreadShouldExit |  \
                         IOChannel.eBroadcastBitThreadDidStart |    \
@@ -382,53 +589,29 @@ class LldbDriver(threading.Thread):
                             lldb.SBCommandInterpreter.eBroadcastBitAsynchronousOutputData | \
                             lldb.SBCommandInterpreter.eBroadcastBitAsynchronousErrorData)
 
-                result = lldb.SBCommandReturnObject()
-                sb_interpreter.SourceInitFileInHomeDirectory(result)
-                # TODO Remove this debugging feature and have a way to report
-                # errors in init files.
-                if True:
-                    result.PutError(self.debugger.GetErrorFileHandle())
-                    result.PutOutput(self.debugger.GetOutputFileHandle())
-
-                sb_interpreter.SourceInitFileInCurrentWorkingDirectory(result)
-                # TODO Remove this debugging feature and have a way to report
-                # errors in init files.
-                if True:
-                    result.PutError(self.debugger.GetErrorFileHandle())
-                    result.PutOutput(self.debugger.GetOutputFileHandle())
-
                 event = lldb.SBEvent()
                 listener.WaitForEventForBroadcasterWithType(BIG_TIMEOUT,
                             self.io_channel.broadcaster,
                             IOChannel.eBroadcastBitThreadDidStart,
                             event)
-
-                self.ready_for_command()
+                self.__startup_phase_done('i/o')
+
+                # Source the init files and run the startup commands in the
+                # background. We'll be ready for user commands when they're
+                # done.
+                self.command_worker.start()
+                # Breakpoints may have been requested before we listened for
+                # those requests.
+                self.__create_breakpoints()
                 while not self.is_done:
                     listener.WaitForEvent(BIG_TIMEOUT, event)
                     if event:
                         if event.GetBroadcaster():
+                            start = monotonic()
+                            kind = eKindOther
                             ev_type = event.GetType()
                             if (event.BroadcasterMatchesRef(self.io_channel.broadcaster)):
-                                if ev_type & IOChannel.eBroadcastBitHasUserInput:
-                                    command_string = lldb.SBEvent.GetCStringFromEvent(event)
-                                    if command_string is None:
-                                        command_string = ''
-                                    result = lldb.SBCommandReturnObject()
-
-                                    self.debugger.GetCommandInterpreter().HandleCommand(command_string, result, True)
-                                    if result.GetOutputSize() > 0:
-                                        self.io_channel.out_write(result.GetOutput(), IOChannel.NO_ASYNC)
-
-                                    if result.GetErrorSize() > 0:
-                                        self.io_channel.err_write(result.GetError(), IOChannel.NO_ASYNC)
-
-                                    debug(debugDriver, 'waiting_for_command = False')
-                                    self.__waiting_for_command = False
-                                    if self.__input_reader.IsActive():
-                                        self.ready_for_command()
-
-                                elif ev_type & IOChannel.eBroadcastBitThreadShouldExit \
+                                if ev_type & IOChannel.eBroadcastBitThreadShouldExit \
                                     or ev_type & IOChannel.eBroadcastBitThreadDidExit:
                                     self.is_done = True
                                     if ev_type & IOChannel.eBroadcastBitThreadDidExit:
@@ -438,10 +621,18 @@ class LldbDriver(threading.Thread):
                                         if self.__handle_io_event(event):
                                             self.is_done = True
                             elif lldb.SBProcess.EventIsProcessEvent(event):
+                                kind = eKindProcess
                                 self.__handle_process_event(event)
                             elif lldb.SBBreakpoint.EventIsBreakpointEvent(event):
+                                kind = eKindBreakpoint
                                 self.__handle_breakpoint_event(event)
+                            elif event.GetBroadcasterClass() == lldb.SBTarget.GetBroadcasterClassName():
+                                self.__handle_target_event(event)
+                            elif event.BroadcasterMatchesRef(self.broadcaster):
+                                if ev_type & LldbDriver.eBroadcastBitCreateBreakpoints:
+                                    self.__create_breakpoints()
                             elif event.BroadcasterMatchesRef(sb_interpreter.GetBroadcaster()):
+                                kind = eKindInterpreter
                                 # This first one should be replaced with a CommandOverrideCallback function
                                 if ev_type & lldb.SBCommandInterpreter.eBroadcastBitQuitCommandReceived:
                                     self.is_done = True
@@ -454,6 +645,9 @@ class LldbDriver(threading.Thread):
                                     self.io_channel.out_write(data, IOChannel.ASYNC)
                                     lldb_view_send(stdout_msg(data))
 
+                            if self.__journal:
+                                self.__journal.record(kind, start, monotonic() - start, event)
+
                 if not iochannel_thread_exited:
                     event.Clear()
                     listener.GetNextEventForBroadcasterWithType(self.io_channel.broadcaster,
@@ -462,12 +656,17 @@ class LldbDriver(threading.Thread):
                     if not event:
                         self.io_channel.stop()
 
+                self.command_worker.stop()
                 self.__file_monitor.setDone()
+                if self.__journal:
+                    self.__journal.close()
+                if self.__bp_store:
+                    self.__bp_store.close()
                 # Ensure the listener (and everything else, really) is destroyed BEFORE the SBDebugger
                 # Otherwise lldb will try to lock a destroyed mutex.
                 # TODO: Track that bug!
                 listener = None
-                lldb.SBDebugger.Destroy(self.debugger)
+                self.__destroy_debugger()
 
         debug(debugDriver, 'leaving')
         set_driver_instance(None)
@@ -476,83 +675,135 @@ class LldbDriver(threading.Thread):
 
     def stop(self):
         self.broadcaster.BroadcastEventByType(LldbDriver.eBroadcastBitThreadShouldExit)
+        # Wake up the IO channel, if it's waiting for a command.
+        self.__input_queue.close()
 
     def __handle_breakpoint_event(self, ev):
         type = lldb.SBBreakpoint.GetBreakpointEventTypeFromEvent(ev)
+        bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
+        store = self.__bp_store
+        if store:
+            # The store knows which target it's for.
+            store.breakpoint_event(ev)
+
+        # Breakpoint IDs are per target, and the index only has the
+        # selected target's breakpoints.
+        target = self.check_selected_target()
+        if not target or not ev.BroadcasterMatchesRef(target.GetBroadcaster()):
+            debug(debugDriver, 'ignoring breakpoint event for another target')
+            return
 
-        # TODO: Remove duplicate code for adding/deleting BP
+        # Besides telling the UI, we keep the breakpoint location index up
+        # to date.
         if type & lldb.eBreakpointEventTypeCommandChanged       \
             or type & lldb.eBreakpointEventTypeIgnoreChanged    \
-            or type & lldb.eBreakpointEventTypeConditionChanged \
-            or type & lldb.eBreakpointEventTypeLocationsResolved:
+            or type & lldb.eBreakpointEventTypeConditionChanged:
             None
-        elif type & lldb.eBreakpointEventTypeAdded:
-            # TODO: show disabled bps
-            bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
-            for loc in bp:
-                entry = None
-                if loc and loc.GetAddress():
-                    line_entry = loc.GetAddress().GetLineEntry()
-                    if line_entry:
-                        filespec = line_entry.GetFileSpec()
-
-                        if filespec:
-                            entry = (filespec.GetDirectory() + '/' + filespec.GetFilename(), \
-                                     line_entry.GetLine())
-                        else:
-                            return None
-                if entry:
-                    ui_updater().breakpoint_added(entry[0], entry[1], loc.IsEnabled())
-
         elif type & lldb.eBreakpointEventTypeEnabled    \
               or type & lldb.eBreakpointEventTypeDisabled:
-            bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
-            for loc in bp:
-                entry = None
-                if loc and loc.GetAddress():
-                    line_entry = loc.GetAddress().GetLineEntry()
-                    if line_entry:
-                        filespec = line_entry.GetFileSpec()
-
-                        if filespec:
-                            entry = (filespec.GetDirectory() + '/' + filespec.GetFilename(), \
-                                     line_entry.GetLine())
-                        else:
-                            return None
-                if entry:
-                    ui_updater().breakpoint_changed(entry[0], entry[1], loc.IsEnabled())
-
+            lines = breakpoint_lines_by_file(bp)
+            self.__bp_index.update(bp.GetID(), lines)
+            self.__send_breakpoint_lines(lines, ui_updater().breakpoints_changed)
         elif type & lldb.eBreakpointEventTypeRemoved:
-            bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
-            for loc in bp:
-                entry = None
-                if loc and loc.GetAddress():
-                    line_entry = loc.GetAddress().GetLineEntry()
-                    if line_entry:
-                        filespec = line_entry.GetFileSpec()
-
-                        if filespec:
-                            entry = (filespec.GetDirectory() + '/' + filespec.GetFilename(), \
-                                     line_entry.GetLine())
-                        else:
-                            return None
-                if entry:
-                    ui_updater().breakpoint_removed(entry[0], entry[1], loc.IsEnabled())
-        elif type & lldb.eBreakpointEventTypeLocationsAdded:
-            new_locs = lldb.SBBreakpoint.GetNumBreakpointLocationsFromEvent(ev)
-            if new_locs > 0:
-                bp = lldb.SBBreakpoint.GetBreakpointFromEvent(ev)
-                lldb_view_send("%d locations added to breakpoint %d\n" %
-                    (new_locs, bp.GetID()))
-        elif type & lldb.eBreakpointEventTypeLocationsRemoved:
-            None
+            lines = self.__bp_index.remove(bp.GetID())
+            if lines is None:
+                lines = breakpoint_lines_by_file(bp)
+            self.__send_breakpoint_lines(lines, ui_updater().breakpoints_removed)
+        elif type & lldb.eBreakpointEventTypeAdded              \
+            or type & lldb.eBreakpointEventTypeLocationsAdded   \
+            or type & lldb.eBreakpointEventTypeLocationsRemoved \
+            or type & lldb.eBreakpointEventTypeLocationsResolved:
+            # TODO: show disabled bps
+            if type & lldb.eBreakpointEventTypeLocationsAdded:
+                new_locs = lldb.SBBreakpoint.GetNumBreakpointLocationsFromEvent(ev)
+                if new_locs > 0:
+                    lldb_view_send("%d locations added to breakpoint %d\n" %
+                        (new_locs, bp.GetID()))
+
+            # Only tell the UI about the lines it doesn't know about yet.
+            lines = breakpoint_lines_by_file(bp)
+            old_lines = self.__bp_index.update(bp.GetID(), lines) or {}
+            self.__send_breakpoint_lines(subtract_breakpoint_lines(old_lines, lines),
+                                         ui_updater().breakpoints_removed)
+            self.__send_breakpoint_lines(subtract_breakpoint_lines(lines, old_lines),
+                                         ui_updater().breakpoints_added)
+
+    def __handle_target_event(self, ev):
+        type = ev.GetType()
+        pending = self.__pending_bps
+        if type & lldb.SBTarget.eBroadcastBitModulesLoaded and pending and len(pending) > 0 and \
+                ev.BroadcasterMatchesRef(pending.target.GetBroadcaster()):
+            # The breakpoints we create will send us breakpoint events, and
+            # those will update the UI.
+            start = monotonic()
+            n = pending.modules_loaded()
+            if n > 0:
+                debug(debugDriver, 'resolved %d pending breakpoints in %.3fs (%d still pending)' %
+                                   (n, monotonic() - start, len(pending)))
+
+    def __create_breakpoints(self):
+        while not self.__bp_requests.empty():
+            (pending, on_done, requested) = self.__bp_requests.get()
+            start = monotonic()
+            n = pending.create()
+            debug(debugDriver, 'created %d breakpoints in %.3fs (%d pending)' %
+                               (n, monotonic() - start, len(pending)))
+            # Including the time it took us to get to them.
+            pending.launch_phase_done('breakpoints', monotonic() - requested)
+            if on_done:
+                run_on_ui_thread(lambda on_done=on_done, n=n: on_done(n))
+
+    def check_selected_target(self):
+        """Makes sure the breakpoint location index (and the UI) have the
+            selected target's breakpoints. When another target is selected,
+            the old target's breakpoints are removed and the new target's
+            are read from lldb. Returns the selected target (or None).
+            Can be called from any thread."""
+        debugger = self.debugger
+        if debugger is None:
+            return None
+        target = debugger.GetSelectedTarget()
+        if not target:
+            target = None
+
+        with self.__bp_target_lock:
+            old_target = self.__bp_target
+            # SBTargets can't be compared, but the debugger finds their
+            # index by identity.
+            if old_target is target or (old_target is not None and target is not None and
+                    debugger.GetIndexOfTarget(old_target) == debugger.GetIndexOfTarget(target)):
+                return target
+
+            debug(debugDriver, 'selected target changed, reloading the breakpoint location index')
+            self.__bp_target = target
+            removed = self.__bp_index.clear()
+            added = {}
+            if target is not None:
+                for bp in target.breakpoint_iter():
+                    lines = breakpoint_lines_by_file(bp)
+                    self.__bp_index.update(bp.GetID(), lines)
+                    for (filename, bp_lines) in lines.iteritems():
+                        added.setdefault(filename, []).extend(bp_lines)
+
+        updater = ui_updater()
+        if updater:
+            self.__send_breakpoint_lines(removed, updater.breakpoints_removed)
+            self.__send_breakpoint_lines(added, updater.breakpoints_added)
+        return target
+
+    def __send_breakpoint_lines(self, lines_by_file, send):
+        """Sends breakpoint lines (as returned by breakpoint_lines_by_file)
+            to the UI updater, with one message per file."""
+        for (filename, lines) in lines_by_file.iteritems():
+            if lines:
+                send(filename, lines)
 
     def __handle_process_event(self, ev):
         type = ev.GetType()
 
         if type & lldb.SBProcess.eBroadcastBitSTDOUT:
             self.get_process_stdout()
-        elif type & lldb.SBProcess.eBroadcastBitSTDOUT:
+        elif type & lldb.SBProcess.eBroadcastBitSTDERR:
             self.get_process_stderr()
         elif type & lldb.SBProcess.eBroadcastBitInterrupt:
             debug(debugDriver, 'Got a process interrupt event!')
@@ -582,12 +833,17 @@ class LldbDriver(threading.Thread):
                     self.debugger.StateAsCString(state))
 
             elif state == lldb.eStateRunning:
-                None  # Don't be too chatty
+                # Don't be too chatty, but let the UI know that any refresh
+                # for the previous stop is now stale.
+                self.__stop_id += 1
+                ui_updater().process_running(self.__stop_id)
+                # If we're stepping, this is the thread that will stop.
+                self.__thread_index.add(process.GetSelectedThread())
             elif state == lldb.eStateExited:
                 debug(debugDriver, 'process state: ' + lldbutil.state_type_to_str(state))
-                r = self.interpret_command('process status')
-                lldb_view_send(stdout_msg(r[0].GetOutput()))
-                lldb_view_send(stderr_msg(r[0].GetError()))
+                self.__stop_id += 1
+                self.__thread_index.clear()
+                self.interpret_command_async('process status', send_command_output)
                 # Remove program counter markers
                 if self.__process_stopped_callback:
                     self.__process_stopped_callback(self, process, state)
@@ -600,7 +856,13 @@ class LldbDriver(threading.Thread):
                     lldb_view_send('Process %llu stopped and was programmatically restarted.' %
                         process.GetProcessID())
                 else:
+                    self.__stop_id += 1
+                    trace_stop(self.__stop_id)
                     self.__update_selected_thread()
+                    # Anything fetched before the thread was selected is
+                    # no good.
+                    self.invalidate_snapshot()
+                    trace_stage(self.__stop_id, 'select thread')
                     if self.__process_stopped_callback:
                         self.__process_stopped_callback(self, process, state)
 
@@ -611,50 +873,554 @@ class LldbDriver(threading.Thread):
             curr_thread = proc.GetSelectedThread()
             current_thread_stop_reason = curr_thread.GetStopReason()
 
-            other_thread = lldb.SBThread()
-            plan_thread = lldb.SBThread()
-            if not curr_thread.IsValid() \
-                or current_thread_stop_reason == lldb.eStopReasonInvalid \
-                or current_thread_stop_reason == lldb.eStopReasonNone:
-                for t in proc:
-                    t_stop_reason = t.GetStopReason()
-                    if t_stop_reason == lldb.eStopReasonInvalid \
-                        or t_stop_reason == lldb.eStopReasonNone:
-                        pass
-                    elif t_stop_reason == lldb.eStopReasonTrace \
-                        or t_stop_reason == lldb.eStopReasonBreakpoint \
-                        or t_stop_reason == lldb.eStopReasonWatchpoint \
-                        or t_stop_reason == lldb.eStopReasonSignal \
-                        or t_stop_reason == lldb.eStopReasonException:
-                        debug(debugDriver, 'thread stop reason: ' + lldbutil.stop_reason_to_str(current_thread_stop_reason))
-                        if not other_thread:
-                            other_thread = t
-                        elif t_stop_reason == lldb.eStopReasonPlanComplete:
-                            if not plan_thread:
-                                plan_thread = t
-
-                if plan_thread:
-                    proc.SetSelectedThread(plan_thread)
-                elif other_thread:
-                    proc.SetSelectedThread(other_thread)
+            if curr_thread.IsValid()                                   \
+                and current_thread_stop_reason != lldb.eStopReasonInvalid \
+                and current_thread_stop_reason != lldb.eStopReasonNone:
+                self.__thread_index.add(curr_thread)
+                return
+
+            thread = self.__thread_index.pick_thread(proc)
+            if not thread:
+                if curr_thread:
+                    thread = curr_thread
                 else:
-                    if curr_thread:
-                        thread = curr_thread
-                    else:
-                        thread = proc.GetThreadAtIndex(0)
+                    thread = proc.GetThreadAtIndex(0)
 
-                    proc.SetSelectedThread(thread)
+            proc.SetSelectedThread(thread)
 
     ##########################################
     # Driver interaction.
     def interpret_command(self, cmd, add_to_history=False):
+        """Runs a command and waits for its result. Returns a tuple with an
+            SBCommandReturnObject and the command's return status."""
+        worker = self.command_worker
+        if not worker.is_alive() or threading.current_thread() is worker:
+            return worker.handle_command(cmd, add_to_history)
+
+        return self.interpret_command_async(cmd, add_to_history=add_to_history).result()
+
+    def interpret_command_async(self, cmd, callback=None, add_to_history=False):
+        """Queues a command on the command worker. Returns a CommandFuture.
+            callback (if any) is called with the future, on the worker
+            thread, after the command is done."""
+        return self.interpret_commands_async([cmd], callback, add_to_history)[0]
+
+    def interpret_commands_async(self, cmds, callback=None, add_to_history=False):
+        """Queues several commands as a batch, which will be run back to
+            back on the command worker. Returns a list of CommandFutures.
+            callback (if any) is called with each future, in order."""
+        futures = [CommandFuture(cmd, add_to_history) for cmd in cmds]
+        if callback:
+            for f in futures:
+                f.add_done_callback(callback)
+        self.command_worker.submit(futures)
+        return futures
+
+    def __create_debugger(self):
+        self.__phase_start = monotonic()
+        try:
+            initialize_lldb()
+            self.__lldb_initialized = True
+            # if log_callback:
+                # self._debugger = lldb.SBDebugger.Create(False, log_callback)
+            # else:
+            self._debugger = lldb.SBDebugger.Create(False)
+            self.__listener = self._debugger.GetListener()
+        finally:
+            # Let whoever is waiting know if we couldn't create it.
+            self.__debugger_created.set()
+        self.__startup_phase_done('debugger')
+
+    def __destroy_debugger(self):
+        """Destroys our debugger (only ours: other sessions have their own),
+            and lets go of lldb."""
+        debugger = self._debugger
+        self._debugger = None
+        if debugger is not None:
+            lldb.SBDebugger.Destroy(debugger)
+        if self.__lldb_initialized:
+            self.__lldb_initialized = False
+            terminate_lldb()
+
+    def __startup_phase_done(self, phase):
+        now = monotonic()
+        self.__startup_times.append((phase, now - self.__phase_start))
+        debug(debugDriver, 'startup phase %s took %.3fs' % self.__startup_times[-1])
+        self.__phase_start = now
+
+    def __startup_done(self, future):
+        self.__starting = False
+        total = sum(t for (phase, t) in self.__startup_times)
+        lldb_view_send('lldb started in %.3fs (%s)\n' % (total,
+            ', '.join(['%s: %.3fs' % p for p in self.__startup_times])))
+        self.ready_for_command()
+
+    def __user_command_done(self, future):
+        (result, r) = future.result()
+        if result.GetOutputSize() > 0:
+            self.io_channel.out_write(result.GetOutput(), IOChannel.NO_ASYNC)
+
+        if result.GetErrorSize() > 0:
+            self.io_channel.err_write(result.GetError(), IOChannel.NO_ASYNC)
+
+        # The command may have created or selected another target.
+        self.check_selected_target()
+
+        if self.__input_reader.IsActive():
+            self.ready_for_command()
+
+
+class ThreadStopIndex(object):
+    """Remembers the threads which recently stopped for a reason (or were
+        stepped), so we can find the thread to select after a stop without
+        calling GetStopReason() on every thread of the process. If none of
+        them stopped, we scan the process' threads, looking at (at most)
+        scan_limit threads (0 means no limit). Only used by the driver
+        thread."""
+    __max_threads = 32
+
+    def __init__(self, scan_limit=0):
+        self.__scan_limit = scan_limit
+        # Thread IDs, most recently added first.
+        self.__tids = []
+        self.__last_scan = (0, 0)
+
+    @property
+    def last_scan(self):
+        """Tuple with the number of threads we looked at and the time we took
+            in the last full scan."""
+        return self.__last_scan
+
+    @staticmethod
+    def is_interesting(stop_reason):
+        return stop_reason == lldb.eStopReasonTrace         \
+            or stop_reason == lldb.eStopReasonBreakpoint    \
+            or stop_reason == lldb.eStopReasonWatchpoint    \
+            or stop_reason == lldb.eStopReasonSignal        \
+            or stop_reason == lldb.eStopReasonException     \
+            or stop_reason == lldb.eStopReasonPlanComplete
+
+    def add(self, thread):
+        if not thread.IsValid():
+            return
+        tid = thread.GetThreadID()
+        if tid in self.__tids:
+            self.__tids.remove(tid)
+        self.__tids.insert(0, tid)
+        del self.__tids[self.__max_threads:]
+
+    def clear(self):
+        self.__tids = []
+
+    def pick_thread(self, proc):
+        """Returns the thread which should be selected, preferring threads
+            which completed a thread plan (e.g: a step). Returns None if no
+            thread stopped for an interesting reason."""
+        other_thread = None
+        for tid in list(self.__tids):
+            t = proc.GetThreadByID(tid)
+            if not t.IsValid():
+                self.__tids.remove(tid)
+                continue
+
+            t_stop_reason = t.GetStopReason()
+            if t_stop_reason == lldb.eStopReasonPlanComplete:
+                return t
+            elif self.is_interesting(t_stop_reason) and not other_thread:
+                other_thread = t
+
+        if other_thread:
+            return other_thread
+        return self.__scan(proc)
+
+    def __scan(self, proc):
+        start = monotonic()
+        n = proc.GetNumThreads()
+        if self.__scan_limit > 0:
+            n = min(n, self.__scan_limit)
+
+        plan_thread = None
+        other_thread = None
+        scanned = 0
+        while scanned < n:
+            t = proc.GetThreadAtIndex(scanned)
+            scanned += 1
+            t_stop_reason = t.GetStopReason()
+            if self.is_interesting(t_stop_reason):
+                debug(debugDriver, 'thread stop reason: ' + lldbutil.stop_reason_to_str(t_stop_reason))
+                self.add(t)
+                if t_stop_reason == lldb.eStopReasonPlanComplete:
+                    plan_thread = t
+                    break
+                elif not other_thread:
+                    other_thread = t
+
+        self.__last_scan = (scanned, monotonic() - start)
+        debug(debugDriver, 'scanned %d of %d threads in %.3fs' %
+            (scanned, proc.GetNumThreads(), self.__last_scan[1]))
+        return plan_thread or other_thread
+
+
+class BreakpointLocationIndex(object):
+    """Breakpoint lines for each file, kept up to date from the breakpoint
+        events, so we don't have to go through every breakpoint location of
+        the target to find the ones in a file. Files are looked up by their
+        canonical path. Can be used from any thread."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # Breakpoint ID -> breakpoint_lines_by_file() result
+        self.__bps = {}
+        # Canonical path -> set of breakpoint IDs with locations there
+        self.__files = {}
+
+    def update(self, bp_id, lines_by_file):
+        """Sets the lines for a breakpoint. Returns its previous lines (or
+            None, if we didn't know about it)."""
+        with self.__lock:
+            old = self.__remove(bp_id)
+            self.__bps[bp_id] = lines_by_file
+            for filename in lines_by_file:
+                self.__files.setdefault(canonical_path(filename), set()).add(bp_id)
+            return old
+
+    def remove(self, bp_id):
+        """Forgets about a breakpoint. Returns its lines (or None, if we
+            didn't know about it)."""
+        with self.__lock:
+            return self.__remove(bp_id)
+
+    def clear(self):
+        """Forgets every breakpoint. Returns their lines, merged by file
+            (like breakpoint_lines_by_file)."""
+        with self.__lock:
+            lines_by_file = {}
+            for bp_lines in self.__bps.itervalues():
+                for (filename, lines) in bp_lines.iteritems():
+                    lines_by_file.setdefault(filename, []).extend(lines)
+            self.__bps = {}
+            self.__files = {}
+            return lines_by_file
+
+    def lines_for_file(self, filename):
+        """Returns a list of (line, is_enabled) tuples, one per breakpoint
+            location in filename."""
+        path = canonical_path(filename)
+        result = []
+        with self.__lock:
+            for bp_id in self.__files.get(path, ()):
+                for (bp_filename, lines) in self.__bps[bp_id].iteritems():
+                    if canonical_path(bp_filename) == path:
+                        result.extend(lines)
+        return result
+
+    def __remove(self, bp_id):
+        old = self.__bps.pop(bp_id, None)
+        if old is not None:
+            for filename in old:
+                path = canonical_path(filename)
+                bp_ids = self.__files.get(path)
+                if bp_ids is not None:
+                    bp_ids.discard(bp_id)
+                    if not bp_ids:
+                        del self.__files[path]
+        return old
+
+
+class StopSnapshot(object):
+    """The process' state for a stop, fetched from lldb at most once. Every
+        view refreshing for that stop reads from the same snapshot, instead
+        of asking lldb (maybe through a remote debugserver) for the same
+        data. Can be used from any thread. Each piece of data is fetched by
+        the first thread which asks for it."""
+    def __init__(self, stop_id, process, driver):
+        self.__stop_id = stop_id
+        self.__process = process
+        self.__driver = driver
+        self.__lock = threading.Lock()
+        # key -> [lock, fetched?, value]
+        self.__cache = {}
+        self.__fetches = 0
+        self.__hits = 0
+
+    def __repr__(self):
+        return '<StopSnapshot for stop %d: %d fetches, %d hits>' % \
+            (self.__stop_id, self.__fetches, self.__hits)
+
+    @property
+    def stop_id(self):
+        return self.__stop_id
+
+    @property
+    def process(self):
+        return self.__process
+
+    def selected_thread(self):
+        return self.__memo('selected thread', self.__process.GetSelectedThread)
+
+    def threads(self):
+        process = self.__process
+        return self.__memo('threads', lambda:
+            [process.GetThreadAtIndex(i) for i in xrange(process.GetNumThreads())])
+
+    def frames(self, thread):
+        return self.__memo(('frames', thread.GetThreadID()), lambda: list(thread))
+
+    def line_entries(self, thread):
+        """List with a (file name, line) tuple for each of thread's frames.
+            The file name is None if the frame has no line information."""
+        def fetch():
+            result = []
+            for frame in self.frames(thread):
+                line_entry = frame.GetLineEntry()
+                filespec = line_entry.GetFileSpec()
+                if filespec:
+                    result.append((filespec.GetDirectory() + '/' + filespec.GetFilename(),
+                                   line_entry.GetLine()))
+                else:
+                    result.append((None, 0))
+            return result
+        return self.__memo(('line entries', thread.GetThreadID()), fetch)
+
+    def frame_lines(self, thread):
+        """Dictionary from (canonical) file name to the line of the topmost
+            frame of thread in that file."""
+        def fetch():
+            result = {}
+            for (filename, line) in self.line_entries(thread):
+                if filename is not None:
+                    result.setdefault(canonical_path(filename), line)
+            return result
+        return self.__memo(('frame lines', thread.GetThreadID()), fetch)
+
+    def selected_frame(self, thread):
+        return self.__memo(('selected frame', thread.GetThreadID()), thread.GetSelectedFrame)
+
+    def pc(self, thread=None):
+        """Load address of the PC for thread's selected frame (by default,
+            the selected thread's)."""
+        if thread is None:
+            thread = self.selected_thread()
+        if not thread:
+            return False
+
+        def fetch():
+            frame = self.selected_frame(thread)
+            if not frame:
+                return False
+            return frame.GetPCAddress().GetLoadAddress(self.__process.GetTarget())
+        return self.__memo(('pc', thread.GetThreadID()), fetch)
+
+    def registers(self, thread):
+        """Registers for thread's selected frame, as a list of
+            (register set name, number of registers, registers) tuples.
+            Registers are (name, value, value as unsigned) tuples, for the
+            registers which have a value."""
+        def fetch():
+            result = []
+            for value in self.selected_frame(thread).GetRegisters():
+                registers = []
+                for child in value:
+                    if child.GetValue() is not None:
+                        registers.append((child.GetName(), child.GetValue(), child.GetValueAsUnsigned()))
+                result.append((value.GetName(), value.GetNumChildren(), registers))
+            return result
+        return self.__memo(('registers', thread.GetThreadID()), fetch)
+
+    def variables(self, thread):
+        """Variables (arguments, locals, statics and in scope only) for
+            thread's selected frame."""
+        return self.__memo(('variables', thread.GetThreadID()), lambda:
+            list(self.selected_frame(thread).GetVariables(True, True, True, True)))
+
+    def disassembly(self, thread):
+        """Instructions around the PC of thread's selected frame, like
+            LldbDriver.disassemble_frame()."""
+        return self.__memo(('disassembly', thread.GetThreadID()), lambda:
+            self.__driver.disassemble_frame(self.selected_frame(thread)))
+
+    def __memo(self, key, fetch):
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is None:
+                entry = [threading.Lock(), False, None]
+                self.__cache[key] = entry
+                self.__fetches += 1
+            else:
+                self.__hits += 1
+
+        # Only hold the entry's lock while fetching, so other threads can
+        # fetch other data in the meantime.
+        with entry[0]:
+            if not entry[1]:
+                entry[2] = fetch()
+                entry[1] = True
+        return entry[2]
+
+
+class CommandFuture(object):
+    """Result of a command sent to the LldbCommandWorker."""
+    def __init__(self, cmd, add_to_history=False):
+        self.__cmd = cmd
+        self.__add_to_history = add_to_history
+        self.__result = None
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+        self.__done = threading.Event()
+
+    @property
+    def command(self):
+        return self.__cmd
+
+    @property
+    def add_to_history(self):
+        return self.__add_to_history
+
+    def done(self):
+        return self.__done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the command to finish and returns a tuple with an
+            SBCommandReturnObject and the command's return status. Returns
+            None if we timed out."""
+        self.__done.wait(timeout)
+        return self.__result
+
+    def run(self, worker):
+        """Runs the command. Called by the worker."""
+        return worker.handle_command(self.__cmd, self.__add_to_history)
+
+    def add_done_callback(self, fn):
+        """Calls fn(self) when the command is done. If it already is, fn is
+            called immediately, on the current thread."""
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        with self.__lock:
+            self.__result = result
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                debug(debugDriver, 'exception in callback for command %s: %s' % (self.__cmd, e))
+
+
+class SourceInitFilesFuture(CommandFuture):
+    """Sources ~/.lldbinit and the current directory's .lldbinit, like the
+        lldb command line driver does at start-up."""
+    def __init__(self):
+        super(SourceInitFilesFuture, self).__init__('<init files>')
+
+    def run(self, worker):
+        return worker.source_init_files()
+
+
+class LldbCommandWorker(threading.Thread):
+    """Thread which owns the command interpreter. Commands are run in the
+        order they were submitted, with each batch running back to back, so
+        whoever submits them doesn't have to wait for lldb."""
+    def __init__(self, driver):
+        super(LldbCommandWorker, self).__init__(name='sublime.lldb.command-worker')
+        self.__session = current_session()
+        self.daemon = True
+        self.__driver = driver
+        self.__queue = Queue.Queue()
+
+    def submit(self, futures):
+        self.__queue.put(futures)
+
+    def source_init_files(self):
         result = lldb.SBCommandReturnObject()
-        ci = self.debugger.GetCommandInterpreter()
+        ci = self.__driver.debugger.GetCommandInterpreter()
+
+        ci.SourceInitFileInHomeDirectory(result)
+        ci.SourceInitFileInCurrentWorkingDirectory(result)
+
+        return (result, result.GetStatus())
+
+    def stop(self):
+        self.__queue.put(None)
+
+    def handle_command(self, cmd, add_to_history=False):
+        result = lldb.SBCommandReturnObject()
+        ci = self.__driver.debugger.GetCommandInterpreter()
 
         r = ci.HandleCommand(str(cmd), result, add_to_history)
 
         return (result, r)
 
+    def run(self):
+        thread_created('<' + self.name + '>')
+        set_thread_session(self.__session)
+
+        batch = self.__queue.get()
+        while batch is not None:
+            for future in batch:
+                debug(debugDriver, 'running command: %s' % future.command)
+                result = future.run(self)
+                # Commands typed by the user may select another thread or
+                # frame, or change registers and variables.
+                if future.add_to_history:
+                    self.__driver.invalidate_snapshot()
+                future.set_result(result)
+
+            batch = self.__queue.get()
+
+        self.__driver = None
+        debug(debugDriver, 'leaving')
+
+
+class InputCommandQueue(object):
+    """Thread-safe queue of commands typed by the user, waiting for the
+        debugger to be ready. Commands can be typed ahead, without blocking,
+        and pending commands can be cancelled."""
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__commands = deque()
+        self.__closed = False
+
+    def __len__(self):
+        with self.__cond:
+            return len(self.__commands)
+
+    def put(self, cmd):
+        """Queues a command. Never blocks. Returns False if the queue was
+            already closed."""
+        with self.__cond:
+            if self.__closed:
+                return False
+            self.__commands.append(cmd)
+            self.__cond.notify()
+            return True
+
+    def get(self):
+        """Blocks until there's a command to run. Returns None if the queue
+            was closed."""
+        with self.__cond:
+            while not self.__closed and len(self.__commands) == 0:
+                self.__cond.wait()
+            if self.__closed:
+                return None
+            return self.__commands.popleft()
+
+    def cancel(self):
+        with self.__cond:
+            n = len(self.__commands)
+            self.__commands.clear()
+            return n
+
+    def close(self):
+        with self.__cond:
+            self.__closed = True
+            self.__cond.notify_all()
+
 
 class IOChannel(threading.Thread):
     eBroadcastBitHasUserInput = 1 << 0
@@ -674,8 +1440,9 @@ class IOChannel(threading.Thread):
 
     ##########################################
     # Python object functions.
-    def __init__(self, driver, pipe, out_write, err_write=None):
+    def __init__(self, driver, input_queue, out_write, err_write=None):
         super(IOChannel, self).__init__(name='sublime.lldb.io-channel')
+        self.__session = current_session()
 
         if err_write is None:
             err_write = out_write
@@ -684,7 +1451,7 @@ class IOChannel(threading.Thread):
         self.__err_write = err_write
         self.__out_write = out_write
         self.__broadcaster = lldb.SBBroadcaster('IOChannel')
-        self.__io_channel_pipe = pipe
+        self.__input_queue = input_queue
 
     ##########################################
     # IOChannel properties.
@@ -712,6 +1479,7 @@ class IOChannel(threading.Thread):
     # IOChannel run loop.
     def run(self):
         thread_created('<' + self.name + '>')
+        set_thread_session(self.__session)
 
         listener = lldb.SBListener('IOChannel.run')
         interpreter_broadcaster = self.driver.debugger.GetCommandInterpreter().GetBroadcaster()
@@ -740,15 +1508,13 @@ class IOChannel(threading.Thread):
             if event.GetBroadcaster():
                 if event.BroadcasterMatchesRef(self.driver.broadcaster):
                     if event_type & LldbDriver.eBroadcastBitReadyForInput:
-                        self.driver.maybe_get_input()
-                        line = self.__io_channel_pipe.readline()
-                        if line == '':
+                        if len(self.__input_queue) == 0:
+                            self.driver.maybe_get_input()
+                        line = self.__input_queue.get()
+                        if line is None:
                             done = True
                             continue
-                        if line[-1] == '\n':
-                            line = line[:-1]
-                        event = lldb.SBEvent(self.eBroadcastBitHasUserInput, line)
-                        self.broadcaster.BroadcastEvent(event)
+                        self.driver.handle_user_input(line)
                     if event_type & LldbDriver.eBroadcastBitThreadShouldExit:
                         done = True
                         continue
@@ -768,6 +1534,7 @@ class IOChannel(threading.Thread):
     def stop(self):
         if self.is_alive():
             self.broadcaster.BroadcastEventByType(IOChannel.eBroadcastBitThreadShouldExit)
+        self.__input_queue.close()
 
         self.join()
 
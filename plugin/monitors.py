@@ -1,162 +1,420 @@
 # -*- mode: python; coding: utf-8 -*-
 
+import io
 import os
+import errno
 import fcntl
 import Queue
+import time
 import select
+import itertools
 import threading
 
-import sublime
 import sublime_plugin
 
 from lldb_wrappers import thread_created
-from debug import debug, debugMonitors
+from debug import debug, debugMonitors, trace_stage
+from utilities import SettingsManager
+from views import LLDBCodeView
 from root_objects import lldb_views_update, del_lldb_view,              \
                          lldb_views_destroy,                            \
-                         get_lldb_view_for, maybe_get_lldb_output_view
+                         get_lldb_view_for, maybe_get_lldb_output_view, \
+                         current_session, set_thread_session, set_window_ref, \
+                         refresh_active_views, forget_active_view,      \
+                         forget_closed_windows,                         \
+                         update_stale_lldb_view,                        \
+                         run_on_ui_thread
 
 
-class LLDBUIUpdater(threading.Thread):
-    _done = False
+class UIMessage(object):
+    """Message for the LLDBUIUpdater. Messages with a lower priority value
+        are handled first. Messages with the same priority are handled in
+        the order they were sent."""
+    priority = 0
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, str(self.__dict__))
+
+
+class ProcessStoppedMessage(UIMessage):
+    priority = 0
+
+    def __init__(self, state, epilogue, stop_id=None):
+        self.state = state
+        self.epilogue = epilogue
+        self.stop_id = stop_id
+
 
-    eProcessStopped = 1 << 0
-    eBreakpointAdded = 1 << 1
-    eBreakpointChanged = 1 << 2
-    # eBreakpointEnabled = 1 << 2
-    eBreakpointRemoved = 1 << 3
-    # eBreakpointDisabled = 1 << 4
-    eUIUpdaterExit = 1 << 4
+class BreakpointMessage(UIMessage):
+    priority = 1
 
+    eAdded = LLDBCodeView.eBreakpointAdded
+    eChanged = LLDBCodeView.eBreakpointChanged
+    eRemoved = LLDBCodeView.eBreakpointRemoved
+
+    def __init__(self, kind, filename, lines):
+        self.kind = kind
+        self.filename = filename
+        # List of (line, is_enabled) tuples
+        self.lines = lines
+
+
+class ExitMessage(UIMessage):
+    # Let everything else be handled before we exit.
+    priority = 2
+
+
+class UIMessageBus(object):
+    """Thread-safe priority queue of UIMessages. Keeps track of the queue
+        depth and of how many messages of each type were handled, and how
+        long that took."""
+    def __init__(self):
+        self.__queue = Queue.PriorityQueue()
+        self.__sequence = itertools.count()
+        self.__lock = threading.Lock()
+        self.__max_depth = 0
+        # message type -> [messages, total time, max time]
+        self.__handled = {}
+
+    def put(self, msg):
+        self.__queue.put((msg.priority, self.__sequence.next(), msg))
+        depth = self.__queue.qsize()
+        with self.__lock:
+            self.__max_depth = max(self.__max_depth, depth)
+
+    def get(self, timeout=None):
+        """Returns the next message. Raises Queue.Empty if we timed out."""
+        if timeout is None:
+            item = self.__queue.get()
+        else:
+            item = self.__queue.get(True, timeout)
+        return item[2]
+
+    def get_all(self):
+        """Returns every queued message, without waiting."""
+        messages = []
+        try:
+            while True:
+                messages.append(self.__queue.get_nowait()[2])
+        except Queue.Empty:
+            pass
+        return messages
+
+    def depth(self):
+        return self.__queue.qsize()
+
+    def handled(self, type, n, duration):
+        """Records that n messages of type were handled in duration seconds."""
+        with self.__lock:
+            if type not in self.__handled:
+                self.__handled[type] = [0, 0.0, 0.0]
+            stats = self.__handled[type]
+            stats[0] += n
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    def report(self):
+        with self.__lock:
+            lines = ['UI message queue depth: %d (max: %d)' % (self.depth(), self.__max_depth)]
+            for (type, (n, total, longest)) in sorted(self.__handled.items()):
+                lines.append('%-24s %8d messages %10.2f ms total %10.2f ms max' %
+                    (type, n, total * 1000, longest * 1000))
+        return '\n'.join(lines) + '\n'
+
+
+class LLDBUIUpdater(threading.Thread):
+    """Updates the UI after process stops and breakpoint changes. Messages
+        are handled in ticks: process stops are handled first (only the
+        latest one), and then every breakpoint change queued until then,
+        with a single UI thread callback which updates each file once."""
     def __init__(self):
         super(LLDBUIUpdater, self).__init__(name='sublime.lldb.UIUpdater')
+        self.__session = current_session()
         self.daemon = True
-        self.__queue = Queue.Queue()
+        self.__bus = UIMessageBus()
+        # Latest stop ID the driver told us about. Refreshes for older stops
+        # are stale and can be dropped.
+        self.__latest_stop_id = 0
+        sm = SettingsManager.getSM()
+        self.__coalesce_window = sm.get_default('ui.coalesce_window', 50) / 1000.0
         self.start()
 
     def stop(self):
-        self.__queue.put(self.packet(self.eUIUpdaterExit))
+        self.__bus.put(ExitMessage())
 
-    def process_stopped(self, state, epilogue):
-        self.__queue.put(self.packet(self.eProcessStopped, state, epilogue))
+    def process_stopped(self, state, epilogue, stop_id=None):
+        if stop_id is not None:
+            self.__latest_stop_id = max(self.__latest_stop_id, stop_id)
+        self.__bus.put(ProcessStoppedMessage(state, epilogue, stop_id))
 
-    def breakpoint_added(self, file, line, is_enabled):
-        packet = self.packet(self.eBreakpointAdded, file, line, is_enabled)
-        self.__queue.put(packet)
+    def process_running(self, stop_id):
+        # We don't need to refresh anything while the process is running,
+        # but any refresh still queued for the previous stop is now stale.
+        self.__latest_stop_id = max(self.__latest_stop_id, stop_id)
 
-    def breakpoint_removed(self, file, line, is_enabled):
-        packet = self.packet(self.eBreakpointRemoved, file, line, is_enabled)
-        self.__queue.put(packet)
+    # Breakpoint changes are sent with every affected line of a file, as a
+    # list of (line, is_enabled) tuples.
+    def breakpoints_added(self, file, lines):
+        self.__bus.put(BreakpointMessage(BreakpointMessage.eAdded, file, lines))
 
-    def breakpoint_changed(self, file, line, is_enabled):
-        packet = self.packet(self.eBreakpointChanged, file, line, is_enabled)
-        self.__queue.put(packet)
+    def breakpoints_removed(self, file, lines):
+        self.__bus.put(BreakpointMessage(BreakpointMessage.eRemoved, file, lines))
 
-    def get_next_packet(self):
-        packet = self.__queue.get()
-        self.__queue.task_done()
-        return packet
+    def breakpoints_changed(self, file, lines):
+        self.__bus.put(BreakpointMessage(BreakpointMessage.eChanged, file, lines))
 
-    def packet(self, *args):
-        return args
+    def metrics(self):
+        """Text report of the message queue's metrics."""
+        return self.__bus.report()
 
     def maybe_get_view_for_file(self, filename):
         return maybe_get_lldb_output_view(None, filename)
 
+    def coalesce(self):
+        """Waits for the coalescing window after a process stop, returning
+            the messages that arrive in the meantime."""
+        messages = []
+        deadline = time.time() + self.__coalesce_window
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                msg = self.__bus.get(timeout)
+            except Queue.Empty:
+                break
+
+            messages.append(msg)
+            if isinstance(msg, ExitMessage):
+                break
+
+        return messages
+
+    def is_stale(self, msg):
+        return msg.stop_id is not None and msg.stop_id < self.__latest_stop_id
+
     def run(self):
         thread_created('<' + self.name + '>')
+        set_thread_session(self.__session)
+
+        msg = self.__bus.get()
+        while True:
+            messages = [msg]
+            if isinstance(msg, ProcessStoppedMessage):
+                messages += self.coalesce()
+            messages += self.__bus.get_all()
 
-        packet = self.get_next_packet()
-        while packet:
-            debug(debugMonitors, 'LLDBUIUpdater: ' + str(packet))
-            if packet[0] == self.eProcessStopped:
-                # state = packet[1]
-                epilogue = packet[2]
-                lldb_views_update(epilogue)
-                # Should we wait or signal ourselves from lldb_views_refresh?
-                # We'll have to signal ourselves if we find that the views get marked,
-                # instead of the input box
-
-                # Focus the best view
-                # Ask for input, if appropriate (epilogue)
-            elif packet[0] == self.eBreakpointAdded:
-                filename = packet[1]
-                line = packet[2]
-                is_enabled = packet[3]
-
-                v = self.maybe_get_view_for_file(filename)
-                if v is not None:
-                    sublime.set_timeout(lambda: v.mark_bp(line, is_enabled), 0)
-
-            elif packet[0] == self.eBreakpointChanged:
-                filename = packet[1]
-                line = packet[2]
-                is_enabled = packet[3]
-
-                v = self.maybe_get_view_for_file(filename)
-                if v is not None:
-                    # Create a new scope so we don't get the line changed
-                    # before change_bp is executed.
-                    def scope(view, line):
-                        sublime.set_timeout(lambda: view.change_bp(line, is_enabled), 0)
-                    scope(v, line)
-
-            elif packet[0] == self.eBreakpointRemoved:
-                filename = packet[1]
-                line = packet[2]
-                is_enabled = packet[3]
-
-                v = self.maybe_get_view_for_file(filename)
-                if v is not None:
-                    sublime.set_timeout(lambda: v.unmark_bp(line, is_enabled), 0)
-
-            elif packet[0] == self.eUIUpdaterExit:
-                lldb_views_destroy()
+            if not self.handle_messages(messages):
                 return
 
-            packet = self.get_next_packet()
+            msg = self.__bus.get()
+
+    def handle_messages(self, messages):
+        """Handles a tick's worth of messages. Returns False if we should
+            stop running."""
+        debug(debugMonitors, 'LLDBUIUpdater: handling %d messages' % len(messages))
+        stops = [m for m in messages if isinstance(m, ProcessStoppedMessage)]
+        bps = [m for m in messages if isinstance(m, BreakpointMessage)]
+        should_exit = any(isinstance(m, ExitMessage) for m in messages)
+
+        if stops:
+            start = time.time()
+            for m in stops[:-1]:
+                debug(debugMonitors, 'LLDBUIUpdater: coalescing ' + repr(m))
+            self.handle_process_stopped(stops[-1])
+            self.__bus.handled(ProcessStoppedMessage.__name__, len(stops), time.time() - start)
+
+        if bps:
+            start = time.time()
+            self.handle_breakpoints(bps)
+            self.__bus.handled(BreakpointMessage.__name__, len(bps), time.time() - start)
+
+        if should_exit:
+            lldb_views_destroy()
+            return False
+
+        return True
+
+    def handle_process_stopped(self, msg):
+        if self.is_stale(msg):
+            debug(debugMonitors, 'LLDBUIUpdater: dropping stale refresh ' + repr(msg))
+            return
+
+        trace_stage(msg.stop_id, 'ui queue')
+        lldb_views_update(msg.epilogue, msg.stop_id, lambda: self.is_stale(msg))
+        # Should we wait or signal ourselves from lldb_views_refresh?
+        # We'll have to signal ourselves if we find that the views get marked,
+        # instead of the input box
+
+        # Focus the best view
+        # Ask for input, if appropriate (epilogue)
+
+    def handle_breakpoints(self, msgs):
+        # Merge the changes for each file, so each view's markers are only
+        # updated once, in a single trip to the UI thread.
+        files = []
+        changes = {}
+        for m in msgs:
+            if m.filename not in changes:
+                files.append(m.filename)
+                changes[m.filename] = []
+            changes[m.filename].extend([(m.kind, line, is_enabled) for (line, is_enabled) in m.lines])
+
+        updates = []
+        for filename in files:
+            v = self.maybe_get_view_for_file(filename)
+            if v is not None:
+                updates.append((v, changes[filename]))
+
+        if updates:
+            def to_ui_thread():
+                for (v, view_changes) in updates:
+                    # Don't let one view keep the others from updating.
+                    try:
+                        v.update_bps(view_changes)
+                    except Exception, e:
+                        debug(debugMonitors, 'exception updating the breakpoints of %s: %s' %
+                                             (v.file_name(), repr(e)))
+            run_on_ui_thread(to_ui_thread)
+
+
+class Poller(object):
+    """Minimal wrapper around the best polling mechanism we have (epoll,
+        poll or select), waiting for input on file descriptors without any
+        timeout."""
+    def __init__(self):
+        self.__fds = set()
+        if hasattr(select, 'epoll'):
+            self.__poller = select.epoll()
+            self.__mask = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self.__no_timeout = -1
+        elif hasattr(select, 'poll'):
+            self.__poller = select.poll()
+            self.__mask = select.POLLIN | select.POLLHUP | select.POLLERR
+            self.__no_timeout = None
+        else:
+            self.__poller = None
+
+    def register(self, fd):
+        self.__fds.add(fd)
+        if self.__poller is not None:
+            self.__poller.register(fd, self.__mask)
+
+    def unregister(self, fd):
+        self.__fds.discard(fd)
+        if self.__poller is not None:
+            self.__poller.unregister(fd)
+
+    def poll(self):
+        """Blocks until at least one of the file descriptors is ready.
+            Returns the list of ready file descriptors."""
+        while True:
+            try:
+                if self.__poller is None:
+                    r, w, x = select.select(list(self.__fds), [], [])
+                    return r
+                return [fd for (fd, ev) in self.__poller.poll(self.__no_timeout)]
+            except (select.error, IOError, OSError), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        if hasattr(self.__poller, 'close'):
+            self.__poller.close()
 
 
 class FileMonitor(threading.Thread):
-    TIMEOUT = 10  # Our default select timeout is 10 secs
+    """Monitors files for input, calling callback with everything that was
+        read from them. The thread sleeps until there's input (or until we're
+        asked to stop, using a self-pipe), reads it into a reusable buffer
+        and delivers everything that was read on a wakeup in a single
+        callback."""
+    BUFFER_SIZE = 65536
 
     def __init__(self, callback, *files):
         super(FileMonitor, self).__init__(name='sublime.lldb.debugger.out.monitor')
+        self.__session = current_session()
         self._callback = callback
         self._files = list(files)
         self._done = False
+        self._buffer = bytearray(FileMonitor.BUFFER_SIZE)
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
         self.start()
 
     def isDone(self):
         return self._done
 
     def setDone(self, done=True):
-        self._done = done
+        with self._lock:
+            self._done = done
+            if done and self._wakeup_w is not None:
+                # Wake up the monitor thread, if it's waiting for input.
+                os.write(self._wakeup_w, 'x')
+
+    def __read_all(self, reader):
+        """Reads everything available from reader. Returns the list of strings
+            that were read, and False if we got to EOF."""
+        pieces = []
+        while True:
+            try:
+                n = reader.readinto(self._buffer)
+            except (IOError, OSError), e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    n = None
+                else:
+                    raise
+
+            if n is None:
+                # Nothing more to read, for now.
+                return (pieces, True)
+            if n == 0:
+                return (pieces, False)
+
+            pieces.append(str(self._buffer[:n]))
+            if n < len(self._buffer):
+                return (pieces, True)
 
     def run(self):
         thread_created('<' + self.name + '>')
+        set_thread_session(self.__session)
 
-        def fun(file):
-            # make stdin a non-blocking file
-            fd = file.fileno()
+        poller = Poller()
+        readers = {}
+        for f in self._files:
+            # make the file non-blocking
+            fd = f.fileno()
             fl = fcntl.fcntl(fd, fcntl.F_GETFL)
             fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-
-        rlist = self._files
-        map(fun, rlist)
-
-        while not self.isDone() and rlist is not []:
-            r, w, x = select.select(rlist, [], [], FileMonitor.TIMEOUT)
-            if len(r) == 0:
-                # Timeout occurred: check for self.isDone()
-                continue
-            for f in r:
-                data = f.read()
-                if data == '':
+            readers[fd] = (f, io.FileIO(fd, 'r', closefd=False))
+            poller.register(fd)
+        poller.register(self._wakeup_r)
+
+        while not self.isDone() and len(readers) > 0:
+            ready = poller.poll()
+            pieces = []
+            for fd in ready:
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, FileMonitor.BUFFER_SIZE)
+                    continue
+
+                (f, reader) = readers[fd]
+                (data, is_open) = self.__read_all(reader)
+                pieces.extend(data)
+                if not is_open:
                     debug(debugMonitors, 'removing ' + str(f) + ' from FileMonitor')
-                    rlist.remove(f)
-                self._callback(data)
+                    poller.unregister(fd)
+                    del readers[fd]
+
+            if len(pieces) > 0:
+                self._callback(''.join(pieces))
 
-        self.setDone(True)
+        poller.close()
+        with self._lock:
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+            self._wakeup_w = None
+            self._done = True
 
 
 class LLDBUIListener(sublime_plugin.EventListener):
@@ -164,13 +422,39 @@ class LLDBUIListener(sublime_plugin.EventListener):
         super(LLDBUIListener, self).__init__()
         debug(debugMonitors, 'Started UIListener')
 
+    def on_activated(self, v):
+        # Whatever isn't bound to a debugging session acts on the active
+        # window's session. We also keep track of the visible views, so we
+        # know which lldb views need to be updated right away on a stop.
+        w = v.window()
+        visible = [v]
+        if w is not None:
+            set_window_ref(w)
+            # Activating a view may have moved it from another group, and
+            # shown whatever was behind it there.
+            visible = refresh_active_views(w) or visible
+
+        for visible_view in visible:
+            lldb_view = get_lldb_view_for(visible_view)
+            if lldb_view:
+                update_stale_lldb_view(lldb_view)
+
     def on_close(self, v):
+        forget_active_view(v.id())
+        # Closing a window closes its views. Once it's gone, so is its
+        # session.
+        run_on_ui_thread(forget_closed_windows)
         lldb_view = get_lldb_view_for(v)
         # TODO: Check if there are other views for the same buffer
         # I blame Sublime Text for mixing both concepts into “something”.
         if lldb_view:
             del_lldb_view(lldb_view)
 
+    def on_post_save(self, v):
+        lldb_view = get_lldb_view_for(v)
+        if isinstance(lldb_view, LLDBCodeView):
+            lldb_view.reconcile_bps()
+
     def on_load(self, v):
         lldb_view = get_lldb_view_for(v)
         if lldb_view:
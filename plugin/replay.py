@@ -0,0 +1,725 @@
+#!/usr/bin/env python
+# -*- mode: python; coding: utf-8 -*-
+"""Replays a journal recorded by LldbDriver (see journal.py) through the
+driver's event handlers and the UI update machinery, using fake lldb and
+sublime modules. This lets us benchmark (and regression-test) the cost of
+handling a real debugging session without a live debuggee, OS X or Sublime
+Text.
+
+Usage: python replay.py [--realtime] journal-file
+
+With --realtime, events are replayed with the same timing they were
+recorded with. Otherwise they're replayed as fast as possible.
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import Queue
+import threading
+
+# Make sure we import the plugin's modules, and not anything else that may
+# be on the path.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+##########################################
+# Fake lldb module.
+# Enumeration values match the ones in the bundled LLDB.framework headers,
+# since the journal records them as plain integers.
+def make_fake_lldb():
+    lldb = types.ModuleType('lldb')
+
+    for (i, name) in enumerate(['eStateInvalid', 'eStateUnloaded', 'eStateConnected',
+                                'eStateAttaching', 'eStateLaunching', 'eStateStopped',
+                                'eStateRunning', 'eStateStepping', 'eStateCrashed',
+                                'eStateDetached', 'eStateExited', 'eStateSuspended']):
+        setattr(lldb, name, i)
+
+    for (i, name) in enumerate(['eStopReasonInvalid', 'eStopReasonNone', 'eStopReasonTrace',
+                                'eStopReasonBreakpoint', 'eStopReasonWatchpoint',
+                                'eStopReasonSignal', 'eStopReasonException',
+                                'eStopReasonPlanComplete']):
+        setattr(lldb, name, i)
+
+    for (i, name) in enumerate(['eBreakpointEventTypeInvalidType', 'eBreakpointEventTypeAdded',
+                                'eBreakpointEventTypeRemoved', 'eBreakpointEventTypeLocationsAdded',
+                                'eBreakpointEventTypeLocationsRemoved',
+                                'eBreakpointEventTypeLocationsResolved',
+                                'eBreakpointEventTypeEnabled', 'eBreakpointEventTypeDisabled',
+                                'eBreakpointEventTypeCommandChanged',
+                                'eBreakpointEventTypeConditionChanged',
+                                'eBreakpointEventTypeIgnoreChanged',
+                                'eBreakpointEventTypeThreadChanged']):
+        setattr(lldb, name, 1 << i)
+
+    for (i, name) in enumerate(['eInputReaderActivate', 'eInputReaderAsynchronousOutputWritten',
+                                'eInputReaderReactivate', 'eInputReaderDeactivate',
+                                'eInputReaderGotToken', 'eInputReaderInterrupt',
+                                'eInputReaderEndOfFile', 'eInputReaderDone']):
+        setattr(lldb, name, i)
+
+    lldb.eInputReaderGranularityLine = 3
+    lldb.eDescriptionLevelBrief = 0
+    lldb.eOnlyThisThread = 1
+    lldb.LLDB_ARCH_DEFAULT = 'systemArch'
+
+    # The process the debugger will report as the selected target's. It's
+    # updated with every process event we replay.
+    state = {'process': None, 'target': None}
+
+    class Dummy(object):
+        def __init__(self, *args):
+            pass
+
+        def __getattr__(self, name):
+            return lambda *args: True
+
+    class SBFileSpec(object):
+        def __init__(self, path):
+            self.__path = path
+
+        def __nonzero__(self):
+            return self.__path is not None
+
+        def GetDirectory(self):
+            return os.path.dirname(self.__path)
+
+        def GetFilename(self):
+            return os.path.basename(self.__path)
+
+    class SBLineEntry(object):
+        def __init__(self, path, line):
+            self.__path = path
+            self.__line = line
+
+        def __nonzero__(self):
+            return self.__path is not None
+
+        def GetFileSpec(self):
+            return SBFileSpec(self.__path)
+
+        def GetLine(self):
+            return self.__line
+
+    class SBAddress(object):
+        def __init__(self, path=None, line=0):
+            self.__line_entry = SBLineEntry(path, line)
+
+        def __nonzero__(self):
+            return True
+
+        def GetLineEntry(self):
+            return self.__line_entry
+
+    class SBFrame(object):
+        def __init__(self, thread, path, line):
+            self.__thread = thread
+            self.__line_entry = SBLineEntry(path, line)
+
+        def __nonzero__(self):
+            return True
+
+        def IsValid(self):
+            return True
+
+        def GetThread(self):
+            return self.__thread
+
+        def GetLineEntry(self):
+            return self.__line_entry
+
+    class SBThread(object):
+        def __init__(self, process=None, desc=None):
+            self.__process = process
+            self.__desc = desc
+            frames = desc.get('frames', []) if desc else []
+            self.__frames = [SBFrame(self, path, line) for (path, line) in frames]
+
+        def __nonzero__(self):
+            return self.__desc is not None
+
+        def __iter__(self):
+            return iter(self.__frames)
+
+        def IsValid(self):
+            return self.__desc is not None
+
+        def GetThreadID(self):
+            return self.__desc['tid'] if self.__desc else 0
+
+        def GetStopReason(self):
+            return self.__desc['stop_reason'] if self.__desc else lldb.eStopReasonInvalid
+
+        def GetProcess(self):
+            return self.__process
+
+        def GetNumFrames(self):
+            return len(self.__frames)
+
+        def GetFrameAtIndex(self, i):
+            return self.__frames[i]
+
+        def GetSelectedFrame(self):
+            if self.__frames:
+                return self.__frames[0]
+            return SBFrame(self, None, 0)
+
+    class SBProcess(object):
+        eBroadcastBitStateChanged = 1 << 0
+        eBroadcastBitInterrupt = 1 << 1
+        eBroadcastBitSTDOUT = 1 << 2
+        eBroadcastBitSTDERR = 1 << 3
+
+        def __init__(self, desc=None):
+            self.__desc = desc or {}
+            self.__threads = [SBThread(self, t) for t in self.__desc.get('threads', [])]
+            self.__selected = None
+            for t in self.__threads:
+                if t.GetThreadID() == self.__desc.get('selected_thread'):
+                    self.__selected = t
+
+        def __nonzero__(self):
+            return 'pid' in self.__desc
+
+        def __iter__(self):
+            return iter(self.__threads)
+
+        @staticmethod
+        def GetBroadcasterClassName():
+            return 'lldb.process'
+
+        @staticmethod
+        def EventIsProcessEvent(ev):
+            return ev.kind == 'process'
+
+        @staticmethod
+        def GetStateFromEvent(ev):
+            return ev.description.get('state', lldb.eStateInvalid)
+
+        @staticmethod
+        def GetRestartedFromEvent(ev):
+            return ev.description.get('restarted', False)
+
+        @staticmethod
+        def GetProcessFromEvent(ev):
+            process = SBProcess(ev.description)
+            state['process'] = process
+            return process
+
+        def IsValid(self):
+            return bool(self)
+
+        def GetProcessID(self):
+            return self.__desc.get('pid', 0)
+
+        def GetState(self):
+            return self.__desc.get('state', lldb.eStateInvalid)
+
+        def GetTarget(self):
+            return SBTarget()
+
+        def GetNumThreads(self):
+            return len(self.__threads)
+
+        def GetThreadAtIndex(self, i):
+            return self.__threads[i]
+
+        def GetThreadByID(self, tid):
+            for t in self.__threads:
+                if t.GetThreadID() == tid:
+                    return t
+            return SBThread(self)
+
+        def GetSelectedThread(self):
+            return self.__selected or SBThread(self)
+
+        def SetSelectedThread(self, thread):
+            self.__selected = thread
+            return True
+
+        def GetSTDOUT(self, size):
+            return ''
+
+        def GetSTDERR(self, size):
+            return ''
+
+    class SBBreakpointLocation(object):
+        def __init__(self, path, line, is_enabled):
+            self.__address = SBAddress(path, line)
+            self.__is_enabled = is_enabled
+
+        def __nonzero__(self):
+            return True
+
+        def GetAddress(self):
+            return self.__address
+
+        def IsEnabled(self):
+            return self.__is_enabled
+
+    class SBBreakpoint(object):
+        def __init__(self, desc=None):
+            self.__desc = desc or {}
+            self.__locations = [SBBreakpointLocation(*l) for l in self.__desc.get('locations', [])]
+
+        def __nonzero__(self):
+            return 'id' in self.__desc
+
+        def __iter__(self):
+            return iter(self.__locations)
+
+        @staticmethod
+        def EventIsBreakpointEvent(ev):
+            return ev.kind == 'breakpoint'
+
+        @staticmethod
+        def GetBreakpointEventTypeFromEvent(ev):
+            return ev.description['type']
+
+        @staticmethod
+        def GetBreakpointFromEvent(ev):
+            return SBBreakpoint(ev.description)
+
+        @staticmethod
+        def GetNumBreakpointLocationsFromEvent(ev):
+            return ev.description.get('new_locations', 0)
+
+        def IsValid(self):
+            return bool(self)
+
+        def GetID(self):
+            return self.__desc.get('id', 0)
+
+        def IsEnabled(self):
+            return self.__desc.get('enabled', True)
+
+        def GetNumLocations(self):
+            return len(self.__locations)
+
+        def GetLocationAtIndex(self, i):
+            return self.__locations[i]
+
+    class SBTarget(object):
+        eBroadcastBitBreakpointChanged = 1 << 0
+        eBroadcastBitModulesLoaded = 1 << 1
+        eBroadcastBitModulesUnloaded = 1 << 2
+
+        def __nonzero__(self):
+            return True
+
+        @staticmethod
+        def GetBroadcasterClassName():
+            return 'lldb.target'
+
+        def GetProcess(self):
+            return state['process'] or SBProcess()
+
+        def GetBroadcaster(self):
+            return self
+
+        def breakpoint_iter(self):
+            return iter([])
+
+    class SBEvent(object):
+        def __init__(self, kind=None, description=None):
+            self.kind = kind
+            self.description = description or {}
+
+        def __nonzero__(self):
+            return self.kind is not None
+
+        @staticmethod
+        def GetCStringFromEvent(ev):
+            return ev.description.get('data')
+
+        def GetType(self):
+            return self.description.get('type', 0)
+
+        def GetBroadcaster(self):
+            return True
+
+        def BroadcasterMatchesRef(self, broadcaster):
+            # Breakpoint events come from the (only) target.
+            return self.kind == 'breakpoint' and broadcaster is state['target']
+
+        def GetDescription(self, stream):
+            return False
+
+    class SBCommandReturnObject(object):
+        def GetOutput(self):
+            return ''
+
+        def GetError(self):
+            return ''
+
+        def GetOutputSize(self):
+            return 0
+
+        def GetErrorSize(self):
+            return 0
+
+        def GetStatus(self):
+            return 0
+
+    class SBCommandInterpreter(Dummy):
+        eBroadcastBitThreadShouldExit = 1 << 0
+        eBroadcastBitResetPrompt = 1 << 1
+        eBroadcastBitQuitCommandReceived = 1 << 2
+        eBroadcastBitAsynchronousOutputData = 1 << 3
+        eBroadcastBitAsynchronousErrorData = 1 << 4
+
+        def HandleCommand(self, cmd, result, add_to_history):
+            return 0
+
+    class SBDebugger(Dummy):
+        @staticmethod
+        def Initialize():
+            pass
+
+        @staticmethod
+        def Terminate():
+            pass
+
+        @staticmethod
+        def Destroy(debugger):
+            pass
+
+        @staticmethod
+        def Create(source_init_files=False):
+            return SBDebugger()
+
+        @staticmethod
+        def GetVersionString():
+            return 'replay'
+
+        def GetSelectedTarget(self):
+            if state['target'] is None:
+                state['target'] = SBTarget()
+            return state['target']
+
+        def GetIndexOfTarget(self, target):
+            return 0 if target is state['target'] else 0xffffffff
+
+        def GetCommandInterpreter(self):
+            return SBCommandInterpreter()
+
+        def StateAsCString(self, state):
+            return str(state)
+
+    class SBHostOS(object):
+        @staticmethod
+        def ThreadCreated(name):
+            pass
+
+    for cls in [SBFileSpec, SBLineEntry, SBAddress, SBFrame, SBThread, SBProcess,
+                SBBreakpointLocation, SBBreakpoint, SBTarget, SBEvent,
+                SBCommandReturnObject, SBCommandInterpreter, SBDebugger, SBHostOS]:
+        setattr(lldb, cls.__name__, cls)
+    for name in ['SBBroadcaster', 'SBListener', 'SBInputReader', 'SBError', 'SBStream',
+                 'SBWatchpoint']:
+        setattr(lldb, name, type(name, (Dummy,), {}))
+
+    return lldb
+
+
+##########################################
+# Fake sublime and sublime_plugin modules.
+# set_timeout() callbacks run on a fake main thread, which measures how
+# long the UI thread is kept busy.
+class MainLoop(threading.Thread):
+    def __init__(self):
+        super(MainLoop, self).__init__(name='replay.main')
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.callbacks = 0
+        self.busy = 0.0
+        self.start()
+
+    def run(self):
+        fn = self.queue.get()
+        while fn is not None:
+            start = time.time()
+            try:
+                fn()
+            except Exception, e:
+                print >> sys.stderr, 'exception on the main loop: %s' % e
+            self.busy += time.time() - start
+            self.callbacks += 1
+            self.queue.task_done()
+            fn = self.queue.get()
+
+
+def make_fake_sublime(main_loop):
+    sublime = types.ModuleType('sublime')
+    sublime_plugin = types.ModuleType('sublime_plugin')
+
+    sublime.HIDDEN = 1
+    sublime.DRAW_OUTLINED = 2
+
+    class Region(object):
+        def __init__(self, a, b=None):
+            self.a = a
+            self.b = a if b is None else b
+
+        def begin(self):
+            return min(self.a, self.b)
+
+        def end(self):
+            return max(self.a, self.b)
+
+    class Settings(object):
+        def __init__(self):
+            self.__values = {}
+            self.__callbacks = {}
+
+        def get(self, key, default=None):
+            return self.__values.get(key, default)
+
+        def set(self, key, value):
+            self.__values[key] = value
+
+        def add_on_change(self, key, fn):
+            self.__callbacks.setdefault(key, []).append(fn)
+
+        def clear_on_change(self, key):
+            pass
+
+    # Every line in a fake view has the same length.
+    line_length = 80
+
+    class View(object):
+        __next_id = [1]
+
+        def __init__(self, window, file_name=None):
+            self.__id = View.__next_id[0]
+            View.__next_id[0] += 1
+            self.__window = window
+            self.__file_name = file_name
+            self.__name = ''
+            self.__size = 0
+            self.__regions = {}
+            self.__settings = Settings()
+
+        def id(self):
+            return self.__id
+
+        def window(self):
+            return self.__window
+
+        def name(self):
+            return self.__name
+
+        def set_name(self, name):
+            self.__name = name
+
+        def file_name(self):
+            return self.__file_name
+
+        def is_loading(self):
+            return False
+
+        def settings(self):
+            return self.__settings
+
+        def size(self):
+            return self.__size
+
+        def begin_edit(self, *args):
+            return None
+
+        def end_edit(self, edit):
+            pass
+
+        def insert(self, edit, point, string):
+            self.__size += len(string)
+
+        def erase(self, edit, region):
+            self.__size -= region.end() - region.begin()
+
+        def replace(self, edit, region, string):
+            self.erase(edit, region)
+            self.insert(edit, region.begin(), string)
+
+        def text_point(self, row, col):
+            return row * line_length + col
+
+        def line(self, point):
+            start = point - point % line_length
+            return Region(start, start + line_length - 1)
+
+        def add_regions(self, key, regions, *args):
+            self.__regions[key] = list(regions)
+
+        def get_regions(self, key):
+            return self.__regions.get(key, [])
+
+        def erase_regions(self, key):
+            self.__regions.pop(key, None)
+
+        def __getattr__(self, name):
+            # set_read_only, set_scratch, show, show_at_center, ...
+            return lambda *args: None
+
+    class Window(object):
+        def __init__(self):
+            self.__views = []
+
+        def id(self):
+            return 1
+
+        def views(self):
+            return list(self.__views)
+
+        def new_file(self):
+            v = View(self)
+            self.__views.append(v)
+            return v
+
+        def open_file(self, file_name):
+            for v in self.__views:
+                if v.file_name() == file_name:
+                    return v
+            v = View(self, file_name)
+            self.__views.append(v)
+            return v
+
+        def active_view(self):
+            return self.__views[-1] if self.__views else None
+
+        def active_view_in_group(self, group):
+            return self.active_view()
+
+        def get_view_index(self, view):
+            return (0, self.__views.index(view))
+
+        def num_groups(self):
+            return 2
+
+        def __getattr__(self, name):
+            # focus_group, focus_view, run_command, set_view_index, ...
+            return lambda *args: None
+
+    window = Window()
+    settings = Settings()
+
+    sublime.Region = Region
+    # Delays are ignored, so nothing is left to run after the replay.
+    sublime.set_timeout = lambda fn, delay: main_loop.queue.put(fn)
+    sublime.load_settings = lambda name: settings
+    sublime.active_window = lambda: window
+    sublime.windows = lambda: [window]
+    sublime.status_message = lambda string: None
+    sublime.error_message = lambda string: sys.stderr.write('error: %s\n' % string)
+    sublime.packages_path = lambda: os.path.expanduser('~/.replay')
+
+    class EventListener(object):
+        pass
+
+    class WindowCommand(object):
+        def __init__(self, window):
+            self.window = window
+
+    sublime_plugin.EventListener = EventListener
+    sublime_plugin.WindowCommand = WindowCommand
+    sublime_plugin.TextCommand = WindowCommand
+    sublime_plugin.ApplicationCommand = object
+
+    return (sublime, sublime_plugin)
+
+
+##########################################
+# Replay.
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def load_journal(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def replay(path, realtime=False):
+    main_loop = MainLoop()
+    sys.modules['lldb'] = make_fake_lldb()
+    (sys.modules['sublime'], sys.modules['sublime_plugin']) = make_fake_sublime(main_loop)
+
+    import lldb
+    import sublime
+    import lldb_wrappers
+    import sublime_lldb
+    from monitors import LLDBUIUpdater
+    from root_objects import set_window_ref, set_ui_updater, ui_updater, set_driver_instance, \
+                             ui_scheduler
+
+    set_window_ref(sublime.active_window())
+    driver = lldb_wrappers.LldbDriver(sublime.active_window(), None, sublime_lldb.process_stopped)
+    # Don't run the driver's event loop, but do everything it does before
+    # it: create the debugger and run the start-up commands.
+    driver._LldbDriver__create_debugger()
+    driver.command_worker.start()
+    set_ui_updater(LLDBUIUpdater())
+
+    handlers = {'process': driver._LldbDriver__handle_process_event,
+                'breakpoint': driver._LldbDriver__handle_breakpoint_event}
+
+    records = [r for r in load_journal(path) if r['kind'] in handlers]
+    recorded = {}
+    replayed = {}
+    replay_start = time.time()
+    first = records[0]['t'] if records else 0
+    for r in records:
+        if realtime:
+            delay = (r['t'] - first) - (time.time() - replay_start)
+            if delay > 0:
+                time.sleep(delay)
+
+        ev = lldb.SBEvent(r['kind'], r['event'])
+        start = time.time()
+        handlers[r['kind']](ev)
+        replayed.setdefault(r['kind'], []).append(time.time() - start)
+        recorded.setdefault(r['kind'], []).append(r['dur'])
+
+    # Let the UI updater and the main loop finish their work.
+    ui_updater().stop()
+    ui_updater().join()
+    driver.command_worker.stop()
+    driver.command_worker.join()
+    while len(ui_scheduler()) > 0:
+        time.sleep(0.01)
+    main_loop.queue.join()
+    main_loop.queue.put(None)
+    main_loop.join()
+    total = time.time() - replay_start
+    set_driver_instance(None)
+
+    print 'Replayed %d events from %s in %.3fs' % (len(records), path, total)
+    print '%-12s %8s %12s %12s %12s %12s' % ('kind', 'count', 'rec. p50', 'rec. p95',
+                                             'replay p50', 'replay p95')
+    for kind in sorted(replayed.keys()):
+        print '%-12s %8d %11.3fms %11.3fms %11.3fms %11.3fms' % \
+            (kind, len(replayed[kind]),
+             percentile(recorded[kind], 50) * 1000, percentile(recorded[kind], 95) * 1000,
+             percentile(replayed[kind], 50) * 1000, percentile(replayed[kind], 95) * 1000)
+    print 'UI thread: %d callbacks, busy for %.3fs' % (main_loop.callbacks, main_loop.busy)
+    sys.stdout.write(ui_scheduler().report())
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    realtime = '--realtime' in args
+    args = [a for a in args if a != '--realtime']
+    if len(args) != 1:
+        print >> sys.stderr, __doc__
+        sys.exit(1)
+    replay(args[0], realtime)
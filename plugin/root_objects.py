@@ -1,9 +1,13 @@
 # -*- mode: python; coding: utf-8 -*-
 
+import Queue
+import threading
+
 import sublime
 
-from debug import debug, debugRoot
-from utilities import SettingsManager
+from debug import debug, debugRoot, trace_stage
+from utilities import SettingsManager, OutputRingBuffer, WorkerPool, UIScheduler, monotonic, \
+                      canonical_path
 
 default_lldb_view_name = 'lldb i/o'
 __lldb_prompt = '(lldb) '
@@ -13,27 +17,237 @@ __lldb_disassembly_view__unkown_addr_fmt = 'disassembly at 0x%x'
 __lldb_disassembly_view_fmt = 'disassembly at %s@0x%x'
 __lldb_thread_disassembly_view_fmt = 'disassembly of TID 0x%x'
 
-__driver = None
-__ui_updater = None
-__out_view = None
 __got_input_function = None
-__window_ref = None
 __breakpoint_dict = {}
-_disabled_bps = []
-__lldb_views = []
 
 __input_fh = None
 __output_fh = None
 __error_fh = None
 
+# Runs the views' pre_update() methods. Shared by every session.
+__pre_update_pool = None
+# Runs everything we send to the UI thread. Shared by every session.
+__ui_scheduler = None
+
+
+class LldbViewRegistry(object):
+    """The lldb views of a session, indexed by view ID, name and canonical
+        file name. Can be used from any thread.
+
+        Several views (e.g: clones of the same buffer) may share a name or a
+        file name, so those indexes hold sets of views."""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__views = {}
+        # What each view is indexed under: view ID -> (name, file name)
+        self.__keys = {}
+        self.__by_name = {}
+        self.__by_file = {}
+
+    def __len__(self):
+        return len(self.__views)
+
+    def __iter__(self):
+        # Iterate over a copy, so the registry can be changed meanwhile.
+        return iter(self.views())
+
+    def __contains__(self, v):
+        return self.__views.get(v.view_id()) is v
+
+    def __repr__(self):
+        return '<LldbViewRegistry: %s>' % repr(self.views())
+
+    def views(self):
+        with self.__lock:
+            return self.__views.values()
+
+    def add(self, v):
+        with self.__lock:
+            old = self.__views.get(v.view_id())
+            if old is not None:
+                self.__unindex(old)
+            self.__views[v.view_id()] = v
+            self.__index(v)
+
+    def reindex(self, v):
+        """Updates the name and file name indexes after v was renamed."""
+        with self.__lock:
+            if self.__views.get(v.view_id()) is v:
+                self.__unindex(v)
+                self.__index(v)
+
+    def remove(self, v):
+        """Removes v from the registry. Returns False if it wasn't there."""
+        with self.__lock:
+            if self.__views.get(v.view_id()) is not v:
+                return False
+            self.__unindex(v)
+            del self.__views[v.view_id()]
+            return True
+
+    def clear(self):
+        """Empties the registry, returning the views it had."""
+        with self.__lock:
+            views = self.__views.values()
+            self.__views = {}
+            self.__keys = {}
+            self.__by_name = {}
+            self.__by_file = {}
+            return views
+
+    def get(self, view_id):
+        return self.__views.get(view_id)
+
+    def find(self, name=None, file_name=None):
+        """Returns a view with that name or, failing that, that file name.
+            When several views share it, any of them is returned."""
+        if file_name:
+            file_name = canonical_path(file_name)
+        with self.__lock:
+            views = None
+            if name:
+                views = self.__by_name.get(name)
+            if not views and file_name:
+                views = self.__by_file.get(file_name)
+            if views:
+                return iter(views).next()
+            return None
+
+    def __index(self, v):
+        # Must be called with self.__lock held.
+        keys = (v.name(), canonical_path(v.file_name()))
+        self.__keys[v.view_id()] = keys
+        (name, file_name) = keys
+        if name:
+            self.__by_name.setdefault(name, set()).add(v)
+        if file_name:
+            self.__by_file.setdefault(file_name, set()).add(v)
+
+    def __unindex(self, v):
+        # Must be called with self.__lock held.
+        (name, file_name) = self.__keys.pop(v.view_id(), (None, None))
+        for (index, key) in ((self.__by_name, name), (self.__by_file, file_name)):
+            views = index.get(key)
+            if views is not None:
+                views.discard(v)
+                if not views:
+                    del index[key]
+
+
+class LldbSession(object):
+    """A debugging session. There's (at most) one session per window, with
+        its own driver, UI updater, lldb i/o view and lldb views.
+
+        Threads working for a session (the driver's, the UI updater, etc)
+        are bound to it with set_thread_session(). On any other thread
+        (e.g: the UI thread), the session for window_ref() is used."""
+    def __init__(self, window):
+        self.window = window
+        self.driver = None
+        self.ui_updater = None
+        self.out_view = None
+        self.lldb_views = LldbViewRegistry()
+        self.process_output = None
+        self.disabled_bps = []
+        self.is_debugging = False
+        # ID of the active view in each group of the window. Only those
+        # views are visible.
+        self.active_views = {}
+        # Set when its window was closed. Nothing is shown for it anymore.
+        self.is_closed = False
+
+    def __repr__(self):
+        return '<LldbSession for window %s, driver: %s>' % (repr(self.window), repr(self.driver))
+
+# Sessions, keyed by window ID. Only changed on the UI thread.
+__sessions = {}
+__current_session = LldbSession(None)
+__thread_session = threading.local()
+
+
+def session_for_window(window, create=True):
+    """Returns the session for a window, creating it if needed. Must be
+        called on the UI thread."""
+    if window is None:
+        return None
+
+    session = __sessions.get(window.id())
+    if session is None and create:
+        session = LldbSession(window)
+        __sessions[window.id()] = session
+    return session
+
+
+def lldb_sessions():
+    return list(__sessions.values())
+
+
+def forget_closed_windows():
+    """Drops the sessions of windows which were closed, stopping their
+        drivers. Must be called on the UI thread."""
+    open_windows = set([w.id() for w in sublime.windows()])
+    for (window_id, session) in __sessions.items():
+        if window_id in open_windows:
+            continue
+        debug(debugRoot, 'window %d was closed, ending its session' % window_id)
+        del __sessions[window_id]
+        session.is_closed = True
+        session.is_debugging = False
+        if session.ui_updater:
+            session.ui_updater.stop()
+        if session.driver:
+            session.driver.stop()
+        session.lldb_views.clear()
+
+
+def current_session():
+    return getattr(__thread_session, 'session', None) or __current_session
+
+
+def set_thread_session(session):
+    """Binds the current thread to a session. Every function in this
+        module will act on that session."""
+    __thread_session.session = session
+
+
+def session_callback(fn, session=None):
+    """Wraps fn, so it acts on session (by default, the current session)
+        even if called on another thread (e.g: with run_on_ui_thread)."""
+    if session is None:
+        session = current_session()
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(__thread_session, 'session', None)
+        __thread_session.session = session
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            __thread_session.session = previous
+    return wrapper
+
+
+def ui_scheduler():
+    global __ui_scheduler
+    if __ui_scheduler is None:
+        sm = SettingsManager.getSM()
+        rate = sm.get_default('ui.scheduler.rate', 60)
+        budget = sm.get_default('ui.scheduler.budget', 10) / 1000.0
+        __ui_scheduler = UIScheduler(rate, budget)
+    return __ui_scheduler
+
+
+def run_on_ui_thread(fn, delay=0):
+    """Runs fn on the UI thread (after, at least, delay milliseconds).
+        Use this instead of sublime.set_timeout()."""
+    ui_scheduler().schedule(fn, delay)
+
 
 def ui_updater():
-    return __ui_updater
+    return current_session().ui_updater
 
 
 def set_ui_updater(ui_updater):
-    global __ui_updater
-    __ui_updater = ui_updater
+    current_session().ui_updater = ui_updater
 
 
 def lldb_prompt():
@@ -126,12 +340,15 @@ def bps_for_file(filename):
 
 
 def window_ref():
-    return __window_ref
+    return current_session().window
 
 
 def set_window_ref(w):
-    global __window_ref
-    __window_ref = w
+    """Makes w's session the current one (for threads which aren't bound
+        to a session)."""
+    global __current_session
+    if w is not None:
+        __current_session = session_for_window(w)
 
 
 def set_got_input_function(f):
@@ -171,54 +388,89 @@ def set_lldb_error_fh(error):
 
 
 def driver_instance():
-    return __driver
+    return current_session().driver
 
 
 def set_driver_instance(d):
-    global __driver
-    __driver = d
+    current_session().driver = d
 
 
 def lldb_out_view():
-    return __out_view
+    return current_session().out_view
 
 
 def set_lldb_out_view(v):
-    global __out_view
-    __out_view = v
+    current_session().out_view = v
 
 
-def lldb_view_send(string):
-    sublime.set_timeout(lambda: lldb_view_write(string), 0)
+def lldb_view_send(string, session=None):
+    if session is None:
+        session = current_session()
+    run_on_ui_thread(lambda: lldb_view_write(string, session))
 
 
-def lldb_view_write(string):
-    global __out_view, __window_ref
-    if not (__out_view and __window_ref and __out_view.window()):
+def lldb_process_output_send(string):
+    """Queues output from the debuggee to be written on the lldb i/o view.
+        Output is merged and written in batches, so a chatty process
+        doesn't flood the main thread."""
+    session = current_session()
+    if session.process_output is None:
+        sm = SettingsManager.getSM()
+        buffer_size = sm.get_default('i/o.process_output.buffer_size', 1048576)
+        session.process_output = OutputRingBuffer(buffer_size)
+
+    if session.process_output.append(string):
+        run_on_ui_thread(lambda: __flush_process_output(session))
+
+
+def __flush_process_output(session):
+    sm = SettingsManager.getSM()
+    max_bytes = sm.get_default('i/o.process_output.flush.max_bytes', 65536)
+    max_lines = sm.get_default('i/o.process_output.flush.max_lines', 1000)
+    delay = sm.get_default('i/o.process_output.flush.delay', 20)
+
+    (string, dropped, more) = session.process_output.take(max_bytes, max_lines)
+    if dropped > 0:
+        debug(debugRoot, 'dropped %d bytes of process output' % dropped)
+        string = '\n[lldb: %d bytes of process output dropped]\n%s' % (dropped, string)
+    if string:
+        lldb_view_write(string, session)
+    if more:
+        # Give the main thread some room before writing the rest.
+        run_on_ui_thread(lambda: __flush_process_output(session), delay)
+
+
+def lldb_view_write(string, session=None):
+    if session is None:
+        session = current_session()
+    if session.is_closed:
+        return
+
+    if not (session.out_view and session.window and session.out_view.window()):
         sm = SettingsManager.getSM()
         name = sm.get_default('i/o.view.name', default_lldb_view_name)
 
-        __out_view = get_lldb_output_view(__window_ref, name)
-        if not __window_ref:
+        if not session.window:
             # Bail out and just set the first window
-            __window_ref = sublime.windows()[0]
+            set_window_ref(sublime.windows()[0])
+            session = current_session()
+        session.out_view = session_callback(get_lldb_output_view, session)(session.window, name)
 
-        # __window_ref.set_view_index(__out_view, 1, 0)
+        # session.window.set_view_index(session.out_view, 1, 0)
 
-    __out_view.set_read_only(False)
-    edit = __out_view.begin_edit('lldb-panel-write')
-    __out_view.insert(edit, __out_view.size(), string)
-    __out_view.end_edit(edit)
-    __out_view.set_read_only(True)
-    __out_view.show(__out_view.size())
+    out_view = session.out_view
+    out_view.set_read_only(False)
+    edit = out_view.begin_edit('lldb-panel-write')
+    out_view.insert(edit, out_view.size(), string)
+    out_view.end_edit(edit)
+    out_view.set_read_only(True)
+    out_view.show(out_view.size())
 
 
 def maybe_get_lldb_output_view(window, name):
-    f = None
-
-    for v in __lldb_views:
-        if v.name() == name or v.file_name() == name:
-            return v
+    f = current_session().lldb_views.find(name, name)
+    if f is not None:
+        return f
 
     if window:
         for v in window.views():
@@ -229,37 +481,247 @@ def maybe_get_lldb_output_view(window, name):
 
 
 def add_lldb_view(v):
-    # This is leaking. Check if Sublime Text 2 tells us when our window is
-    # closed.
-    __lldb_views.append(v)
+    # Views are removed when they're closed (LLDBUIListener.on_close) or
+    # when the session ends (lldb_views_destroy).
+    current_session().lldb_views.add(v)
+
+
+def reindex_lldb_view(v):
+    """Must be called when an lldb view changes its name."""
+    for session in [current_session()] + lldb_sessions():
+        session.lldb_views.reindex(v)
 
 
 def del_lldb_view(v):
     debug(debugRoot, 'Removing %s from lldb_views.' % str(v))
-    __lldb_views.remove(v)
+    for session in [current_session()] + lldb_sessions():
+        if session.lldb_views.remove(v):
+            return
 
 
 def lldb_views():
     # Return a copy of the list
-    return list(__lldb_views)
+    return current_session().lldb_views.views()
 
 
-def lldb_views_update(epilogue):
+def pre_update_pool():
+    global __pre_update_pool
+    if __pre_update_pool is None:
+        sm = SettingsManager.getSM()
+        workers = sm.get_default('ui.pre_update.workers', 4)
+        __pre_update_pool = WorkerPool(max(1, workers), 'sublime.lldb.pre_update')
+    return __pre_update_pool
+
+
+class RefreshCancelled(Exception):
+    """Raised by LLDBView.check_cancelled() when the view's refresh is
+        obsolete."""
+    pass
+
+
+def lldb_views_update(epilogue, stop_id=None, is_cancelled=lambda: False):
+    """Updates every lldb view. The views' pre_update() methods run on the
+        pre_update pool, with views which were quicker last time going
+        first. Each view's update() is sent to the UI thread as soon as its
+        pre_update() is done. We give up on views whose pre_update() runs
+        for longer than the ui.pre_update.timeout setting, and on views
+        which are still in a pre_update() from an earlier refresh. Those
+        are marked as stale, and get refreshed when that pre_update()
+        finishes.
+
+        Each refresh belongs to a stop ID (its generation). When a newer
+        stop ID comes along (e.g: the process moved on), is_cancelled()
+        starts returning True, and we give up on the whole refresh: views
+        stop their pre_update() at their next safe point, and updates
+        already sent to the UI thread aren't applied.
+        The epilogue is called (on the UI thread) after every view has
+        been updated."""
     debug(debugRoot, 'lldb_views_update')
-    for v in __lldb_views:
-        v.pre_update()
-
-    def updater():
-        for v in __lldb_views:
+    sm = SettingsManager.getSM()
+    timeout = sm.get_default('ui.pre_update.timeout', 500) / 1000.0
+
+    # Views which aren't visible are only updated when they're activated.
+    session = current_session()
+    views = session.lldb_views.views()
+    if session.active_views:
+        visible = set(session.active_views.values())
+        for v in views:
+            if v.view_id() not in visible:
+                v.mark_stale(stop_id)
+        views = [v for v in views if v.view_id() in visible]
+
+    views = sorted(views, key=lambda v: v.pre_update_time())
+    # Messages from the workers: (view, 'started', start time) and
+    # (view, 'done', True if it can be updated).
+    done = Queue.Queue()
+    # Views we gave up on, and views whose pre_update() finished, so we
+    # know who is going to refresh each view.
+    lock = threading.Lock()
+    given_up = set()
+    finished = set()
+
+    def update(v):
+        # Don't show a stop the process already moved on from.
+        if not is_cancelled():
             v.update()
+
+    def pre_update(v):
+        if is_cancelled():
+            done.put((v, 'done', False))
+            return
+        ok = False
+        try:
+            done.put((v, 'started', monotonic()))
+            ok = v.timed_pre_update(is_cancelled)
+            if not ok:
+                # Someone else started a pre_update() since we checked.
+                v.mark_stale_if_busy(stop_id)
+        except RefreshCancelled:
+            pass
+        except Exception, e:
+            debug(debugRoot, 'exception in %s.pre_update(): %s' % (v.__class__.__name__, repr(e)))
+
+        with lock:
+            finished.add(v)
+            late = v in given_up
+        if not late:
+            done.put((v, 'done', ok))
+        elif ok and not is_cancelled():
+            # We gave up waiting for it, so nobody else is going to update
+            # it. It's not stale for this stop anymore, either.
+            v.clear_stale(stop_id)
+            run_on_ui_thread(session_callback(lambda: update(v)))
+        refresh_if_stale(v)
+
+    pool = pre_update_pool()
+    pending = set()
+    for v in views:
+        if v.mark_stale_if_busy(stop_id):
+            # Still busy with an earlier refresh, which will refresh it
+            # again when it's done.
+            debug(debugRoot, 'skipping %s: still in pre_update()' % v.name())
+            continue
+        pending.add(v)
+        pool.submit(session_callback(lambda v=v: pre_update(v)))
+
+    # Views whose pre_update() is running, and when it started.
+    running = {}
+    last_progress = monotonic()
+    while pending:
+        now = monotonic()
+        if running:
+            deadline = min(running.values()) + timeout
+        else:
+            # Every worker is busy with something else.
+            deadline = last_progress + timeout
+        try:
+            (v, what, value) = done.get(True, max(0, deadline - now))
+        except Queue.Empty:
+            now = monotonic()
+            if running:
+                late = [v for (v, start) in running.iteritems() if now - start >= timeout]
+            else:
+                late = list(pending)
+            with lock:
+                late = [v for v in late if v not in finished]
+                given_up.update(late)
+                # Before their workers can see they were given up on.
+                for v in late:
+                    v.mark_stale(stop_id)
+            for v in late:
+                pending.discard(v)
+                running.pop(v, None)
+            if late:
+                debug(debugRoot, 'giving up on %d view(s) which took longer than %.3fs' % (len(late), timeout))
+            continue
+
+        if is_cancelled():
+            debug(debugRoot, 'lldb_views_update: cancelled (stop ID %s)' % str(stop_id))
+            return
+        last_progress = monotonic()
+        if what == 'started':
+            running[v] = value
+        else:
+            pending.discard(v)
+            running.pop(v, None)
+            if value:
+                run_on_ui_thread(session_callback(lambda v=v: update(v)))
+    trace_stage(stop_id, 'pre_update')
+
+    def finish():
+        if is_cancelled():
+            debug(debugRoot, 'lldb_views_update: cancelled before the epilogue (stop ID %s)' % str(stop_id))
+            return
+        trace_stage(stop_id, 'update', last=True)
         epilogue()
-    sublime.set_timeout(updater, 0)
+    run_on_ui_thread(session_callback(finish))
+
+
+def refresh_if_stale(v):
+    """Called (on any thread) after v's pre_update() finished. If someone
+        marked it as stale while it was running, it's refreshed again."""
+    if v.stale_stop_id() is not None:
+        run_on_ui_thread(session_callback(lambda: update_stale_lldb_view(v)))
+
+
+def refresh_active_views(window):
+    """Looks up which view is active in each of a window's groups. Views
+        can be moved to another group, or closed, so we don't keep track of
+        them one at a time. Returns the active views. Must be called on the
+        UI thread."""
+    views = []
+    active_views = {}
+    for group in xrange(window.num_groups()):
+        v = window.active_view_in_group(group)
+        if v is not None:
+            views.append(v)
+            active_views[group] = v.id()
+    session_for_window(window).active_views = active_views
+    return views
+
+
+def forget_active_view(view_id):
+    """Called when a view is closed (its window may not be there anymore).
+        Must be called on the UI thread."""
+    for session in lldb_sessions():
+        for (group, active_id) in session.active_views.items():
+            if active_id == view_id:
+                del session.active_views[group]
+
+
+def update_stale_lldb_view(v):
+    """Updates a view which missed an update while it wasn't visible (or
+        took too long). Must be called on the UI thread."""
+    stop_id = v.stale_stop_id()
+    if stop_id is None:
+        return
+
+    debug(debugRoot, 'updating stale view %s (missed stop %s)' % (v.name(), str(stop_id)))
+    # Don't update it twice if it's activated again before we're done.
+    v.mark_stale(None)
+
+    def pre_update():
+        try:
+            updated = v.timed_pre_update()
+        except Exception, e:
+            debug(debugRoot, 'exception in %s.pre_update(): %s' % (v.__class__.__name__, repr(e)))
+            return
+
+        if updated:
+            run_on_ui_thread(session_callback(v.update))
+        elif v.mark_stale_if_busy(stop_id):
+            # Whoever is in its pre_update() will refresh it again.
+            return
+        else:
+            # It was busy, but not anymore. Try again.
+            v.mark_stale(stop_id)
+        refresh_if_stale(v)
+    pre_update_pool().submit(session_callback(pre_update))
 
 
 def lldb_views_destroy():
-    global __lldb_views
-    views = __lldb_views
-    __lldb_views = []
+    session = current_session()
+    views = session.lldb_views.clear()
 
     def stop_visitor(thing):
         thing.stop()
@@ -267,12 +729,20 @@ def lldb_views_destroy():
 
 
 def get_lldb_view_for(v):
-    debug(debugRoot, 'lldb_views: %s' % repr(__lldb_views))
+    """Returns the LLDBView for v. Must be called on the UI thread."""
+    sessions = [current_session()] + lldb_sessions()
+    window_session = session_for_window(v.window(), create=False)
+    if window_session:
+        sessions.insert(0, window_session)
+
+    view_id = v.id()
     name = v.name()
     file_name = v.file_name()
-    for lldb_view in __lldb_views:
-        if (name is not None and len(name) > 0 and name == lldb_view.name()) \
-            or (file_name is not None and len(file_name) > 0 and file_name == lldb_view.file_name()):
+    for session in sessions:
+        # Other views on the same buffer (e.g: clones) are found by name.
+        lldb_view = session.lldb_views.get(view_id) \
+            or session.lldb_views.find(name, file_name)
+        if lldb_view is not None:
             return lldb_view
     return None
 
@@ -295,18 +765,31 @@ def get_lldb_output_view(window, name=None):
 
 
 def disabled_bps():
-    return _disabled_bps
+    return current_session().disabled_bps
 
 
 def set_disabled_bps(bps):
-    global _disabled_bps
-    _disabled_bps = bps
+    current_session().disabled_bps = bps
 
 
 __settings_keys = ['lldb.prologue',
+                   'lldb.startup.timeout',
                    'lldb.use_bundled_debugserver',
                    'lldb.i/o.view.name',
                    'lldb.i/o.view.clear_on_startup',
+                   'lldb.ui.coalesce_window',
+                   'lldb.ui.pre_update.workers',
+                   'lldb.ui.pre_update.timeout',
+                   'lldb.ui.scheduler.rate',
+                   'lldb.ui.scheduler.budget',
+                   'lldb.journal.path',
+                   'lldb.breakpoints.store_dir',
+                   'lldb.threads.scan_limit',
+                   'lldb.i/o.process_output.read_size',
+                   'lldb.i/o.process_output.buffer_size',
+                   'lldb.i/o.process_output.flush.max_bytes',
+                   'lldb.i/o.process_output.flush.max_lines',
+                   'lldb.i/o.process_output.flush.delay',
                    'lldb.layout',
                    'lldb.layout.basic',
                    'lldb.layout.group.source_file',
@@ -321,6 +804,8 @@ __settings_keys = ['lldb.prologue',
                    'lldb.markers.breakpoint.disabled.region_name',
                    'lldb.markers.breakpoint.disabled.scope',
                    'lldb.markers.breakpoint.disabled.type',
+                   'lldb.markers.changed_lines.region_name',
+                   'lldb.markers.changed_lines.scope',
                    'lldb.exe',
                    'lldb.args',
                    'lldb.arch',
@@ -340,8 +825,8 @@ class InputPanelDelegate(object):
     def show_on_window(self, window, title='', initial_text=''):
         # Make sure we save the window we're passed.
         self.window = window
-        sublime.set_timeout(lambda: window.show_input_panel(title, initial_text,
-            self.on_done, self.on_change, self.on_cancel), 0)
+        run_on_ui_thread(lambda: window.show_input_panel(title, initial_text,
+            self.on_done, self.on_change, self.on_cancel))
 
     def on_done(self, string):
         pass
@@ -2,6 +2,7 @@
 
 import re
 import os
+import json
 import sys
 import atexit
 import datetime
@@ -16,13 +17,16 @@ import lldbutil
 import lldb_wrappers
 
 from monitors import LLDBUIUpdater
-from lldb_wrappers import thread_created
-from debug import debug, debugPlugin, debugVerbose, debugAny
+from lldb_wrappers import thread_created, send_command_output
+from debug import debug, debugPlugin, debugVerbose, debugAny, debugLatency, \
+                  toggle_debug, debug_is_active, tracer, trace_stage
 from views import LLDBRegisterView, LLDBVariableView, LLDBThreadDisassemblyView, LLDBCodeView
-from utilities import stderr_msg, stdout_msg, generate_memory_view_for, SettingsManager
+from utilities import generate_memory_view_for, SettingsManager, monotonic
+from breakpoints import BreakpointStore, breakpoint_store_path, breakpoint_spec, create_breakpoint, \
+                        PendingBreakpoints
 
 # import these specific names without the prefix
-from lldb_wrappers import LldbDriver, START_LLDB_TIMEOUT
+from lldb_wrappers import LldbDriver
 
 from root_objects import driver_instance, set_driver_instance,          \
                          lldb_out_view, set_lldb_out_view,              \
@@ -30,16 +34,16 @@ from root_objects import driver_instance, set_driver_instance,          \
                          lldb_view_write, lldb_view_send,               \
                          window_ref, set_window_ref,                    \
                          get_lldb_output_view, get_lldb_view_for,       \
-                         lldb_prompt,                                   \
                          lldb_register_view_name,                       \
                          lldb_variable_view_name,                       \
                          lldb_disassembly_view_name,                    \
                          disabled_bps, set_disabled_bps,                \
                          InputPanelDelegate,                            \
-                         set_ui_updater, ui_updater
+                         set_ui_updater, ui_updater,                    \
+                         current_session, lldb_sessions, session_callback, \
+                         session_for_window, ui_scheduler, run_on_ui_thread
 
 _initialized = False
-_is_debugging = False
 _os_not_supported = False
 _macosx_is_too_old = False
 _did_not_find_debugserver = False
@@ -120,18 +124,17 @@ class LLDBPlugin(object):
         return found
 
     @classmethod
-    def debug_prologue(cls, driver):
+    def debug_prologue(cls):
         """
         Prologue for the debugging session during the development of the plugin.
-        Loads a simple program in the debugger and sets a breakpoint in main()
+        Returns the commands to run after lldb's init files (e.g: load a
+        simple program in the debugger and set a breakpoint in main())
         """
         sm = SettingsManager.getSM()
         prologue = sm.get_default('prologue', [])
 
         debug(debugPlugin, 'LLDB prologue: %s' % str(prologue))
-        for c in prologue:
-            lldb_view_write(lldb_prompt() + c + '\n')
-            driver.interpret_command(c)
+        return prologue
 
     @classmethod
     def lldb_greeting(cls):
@@ -175,36 +178,50 @@ class LLDBPlugin(object):
             lldb_view_write(g)
             lldb_view_write('cwd: ' + os.getcwd() + '\n')
             w.set_view_index(lldb_out_view(), 1, 0)
-
-            cls.debug_prologue(driver_instance())
+            sublime.status_message('Starting lldb...')
             return True
 
         return True
 
+    @classmethod
+    def with_debugger(cls, driver, fn):
+        """Calls fn(debugger) on the UI thread as soon as driver's
+            SBDebugger exists. We poll for it instead of blocking the UI
+            thread, and tell the user (without calling fn) if it isn't
+            ready after lldb.startup.timeout seconds."""
+        if driver is None:
+            sublime.error_message('Couldn\'t get a debugging session.')
+            return
+        sm = SettingsManager.getSM()
+        deadline = monotonic() + sm.get_default('startup.timeout', 10)
+
+        def poll():
+            debugger = driver.debugger
+            if debugger is not None:
+                fn(debugger)
+            elif driver.tried_creating_debugger:
+                sublime.error_message('Couldn\'t start lldb.')
+            elif monotonic() >= deadline:
+                sublime.error_message('lldb is taking too long to start.')
+            else:
+                run_on_ui_thread(session_callback(poll), 50)
+        poll()
+
     @classmethod
     def initialize_lldb(cls, w):
         # set_got_input_function(lldb_in_panel_on_done)
 
-        driver = LldbDriver(w, lldb_view_send, process_stopped, on_exit_callback=cls.cleanup)
-        event = lldb.SBEvent()
-        listener = lldb.SBListener('Wait for lldb initialization')
-        listener.StartListeningForEvents(driver.broadcaster,
-                LldbDriver.eBroadcastBitThreadDidStart)
-
+        # Don't wait for lldb. The driver will tell us (on the lldb i/o
+        # view) when it's ready for commands.
+        driver = LldbDriver(w, lldb_view_send, process_stopped, on_exit_callback=cls.cleanup,
+                            startup_commands=cls.debug_prologue())
         driver.start()
-        listener.WaitForEvent(START_LLDB_TIMEOUT, event)
-        listener.Clear()
-
-        if not event:
-            lldb_view_write("oops... the event isn't valid")
-
         return driver
 
     @classmethod
     def start_debugging(cls, w):
-        global _is_debugging
-        if _is_debugging:
-            cls.cleanup(window_ref())
+        if current_session().is_debugging:
+            cls.cleanup()
 
         cls.initialize_plugin()
 
@@ -225,24 +242,39 @@ class LLDBPlugin(object):
                         'like to have the plugin support it, please contact the author.')
             return False
 
-        _is_debugging = True
+        current_session().is_debugging = True
 
         # Really start the debugger
         cls.initialize_lldb(w)
 
-        driver_instance().debugger.SetInputFileHandle(sys.__stdin__, False)
-
         # We may also need to change the width upon window resize
         # debugger.SetTerminalWidth()
         return True
 
     @classmethod
-    def cleanup(cls, w=None):
-        global _is_debugging
-        _is_debugging = False
+    def prewarm_session(cls, w):
+        """Starts lldb for w's session (if it isn't running), so it's ready
+            when the user starts debugging."""
+        set_window_ref(w)
+        if driver_instance() is None:
+            debug(debugPlugin, 'pre-warming session for window %s' % repr(w))
+            return cls.ensure_lldb_is_running(w)
+        return True
+
+    @classmethod
+    def cleanup(cls, session=None):
+        """Ends a debugging session (by default, the current one)."""
+        if session is None:
+            session = current_session()
+        session_callback(cls.cleanup_session, session)()
+
+    @classmethod
+    def cleanup_session(cls):
+        current_session().is_debugging = False
 
         set_disabled_bps([])
-        ui_updater().stop()
+        if ui_updater():
+            ui_updater().stop()
         driver = driver_instance()
         if driver:
             driver.stop()
@@ -311,66 +343,65 @@ class LLDBLayoutManager(object):
 @atexit.register
 def atexit_function():
     debug(debugPlugin, 'running atexit_function')
-    LLDBPlugin.cleanup(window_ref())
+    for session in lldb_sessions():
+        LLDBPlugin.cleanup(session)
 
 
 def unload_handler():
     debug(debugPlugin, 'unloading lldb plugin')
-    LLDBPlugin.cleanup(window_ref())
+    for session in lldb_sessions():
+        LLDBPlugin.cleanup(session)
 
 
 def process_stopped(driver, process, state=None):
-    ui_updater().process_stopped(state, lambda: driver.maybe_get_input())
+    stop_id = driver.stop_id
+    trace_stage(stop_id, 'callback')
+    ui_updater().process_stopped(state, lambda: driver.maybe_get_input(), stop_id)
 
     # Open a new view on source code/disassembly, if needed.
     if process and driver.process_is_stopped(process):
-        filespec = None
-        line_entry = process.GetSelectedThread().GetSelectedFrame().GetLineEntry()
-        if line_entry:
+        # The views will need the same frames, so get them from the
+        # stop's snapshot.
+        snapshot = driver.snapshot()
+        line_entries = snapshot.line_entries(snapshot.selected_thread())
+        filename = None
+        if line_entries and line_entries[0][0] is not None:
             # We don't need to run 'process status' like Driver.cpp
             # Since we open the file and show the source line.
-            r = driver.interpret_command('thread list')
-            lldb_view_send(stdout_msg(r[0].GetOutput()))
-            lldb_view_send(stderr_msg(r[0].GetError()))
-            r = driver.interpret_command('frame info')
-            lldb_view_send(stdout_msg(r[0].GetOutput()))
-            lldb_view_send(stderr_msg(r[0].GetError()))
-
-            filespec = line_entry.GetFileSpec()
+            driver.interpret_commands_async(['thread list', 'frame info'], send_command_output)
+
+            filename = line_entries[0][0]
         else:
             # Give us some assembly to check the crash/stop
-            r = driver.interpret_command('process status')
-            lldb_view_send(stdout_msg(r[0].GetOutput()))
-            lldb_view_send(stderr_msg(r[0].GetError()))
-            if not line_entry:
-                # Get ALL the SBFrames
-                t = process.GetSelectedThread()
-                n = t.GetNumFrames()
-                for i in xrange(0, n):
-                    f = t.GetFrameAtIndex(i)
-                    if f:
-                        line_entry = f.GetLineEntry()
-                        if line_entry and line_entry.GetFileSpec():
-                            filespec = line_entry.GetFileSpec()
-
-        if filespec:
-            filename = filespec.GetDirectory() + '/' + filespec.GetFilename()
+            driver.interpret_command_async('process status', send_command_output)
+            # Show the first frame which has line information.
+            for (frame_filename, line) in line_entries:
+                if frame_filename is not None:
+                    filename = frame_filename
+                    break
+
+        if filename:
             # Maybe we don't need to focus the first group. The user knows
             # what he/she wants.
 
             def to_ui_thread():
+                if driver.stop_id != stop_id:
+                    # The process already moved on. Don't open a file for
+                    # a stop we won't show.
+                    debug(debugPlugin, 'skipping stale file open: %s' % filename)
+                    return
                 window_ref().focus_group(0)
                 v = window_ref().open_file(filename)
                 lldb_view = get_lldb_view_for(v)
                 if lldb_view is None:
                     lldb_view = LLDBCodeView(v, driver)
                 # TODO: Maybe bring the view to the front?
-            sublime.set_timeout(to_ui_thread, 0)
+            run_on_ui_thread(session_callback(to_ui_thread))
         else:
             # TODO: If we don't have a filespec, we can try to disassemble
             # around the thread's PC.
-            sublime.set_timeout(lambda:
-                window_ref().run_command('lldb_disassemble_frame', {'thread': process.GetSelectedThread()}), 0)
+            run_on_ui_thread(session_callback(lambda:
+                window_ref().run_command('lldb_disassemble_frame', {'thread': process.GetSelectedThread()})))
 
 
 bp_re_file_line = re.compile('^(.*\S)\s*:\s*(\d+)\s*$')
@@ -379,11 +410,15 @@ bp_re_address = re.compile('^(0x[0-9A-Fa-f]+)\s*$')
 bp_re_name = re.compile('^(.*\S)\s*$')
 
 
-def create_default_bps_for_target(target):
-    n = 0
+def create_default_bps_for_target(target, on_done=None):
+    """Creates the breakpoints from the lldb.breakpoints setting and from
+        the target's breakpoint store, which keeps the breakpoints we had
+        the last time we debugged it. They're created on the driver thread,
+        which then calls on_done(number of breakpoints created) on the UI
+        thread. Returns the PendingBreakpoints which keeps track of them."""
     sm = SettingsManager.getSM()
-    bps = sm.get_default('breakpoints', [])
-    for bp in bps:
+    specs = []
+    for bp in sm.get_default('breakpoints', []):
         if not bp:
             continue
 
@@ -391,38 +426,91 @@ def create_default_bps_for_target(target):
             bp = str(bp)
             m = bp_re_file_line.match(bp)
             if m:
-                target.BreakpointCreateByLocation(m.group(1), m.group(2))
-                ++n
+                specs.append({'file': m.group(1), 'line': int(m.group(2))})
                 continue
 
             m = bp_re_address.match(bp)
             if m:
-                target.BreakpointCreateByAddress(m.group(1))
-                ++n
+                specs.append({'address': m.group(1)})
                 continue
 
             m = bp_re_name.match(bp)
             if m:
-                target.BreakpointCreateByName(m.group(1))
-                ++n
+                specs.append({'name': m.group(1)})
                 continue
 
             debug(debugPlugin, "couldn't tell where the bp spec '" + bp + "' should break.")
 
         # bp isn't an str. It should be a dict
-        elif 'file' in bp and 'line' in bp:
-            target.BreakpointCreateByLocation(str(bp['file']), bp['line'])
-            ++n
-        elif 'address' in bp:
-            target.BreakpointCreateByAddress(bp['address'])
-            ++n
         else:
-            debug(debugPlugin, 'unrecognized breakpoint type: ' + str(bp))
+            specs.append(bp)
+
+    store = None
+    exe = target.GetExecutable()
+    if exe:
+        store = BreakpointStore(breakpoint_store_path(exe.GetDirectory() + '/' + exe.GetFilename()),
+                                target)
+        driver_instance().breakpoint_store = store
+
+    # Breakpoints from the setting take precedence over the stored ones of
+    # the same kind.
+    pending = PendingBreakpoints(target, store)
+    for spec in specs:
+        pending.add(spec)
+    if store:
+        for (key, spec) in store.load():
+            pending.add(spec, key)
+    driver_instance().create_breakpoints(pending, on_done)
+    return pending
+
+
+def store_breakpoint(target, bp, spec):
+    """Stores a breakpoint we created from spec in the breakpoint store, if
+        it's the store's target, so we don't have to parse its description
+        later. If it was pending, we stop looking for it."""
+    pending = pending_breakpoints_for(target)
+    if pending:
+        pending.discard(spec)
+    driver = driver_instance()
+    store = driver and driver.breakpoint_store
+    debugger = driver and driver.debugger
+    if store and debugger and \
+            debugger.GetIndexOfTarget(target) == debugger.GetIndexOfTarget(store.target):
+        store.add(bp.GetID(), breakpoint_spec(bp, spec))
+
+
+def pending_and_not_created(target):
+    """Returns two lists of (store key, spec): target's pending breakpoints,
+        and the stored ones which we couldn't create."""
+    pending = pending_breakpoints_for(target)
+    if not pending:
+        return ([], [])
+    specs = pending.pending()
+    # The store was created with the default breakpoints, for the same
+    # target.
+    store = driver_instance().breakpoint_store
+    keys = set([key for (key, spec) in specs])
+    not_created = [(key, spec) for (key, spec) in store.saved() if key not in keys] if store else []
+    return (specs, not_created)
+
+
+def pending_breakpoints_for(target):
+    """The PendingBreakpoints we created target's default breakpoints with,
+        or None."""
+    driver = driver_instance()
+    pending = driver and driver.pending_breakpoints
+    debugger = driver and driver.debugger
+    if pending and debugger and \
+            debugger.GetIndexOfTarget(target) == debugger.GetIndexOfTarget(pending.target):
+        return pending
+    return None
 
 
 # TODO: Check when each command should be enabled.
 class WindowCommand(sublime_plugin.WindowCommand):
     def setup(self):
+        # Act on this window's debugging session.
+        set_window_ref(self.window)
         if lldb_out_view() is None:
             sm = SettingsManager.getSM()
             view_name = sm.get_default('i/o.view.name', default_lldb_view_name)
@@ -448,6 +536,20 @@ class LldbCommand(WindowCommand):
             sublime.error_message('Unable to send commands to the debugger.')
 
 
+class LldbPrewarmSession(WindowCommand):
+    # Starts lldb for this window in the background.
+    def is_enabled(self):
+        session = session_for_window(self.window, create=False)
+        return session is None or session.driver is None
+
+    def run(self):
+        self.setup()
+        if LLDBPlugin.prewarm_session(self.window):
+            self.status_message('Starting lldb in the background...')
+        else:
+            sublime.error_message('Couldn\'t get a debugging session.')
+
+
 class LldbDebugProgram(WindowCommand):
     # Only enabled when we have a default program to run.
     def is_enabled(self):
@@ -472,17 +574,34 @@ class LldbDebugProgram(WindowCommand):
             args = map(str, sm.get_default('args', []))
 
             debug(debugPlugin, 'Launching program: ' + exe + ' (' + arch + '), with args: ' + str(args))
-            t = driver_instance().debugger.CreateTargetWithFileAndArch(str(exe), str(arch))
-            driver_instance().debugger.SetSelectedTarget(t)
 
-            sublime.status_message('Setting default breakpoints.')
-            create_default_bps_for_target(t)
-
-            sublime.status_message('Launching program (%s): %s %s' % (arch, exe, args))
-            if t.LaunchSimple(args, None, os.getcwd()):
-                sublime.status_message('Program successfully launched.')
-            else:
-                sublime.error_message('Program failed to launch.')
+            def create_target(debugger):
+                start = monotonic()
+                t = debugger.CreateTargetWithFileAndArch(str(exe), str(arch))
+                debugger.SetSelectedTarget(t)
+                driver_instance().check_selected_target()
+                target_time = monotonic() - start
+                cwd = os.getcwd()
+
+                def launch(n):
+                    pending.launch_phase_done('target', target_time)
+                    sublime.status_message('Launching program (%s): %s %s' % (arch, exe, args))
+                    start = monotonic()
+                    launched = t.LaunchSimple(args, None, cwd)
+                    pending.launch_phase_done('launch', monotonic() - start)
+                    lldb_view_send(pending.launch_summary())
+                    if launched:
+                        sublime.status_message('Program successfully launched.')
+                    else:
+                        sublime.error_message('Program failed to launch.')
+
+                # The program is launched once the driver created the
+                # breakpoints, so it can't run past them.
+                sublime.status_message('Setting default breakpoints.')
+                pending = create_default_bps_for_target(t, launch)
+
+            # The driver thread may not have created the debugger yet.
+            LLDBPlugin.with_debugger(driver_instance(), create_target)
 
 
 class LldbAttachProcess(WindowCommand):
@@ -499,15 +618,17 @@ class LldbAttachProcess(WindowCommand):
                 return False
 
             driver = driver_instance()
-            if driver:
+
+            def attach(debugger):
                 # Check if we have a previously running program
-                target = driver.debugger.GetSelectedTarget()
+                target = debugger.GetSelectedTarget()
 
                 if not target:
-                    target = driver.debugger.CreateTarget('')
+                    target = debugger.CreateTarget('')
                     if not target:
                         sublime.error_message('Error attaching to process')
-                    driver.debugger.SetSelectedTarget(target)
+                    debugger.SetSelectedTarget(target)
+                    driver.check_selected_target()
 
                 old_exec_module = target.GetExecutable()
                 old_triple = target.GetTriple()
@@ -563,8 +684,8 @@ class LldbAttachProcess(WindowCommand):
 
                 # How can we setup the default breakpoints?
                 # We *could* start a new thread with a listener, just for that...
-            else:
-                sublime.error_message('Couldn\'t get a debugging session.')
+
+            LLDBPlugin.with_debugger(driver, attach)
 
     def run(self):
         self.setup()
@@ -587,11 +708,10 @@ class LldbConnectDebugserver(WindowCommand):
                 return False
             LLDBLayoutManager.lldb_toggle_output_view(self.window, show=True)
 
-            driver = driver_instance()
-            if driver:
+            def connect(debugger):
                 invalidListener = lldb.SBListener()
                 error = lldb.SBError()
-                target = driver.debugger.CreateTargetWithFileAndArch(None, None)
+                target = debugger.CreateTargetWithFileAndArch(None, None)
 
                 sublime.status_message('Connecting to debugserver at: %s' % string)
                 process = target.ConnectRemote(invalidListener, str(string), None, error)
@@ -599,9 +719,12 @@ class LldbConnectDebugserver(WindowCommand):
                 if error.Fail():
                     sublime.error_message("Connect failed: %s" % error.GetCString())
                 else:
-                    driver.debugger.SetSelectedTarget(target)
+                    debugger.SetSelectedTarget(target)
+                    driver_instance().check_selected_target()
                     sublime.status_message('Connected to debugserver.')
 
+            LLDBPlugin.with_debugger(driver_instance(), connect)
+
             # How can we setup the default breakpoints?
             # We *could* start a new thread with a listener, just for that...
 
@@ -622,7 +745,7 @@ class LldbStopDebugging(WindowCommand):
         driver = driver_instance()
         if driver:
             sublime.status_message('Stopping the debugger.')
-            LLDBPlugin.cleanup(self.window)
+            LLDBPlugin.cleanup(session_for_window(self.window))
             sublime.status_message('Debugging session stopped.')
         else:
             sublime.error_message('Nothing to stop. Debugger not running.')
@@ -640,7 +763,7 @@ class LldbContinue(WindowCommand):
         driver = driver_instance()
         if driver:
             if process is None:
-                target = driver.debugger.GetSelectedTarget()
+                target = driver.current_target()
                 if target:
                     process = target.GetProcess()
 
@@ -671,7 +794,7 @@ class LldbSendSignal(WindowCommand):
     def is_enabled(self):
         driver = driver_instance()
         if driver:
-            target = driver.debugger.GetSelectedTarget()
+            target = driver.current_target()
             return target and target.GetProcess()
 
     def run(self, process=None):
@@ -679,7 +802,7 @@ class LldbSendSignal(WindowCommand):
         driver = driver_instance()
         if driver:
             if process is None:
-                target = driver.debugger.GetSelectedTarget()
+                target = driver.current_target()
                 if target:
                     process = target.GetProcess()
 
@@ -806,74 +929,43 @@ class LldbStepIntoThread(WindowCommand):
 
 # Breakpoint related commands
 class LldbListBreakpoints(WindowCommand):
-    bp_desc_re_addr = re.compile('address = ([^,]+)')
-    bp_desc_re_name = re.compile("name = '(([^'\\\\]|\\\\.)+)'")
-    bp_desc_re_file_line = re.compile("file =\\s*'(([^'\\\\]|\\\\.)+)', line = (\\d+)")
-    bp_desc_re_regex = re.compile('source regex = "(([^"\\\\]|\\\\.)*)"')
-
     def is_enabled(self):
         driver = driver_instance()
-        return driver is not None and driver.debugger.GetSelectedTarget()
-
-    def parse_description(self, bp_desc):
-        """
-        Parse breakpoint descriptions from lldb, outputting JSON for putting in the lldb.breakpoints setting.
-        TODO: Support breakpoint conditions (and maybe callbacks/commands)
-
-        Example descriptions:
-
-        Current breakpoints:
-        1: name = 'main', locations = 1
-          1.1: where = tests`main + 36 at tests.c:15, address = tests[0x0000000100000824], unresolved, hit count = 0
-
-        2: name = 'atoi', locations = 2
-          2.1: where = tests`atoi + 13 at atoi.c:10, address = tests[0x000000010000154d], unresolved, hit count = 0
-          2.2: where = libsystem_c.dylib`atoi, address = libsystem_c.dylib[0x0000000000080bba], unresolved, hit count = 0
-
-        3: name = 'itoa', locations = 1
-          3.1: where = tests`itoa + 11 at atoi.c:56, address = tests[0x000000010000175b], unresolved, hit count = 0
-
-        4: file ='tests.c', line = 42, locations = 1
-          4.1: where = tests`main + 1786 at tests.c:43, address = tests[0x0000000100000efa], unresolved, hit count = 0
-
-        """
-        m = self.bp_desc_re_addr.search(bp_desc)
-        if m:
-            json = '{ "address": %s }' % m.group(1)
-            return json
-
-        m = self.bp_desc_re_name.search(bp_desc)
-        if m:
-            json = '{ "name": "%s" }' % m.group(1)
-            return json
-
-        m = self.bp_desc_re_file_line.search(bp_desc)
-        if m:
-            json = '{ "file": "%s", "line": %s }' % (m.group(1), m.group(2))
-            return json
-
-        m = self.bp_desc_re_regex.search(bp_desc)
-        if m:
-            json = '{ "regex": "%s" }' % m.group(1)
-            return json
+        return driver is not None and driver.current_target()
 
     def run(self, target=None):
         self.setup()
 
         if target is None:
-            target = driver_instance().debugger.GetSelectedTarget()
+            target = driver_instance().current_target()
 
         if not target:
             sublime.error_message('No selected target.')
             return
 
+        store = driver_instance().breakpoint_store
         bp_list = []
         for bp in target.breakpoint_iter():
-            # We're going to have to parse the description to know which kind
-            # of breakpoint we have, since lldb doesn't reify that information.
-            bp_list.append(self.parse_description(lldbutil.get_description(bp)))
+            spec = store and store.spec_for(bp.GetID())
+            if spec is None:
+                # We're going to have to parse the description to know which
+                # kind of breakpoint we have, since lldb doesn't reify that
+                # information.
+                spec = breakpoint_spec(bp)
+            if spec is not None:
+                bp_list.append(json.dumps(spec))
 
         string = ', '.join(bp_list)
+
+        # Breakpoints we didn't find a module for yet, and stored ones
+        # which we couldn't create. Both can be removed with "LLDB: Remove
+        # Pending Breakpoint".
+        (pending, not_created) = pending_and_not_created(target)
+        if pending:
+            string += '\n\nPending: ' + ', '.join([json.dumps(pending_spec) for (key, pending_spec) in pending])
+        if not_created:
+            string += '\n\nNot created: ' + ', '.join([json.dumps(saved_spec)
+                                                      for (key, saved_spec) in not_created])
         v = self.window.get_output_panel('breakpoint list')
 
         LLDBLayoutManager.clear_view(v)
@@ -889,7 +981,7 @@ class LldbListBreakpoints(WindowCommand):
 class LldbBreakAtLine(WindowCommand):
     def is_enabled(self):
         driver = driver_instance()
-        return driver is not None and driver.debugger.GetSelectedTarget()
+        return driver is not None and driver.current_target()
 
     def run(self, target=None):
         self.setup()
@@ -901,7 +993,10 @@ class LldbBreakAtLine(WindowCommand):
         if target and v:
             file = v.file_name()
             (line, col) = v.rowcol(v.sel()[0].begin())
-            if target.BreakpointCreateByLocation(str(file), line + 1):
+            spec = {'file': file, 'line': line + 1}
+            bp = create_breakpoint(target, spec)
+            if bp:
+                store_breakpoint(target, bp, spec)
                 sublime.status_message('Breakpoint set at %s:%d' % (file, line))
             else:
                 sublime.error_message('Couldn\'t set breakpoint at %s:%d' % (file, line))
@@ -916,12 +1011,15 @@ class LldbBreakAtSymbol(WindowCommand):
 
         def on_done(self, string):
             if self.__target:  # Check if it's still valid
-                if self.__target.BreakpointCreateByName(str(string)):
+                spec = {'name': string}
+                bp = create_breakpoint(self.__target, spec)
+                if bp:
+                    store_breakpoint(self.__target, bp, spec)
                     sublime.status_message('Breakpoint set at symbol `%s\'' % (string))
 
     def is_enabled(self):
         driver = driver_instance()
-        return driver is not None and driver.debugger.GetSelectedTarget()
+        return driver is not None and driver.current_target()
 
     def run(self, target=None):
         self.setup()
@@ -934,10 +1032,47 @@ class LldbBreakAtSymbol(WindowCommand):
             delegate.show_on_window(self.window, 'Symbol to break at')
 
 
+class LldbRemovePendingBreakpoint(WindowCommand):
+    """Removes a breakpoint we didn't find a module for yet, or a stored one
+        we couldn't create."""
+    def is_enabled(self):
+        driver = driver_instance()
+        return driver is not None and driver.current_target()
+
+    def run(self, target=None):
+        self.setup()
+
+        if target is None:
+            target = driver_instance().current_target()
+        if not target:
+            sublime.error_message('No selected target.')
+            return
+
+        (pending, not_created) = pending_and_not_created(target)
+        # (is pending, store key, spec)
+        items = [(True, key, spec) for (key, spec) in pending] + \
+                [(False, key, spec) for (key, spec) in not_created]
+        if not items:
+            sublime.status_message('No pending breakpoints.')
+            return
+
+        def on_done(index):
+            if index < 0:
+                return
+            (is_pending, key, spec) = items[index]
+            if is_pending:
+                pending_breakpoints_for(target).discard(spec)
+            else:
+                driver_instance().breakpoint_store.remove(key)
+            sublime.status_message('Removed breakpoint %s' % json.dumps(spec))
+
+        self.window.show_quick_panel([json.dumps(spec) for (is_pending, key, spec) in items], on_done)
+
+
 class LldbToggleEnableBreakpoints(WindowCommand):
     def is_enabled(self):
         driver = driver_instance()
-        return driver is not None and driver.debugger.GetSelectedTarget()
+        return driver is not None and driver.current_target()
 
     def run(self, target=None):
         self.setup()
@@ -1089,6 +1224,41 @@ class LldbSendEof(WindowCommand):
             debugger.DispatchInput('\x04')
 
 
+class LldbCancelPendingCommands(WindowCommand):
+    def is_enabled(self):
+        driver = driver_instance()
+        return driver is not None
+
+    def run(self):
+        driver = driver_instance()
+        if driver:
+            n = driver.cancel_pending_input()
+            self.status_message('Cancelled %d pending command%s.' % (n, '' if n == 1 else 's'))
+
+
+class LldbToggleLatencyTracing(WindowCommand):
+    def run(self):
+        toggle_debug(debugLatency)
+        if debug_is_active(debugLatency):
+            self.status_message('Tracing stop latencies.')
+        else:
+            self.status_message('Stopped tracing stop latencies.')
+
+
+class LldbShowLatencyHistogram(WindowCommand):
+    def run(self, clear=False):
+        LLDBLayoutManager.lldb_toggle_output_view(self.window, show=True)
+        lldb_view_send('\nLatency since the process stopped, per stage:\n' + tracer.report())
+        if ui_updater():
+            lldb_view_send(ui_updater().metrics())
+        lldb_view_send(ui_scheduler().report())
+        driver = driver_instance()
+        if driver and driver.pending_breakpoints:
+            lldb_view_send(driver.pending_breakpoints.report())
+        if clear:
+            tracer.clear()
+
+
 class LldbPauseProcess(WindowCommand):
     def is_enabled(self):
         driver = driver_instance()
@@ -1,8 +1,13 @@
 # Utilities for the sublime lldb plugin
+import os
+import Queue
 import string
 import sublime
+import threading
 
-from debug import debug, debugSettings, debugAny
+from collections import deque
+
+from debug import debug, debugSettings, debugAny, monotonic
 
 
 class SettingsManager(object):
@@ -126,6 +131,225 @@ class SettingsManager(object):
                     o(key, old_value, new_value)
 
 
+class OutputRingBuffer(object):
+    """Thread-safe bounded buffer for output that has to reach the UI
+        thread. Producers append chunks and the UI thread takes merged
+        batches, bounded by a byte and line budget. When the buffer is full,
+        the oldest data is dropped and accounted for, so we can report it."""
+    def __init__(self, capacity):
+        self.__lock = threading.Lock()
+        self.__chunks = deque()
+        self.__size = 0
+        self.__capacity = capacity
+        self.__dropped = 0
+        self.__flush_scheduled = False
+
+    def append(self, data):
+        """Appends data to the buffer. Returns True if the caller has to
+            schedule a flush (nobody else has scheduled one yet)."""
+        if not data:
+            return False
+
+        with self.__lock:
+            if len(data) > self.__capacity:
+                self.__dropped += len(data) - self.__capacity
+                data = data[-self.__capacity:]
+
+            self.__chunks.append(data)
+            self.__size += len(data)
+            while self.__size > self.__capacity:
+                chunk = self.__chunks.popleft()
+                self.__size -= len(chunk)
+                self.__dropped += len(chunk)
+
+            if self.__flush_scheduled:
+                return False
+            self.__flush_scheduled = True
+            return True
+
+    def take(self, max_bytes, max_lines):
+        """Takes at most max_bytes and max_lines of data from the buffer.
+            Returns (data, dropped, more), where dropped is the number of
+            bytes dropped since the last take() and more tells if there's
+            still data for another flush. If there isn't, the next append()
+            will ask for a new flush."""
+        with self.__lock:
+            pieces = []
+            n_bytes = 0
+            n_lines = 0
+            while self.__chunks and n_bytes < max_bytes and n_lines < max_lines:
+                chunk = self.__chunks.popleft()
+                self.__size -= len(chunk)
+
+                # Cut the chunk if it goes over budget, preferably on a line
+                # boundary, and put the rest back for the next flush.
+                cut = max_bytes - n_bytes
+                lines_left = max_lines - n_lines
+                pos = -1
+                for i in xrange(0, lines_left):
+                    pos = chunk.find('\n', pos + 1)
+                    if pos == -1 or pos >= cut:
+                        break
+                if pos != -1 and pos < cut and pos + 1 < len(chunk):
+                    cut = pos + 1
+                elif len(chunk) > cut:
+                    newline = chunk.rfind('\n', 0, cut)
+                    if newline != -1:
+                        cut = newline + 1
+
+                if cut < len(chunk):
+                    rest = chunk[cut:]
+                    chunk = chunk[:cut]
+                    self.__chunks.appendleft(rest)
+                    self.__size += len(rest)
+
+                pieces.append(chunk)
+                n_bytes += len(chunk)
+                n_lines += chunk.count('\n')
+
+            dropped = self.__dropped
+            self.__dropped = 0
+            more = len(self.__chunks) > 0
+            if not more:
+                self.__flush_scheduled = False
+
+            return (''.join(pieces), dropped, more)
+
+
+class WorkerPool(object):
+    """Fixed number of daemon threads which run the callables they're
+        given, in the order they were submitted."""
+    def __init__(self, size, name):
+        self.__queue = Queue.Queue()
+        self.__threads = []
+        for i in xrange(size):
+            t = threading.Thread(target=self.__run, name='%s.%d' % (name, i))
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+    def __len__(self):
+        return len(self.__threads)
+
+    def submit(self, fn):
+        self.__queue.put(fn)
+
+    def stop(self):
+        for t in self.__threads:
+            self.__queue.put(None)
+
+    def __run(self):
+        fn = self.__queue.get()
+        while fn is not None:
+            try:
+                fn()
+            except Exception, e:
+                debug(debugAny, 'exception in worker %s: %s' % (threading.current_thread().name, repr(e)))
+            fn = self.__queue.get()
+
+
+class UIScheduler(object):
+    """Runs callables on the UI thread, in the order they were scheduled.
+
+        Instead of one sublime.set_timeout() per callable, they're run in
+        batches (ticks), at most rate times per second. Each tick stops
+        after budget seconds, and whatever is left is run on the next tick,
+        so the editor can deal with its own events in between."""
+    def __init__(self, rate, budget):
+        self.__interval = 1.0 / max(1, rate)
+        self.__budget = budget
+        self.__lock = threading.Lock()
+        self.__tasks = deque()
+        self.__tick_pending = False
+        self.__last_tick = 0
+
+        # Metrics
+        self.__ticks = 0
+        self.__tasks_run = 0
+        self.__overruns = 0
+        self.__busy = 0
+        self.__max_tick = 0
+
+    def schedule(self, fn, delay=0):
+        """Runs fn on the UI thread after (at least) delay milliseconds.
+            Can be called from any thread."""
+        if delay > 0:
+            sublime.set_timeout(lambda: self.schedule(fn), delay)
+            return
+
+        with self.__lock:
+            self.__tasks.append(fn)
+            if self.__tick_pending:
+                return
+            self.__tick_pending = True
+        self.__schedule_tick()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__tasks)
+
+    def __schedule_tick(self):
+        wait = self.__last_tick + self.__interval - monotonic()
+        sublime.set_timeout(self.__tick, max(0, int(wait * 1000)))
+
+    def __tick(self):
+        start = monotonic()
+        self.__last_tick = start
+        deadline = start + self.__budget
+        n = 0
+        while True:
+            with self.__lock:
+                if not self.__tasks:
+                    self.__tick_pending = False
+                    break
+                if n > 0 and monotonic() >= deadline:
+                    # Out of time. Leave the rest for the next tick.
+                    self.__overruns += 1
+                    break
+                fn = self.__tasks.popleft()
+
+            n += 1
+            try:
+                fn()
+            except Exception, e:
+                debug(debugAny, 'exception in UI task %s: %s' % (repr(fn), repr(e)))
+
+        elapsed = monotonic() - start
+        self.__ticks += 1
+        self.__tasks_run += n
+        self.__busy += elapsed
+        self.__max_tick = max(self.__max_tick, elapsed)
+
+        if self.__tick_pending:
+            self.__schedule_tick()
+
+    def report(self):
+        """Text report of how busy we kept the UI thread."""
+        if self.__ticks == 0:
+            return 'UI thread: no ticks yet\n'
+        return 'UI thread: %d ticks (%d over budget), %d tasks, busy for %.3fs ' \
+               '(%.3fms per tick, max %.3fms)\n' %                             \
+               (self.__ticks, self.__overruns, self.__tasks_run, self.__busy,
+                self.__busy * 1000 / self.__ticks, self.__max_tick * 1000)
+
+
+# Canonical paths we already know about. Debug information (and Sublime
+# Text) may name the same file through symlinks or with '..' components.
+__canonical_paths = {}
+
+
+def canonical_path(path):
+    """Returns the canonical path for path (see os.path.realpath). Results
+        are cached, so each path only hits the file system once."""
+    if path is None:
+        return None
+    result = __canonical_paths.get(path)
+    if result is None:
+        result = os.path.realpath(path)
+        __canonical_paths[path] = result
+    return result
+
+
 def stderr_msg(str):
     if str is not None and len(str) > 0:
         str = 'err> ' + str.replace('\n', '\nerr> ')
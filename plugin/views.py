@@ -1,4 +1,5 @@
 import re
+import difflib
 
 import sublime
 
@@ -8,9 +9,11 @@ import lldbutil
 from multiprocessing import Lock
 
 from debug import debug, debugViews, debugSettings
-from utilities import SettingsManager
+from utilities import SettingsManager, monotonic, canonical_path
 from root_objects import lldb_register_view_name, lldb_disassembly_view_name,   \
-                         lldb_variable_view_name, driver_instance, add_lldb_view
+                         lldb_variable_view_name, driver_instance, add_lldb_view, \
+                         reindex_lldb_view, run_on_ui_thread, pre_update_pool, \
+                         session_callback, RefreshCancelled
 
 
 class LLDBView(object):
@@ -24,6 +27,13 @@ class LLDBView(object):
         self.__name = view.name()
         # TODO: What happens when a file is renamed?
         self.__file_name = view.file_name()
+        self.__view_id = view.id()
+        self.__pre_update_time = 0
+        self.__stale_stop_id = None
+        self.__is_cancelled = None
+        # Guards the fields below, and the two above.
+        self.__pre_update_lock = Lock()
+        self.__in_pre_update = False
         add_lldb_view(self)
         debug(debugViews, "Created an LLDBView with (class, view, name, file_name) == %s" %
               str((self.__class__.__name__, self.__view, self.__name, self.__file_name)))
@@ -39,10 +49,14 @@ class LLDBView(object):
     def set_name(self, name):
         self.base_view().set_name(name)
         self.__name = name
+        reindex_lldb_view(self)
 
     def file_name(self):
         return self.__file_name
 
+    def view_id(self):
+        return self.__view_id
+
     def set_read_only(self, is_ro=True):
         self.__view.set_read_only(is_ro)
 
@@ -58,13 +72,71 @@ class LLDBView(object):
         """Performs a full update, calling pre_update() on the current thread
             and subsequently calling update() on the main thread."""
         self.pre_update()
-        sublime.set_timeout(self.update, 0)
+        run_on_ui_thread(self.update)
 
     def pre_update(self):
         """Prepares the view for an update, performing any work that doesn't
             have to be done on the main view."""
         pass
 
+    def timed_pre_update(self, is_cancelled=None):
+        """Calls pre_update(), keeping track of how long it took. If
+            is_cancelled() returns True at one of pre_update()'s safe points,
+            RefreshCancelled is raised.
+            Returns False, without calling pre_update(), if another thread
+            is already in the view's pre_update()."""
+        with self.__pre_update_lock:
+            if self.__in_pre_update:
+                return False
+            self.__in_pre_update = True
+            self.__stale_stop_id = None
+            self.__is_cancelled = is_cancelled
+        start = monotonic()
+        try:
+            self.pre_update()
+        finally:
+            with self.__pre_update_lock:
+                self.__in_pre_update = False
+                self.__is_cancelled = None
+        self.__pre_update_time = monotonic() - start
+        return True
+
+    def check_cancelled(self):
+        """Safe point for pre_update() implementations. Raises
+            RefreshCancelled if the current refresh is obsolete."""
+        is_cancelled = self.__is_cancelled
+        if is_cancelled is not None and is_cancelled():
+            raise RefreshCancelled()
+
+    def pre_update_time(self):
+        """How long the last timed_pre_update() took."""
+        return self.__pre_update_time
+
+    def mark_stale(self, stop_id):
+        """Marks the view as not having been updated for stop_id (because
+            it wasn't visible, or its pre_update() took too long)."""
+        with self.__pre_update_lock:
+            self.__stale_stop_id = stop_id
+
+    def clear_stale(self, stop_id):
+        """Marks the view as up to date, if it was only stale for stop_id."""
+        with self.__pre_update_lock:
+            if self.__stale_stop_id == stop_id:
+                self.__stale_stop_id = None
+
+    def mark_stale_if_busy(self, stop_id):
+        """Marks the view as stale if another thread is in its
+            pre_update(). Returns True if it was."""
+        with self.__pre_update_lock:
+            if self.__in_pre_update:
+                self.__stale_stop_id = stop_id
+            return self.__in_pre_update
+
+    def stale_stop_id(self):
+        """The stop the view missed an update for, or None if it's up to
+            date."""
+        return self.__stale_stop_id
+
     def update(self):
         """Updates the view. This method will be called on the UI thread and
             its overrides should only contain UI code, if possible. Most of the
@@ -80,10 +152,21 @@ class LLDBView(object):
 class LLDBReadOnlyView(LLDBView):
     """Class to abstract read-only views that show the user information about
         the process being debugged. Examples: LLDBThreadDisassemblyView and
-        LLDBRegisterView"""
+        LLDBRegisterView
+
+        Views are updated by only replacing the lines that changed since
+        the last update (which get highlighted)."""
+    __sm = SettingsManager.getSM()
+    eMarkerChangedName = __sm.get_default('markers.changed_lines.region_name', 'lldb.changed')
+    eMarkerChangedScope = __sm.get_default('markers.changed_lines.scope', 'markup.changed')
+
     def __init__(self, view):
         super(LLDBReadOnlyView, self).__init__(view)
         self.__content = ''
+        # Lines currently shown in the view (None if we never updated it),
+        # and the edits to go from them to the current content.
+        self.__shown_lines = None
+        self.__diff = None
 
     ##########################################
     # Content managing properties and methods.
@@ -96,21 +179,84 @@ class LLDBReadOnlyView(LLDBView):
     ##########################################
     # Update mechanism implementation.
     def pre_update(self):
-        self.__content = self.updated_content()
+        content = self.updated_content()
+        self.check_cancelled()
+        self.__content = content
+
+        # Diff the lines off the UI thread. update() will only use the diff
+        # if the view still shows the same lines.
+        shown_lines = self.__shown_lines
+        new_lines = self.__split_lines(self.__content)
+        if shown_lines is None:
+            self.__diff = None
+        else:
+            matcher = difflib.SequenceMatcher(None, shown_lines, new_lines)
+            self.__diff = (shown_lines, new_lines, matcher.get_opcodes())
 
     def update(self):
-        string = self.content()
         view = self.base_view()
+        diff = self.__diff
+        self.__diff = None
 
         view.set_read_only(False)
         edit = view.begin_edit(view.name())
-        region = sublime.Region(0, view.size())
-        view.erase(edit, region)
-        view.insert(edit, 0, string)
+        if diff is None or diff[0] is not self.__shown_lines:
+            string = self.content()
+            region = sublime.Region(0, view.size())
+            view.erase(edit, region)
+            view.insert(edit, 0, string)
+            self.__shown_lines = self.__split_lines(string)
+            changed = []
+        else:
+            (old_lines, new_lines, opcodes) = diff
+            changed = self.__apply_diff(view, edit, old_lines, new_lines, opcodes)
+            self.__shown_lines = new_lines
         view.end_edit(edit)
         view.set_read_only(True)
+
+        if changed:
+            view.add_regions(self.eMarkerChangedName, changed, self.eMarkerChangedScope, '', sublime.DRAW_OUTLINED)
+        else:
+            view.erase_regions(self.eMarkerChangedName)
         self.epilogue()
 
+    @staticmethod
+    def __split_lines(string):
+        # The view's positions are in characters, not bytes.
+        if isinstance(string, str):
+            string = string.decode('utf-8', 'replace')
+        return string.splitlines(True)
+
+    @staticmethod
+    def __line_offsets(lines):
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+        return offsets
+
+    def __apply_diff(self, view, edit, old_lines, new_lines, opcodes):
+        """Edits the view, replacing old_lines with new_lines, and returns
+            the regions (in the new text) for the lines that changed."""
+        old_offsets = self.__line_offsets(old_lines)
+        new_offsets = self.__line_offsets(new_lines)
+
+        # Go backwards, so the old offsets stay valid while we edit.
+        for (tag, i1, i2, j1, j2) in reversed(opcodes):
+            if tag == 'equal':
+                continue
+            region = sublime.Region(old_offsets[i1], old_offsets[i2])
+            text = u''.join(new_lines[j1:j2])
+            if tag == 'delete':
+                view.erase(edit, region)
+            elif tag == 'insert':
+                view.insert(edit, old_offsets[i1], text)
+            else:
+                view.replace(edit, region, text)
+
+        return [sublime.Region(new_offsets[j1], new_offsets[j2])
+                    for (tag, i1, i2, j1, j2) in opcodes
+                    if tag in ('replace', 'insert')]
+
     ##########################################
     # API to let subclasses execute code in the UI thread after the update.
     def epilogue(self):
@@ -119,10 +265,15 @@ class LLDBReadOnlyView(LLDBView):
 
 class LLDBCodeView(LLDBView):
     eRegionPC = 1 << 0
-    eRegionBreakpointEnabled = 1 << 1
-    eRegionBreakpointDisabled = 1 << 2
+
+    # Breakpoint changes for update_bps()
+    eBreakpointAdded = 1 << 0
+    eBreakpointChanged = 1 << 1
+    eBreakpointRemoved = 1 << 2
 
     __pc_line = None
+    # The PC line update() last marked on the view.
+    __shown_pc_line = None
     __bp_lock = Lock()
 
     # Settings for the whole class
@@ -152,24 +303,19 @@ class LLDBCodeView(LLDBView):
     eMarkerBreakpointDisabledIcon = __sm.get_default('markers.breakpoint.disabled.type', 'circle')
 
     def __init__(self, view, driver):
-        # FIXME: Split stuff that doesn't have to run on the UI thread.
         super(LLDBCodeView, self).__init__(view)
 
         self.__needs_update = False
         self.__driver = driver
+        self.__canonical_file_name = canonical_path(self.file_name())
         self.__enabled_bps = {}
         self.__disabled_bps = {}
-        # Get info on current breakpoints for this file
-        self.__populate_breakpoint_lists()
-        if not view.is_loading():
-            self.__update_bps()
-            self.pre_update()
-        else:
-            debug(debugViews, 'Skipped LLDBCodeView.__update_bps() because view.is_loading is True')
-            self.pre_update()
-            self.__needs_update = 'full'  # Horrible hack to update the bp
-                                        # markers as well as the pc marker when the on_load
-                                        # method calls update on this object
+        # Breakpoint markers on the view: (line, is_enabled) -> region name
+        self.__bp_markers = {}
+        # Getting the breakpoints and PC line for this file means talking to
+        # lldb, so we do it on the pre_update pool. The markers are added
+        # on the UI thread afterwards.
+        pre_update_pool().submit(session_callback(self.__load))
 
         # FIXME: Just make every LLDBCodeView observe the settings.
         #        Another way to do it would be for the class to observe and
@@ -198,11 +344,12 @@ class LLDBCodeView(LLDBView):
             self.__class__.eMarkerPCScope = self.__sm.get_default('markers.current_line.scope', 'bookmark')
             self.__class__.eMarkerPCScopeCrashed = self.__sm.get_default('markers.current_line.scope.crashed', 'invalid')
             self.__class__.eMarkerPCIcon = self.__sm.get_default('markers.current_line.icon', 'bookmark')
-            self.__mark_pc(self.__pc_line - 1, False)
+            if self.__shown_pc_line is not None:
+                self.__mark_pc(self.__shown_pc_line - 1, False)
 
         elif key.startswith('markers.breakpoint.enabled'):
             # Update all the enabled bp settings.
-            self.__mark_regions([], self.eRegionBreakpointEnabled)
+            self.__erase_bp_markers(True)
             self.__class__.eMarkerBreakpointEnabledName = self.__sm.get_default('markers.breakpoint.enabled.region_name',
                                                                            'lldb.breakpoint.enabled')
             self.__class__.eMarkerBreakpointEnabledScope = self.__sm.get_default('markers.breakpoint.enabled.scope', 'string')
@@ -210,13 +357,11 @@ class LLDBCodeView(LLDBView):
             # TODO: Check if the settings' on_change method is always called in
             # the main thread. If not, we'll have to guard the regions
             # definition
-            v = self.base_view()
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__enabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointEnabled)
+            self.__update_bps()
 
         elif key.startswith('markers.breakpoint.disabled'):
             # Update all the disabled bp settings.
-            self.__mark_regions([], self.eRegionBreakpointDisabled)
+            self.__erase_bp_markers(False)
             self.__class__.eMarkerBreakpointDisabledName = self.__sm.get_default('markers.breakpoint.disabled.region_name',
                                                                                  'lldb.breakpoint.disabled')
             self.__class__.eMarkerBreakpointDisabledScope = self.__sm.get_default('markers.breakpoint.disabled.scope', 'bookmark')
@@ -224,9 +369,7 @@ class LLDBCodeView(LLDBView):
             # TODO: Check if the settings' on_change method is always called in
             # the main thread. If not, we'll have to guard the regions
             # definition
-            v = self.base_view()
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__disabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointDisabled)
+            self.__update_bps()
 
         else:
             raise Exception('Weird key to be updated for LLDBCodeView: %s' % key)
@@ -249,55 +392,60 @@ class LLDBCodeView(LLDBView):
         """Mark a new breakpoint as enabled/disabled and immediately mark
             its region."""
         self.__add_bps([line], is_enabled)
-        v = self.base_view()
-
-        if is_enabled:
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__enabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointEnabled)
-        else:
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__disabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointDisabled)
+        self.__update_bps()
 
     def change_bp(self, line, is_enabled):
-        if is_enabled:
-            remove_from = self.__disabled_bps
-            add_to = self.__enabled_bps
-        else:
-            remove_from = self.__enabled_bps
-            add_to = self.__disabled_bps
-
-        with self.__bp_lock:
-            # The breakpoint must exist in remove_from
-            existing = remove_from[line]
-            if existing == 1:
-                del remove_from[line]
-            else:
-                remove_from[line] = existing - 1
-
-            if line in add_to:
-                existing = add_to[line]
-            else:
-                existing = 0
-            add_to[line] = existing + 1
-
-        v = self.base_view()
-        regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__enabled_bps.keys())
-        self.__mark_regions(regions, self.eRegionBreakpointEnabled)
-        regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__disabled_bps.keys())
-        self.__mark_regions(regions, self.eRegionBreakpointDisabled)
+        self.__change_bp(line, is_enabled)
+        self.__update_bps()
 
     def unmark_bp(self, line, is_enabled=True):
         """Remove merkings for a breakpoint and update the UI
             afterwards."""
         self.__remove_bps([line], is_enabled)
-        v = self.base_view()
-
-        if is_enabled:
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__enabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointEnabled)
-        else:
-            regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__disabled_bps.keys())
-            self.__mark_regions(regions, self.eRegionBreakpointDisabled)
+        self.__update_bps()
+
+    def reconcile_bps(self):
+        """Puts the breakpoint markers back on the lines lldb has for them.
+            Markers follow the text they're on when the file is edited, so
+            they may have moved to other lines. Must be called on the UI
+            thread (e.g: after the file is saved)."""
+        def load():
+            enabled_bps = {}
+            disabled_bps = {}
+            for (line, is_enabled) in self.__driver.get_breakpoint_lines_for_file(self.file_name()):
+                bps = enabled_bps if is_enabled else disabled_bps
+                bps[line] = bps.get(line, 0) + 1
+            run_on_ui_thread(session_callback(lambda: move_markers(enabled_bps, disabled_bps)))
+
+        def move_markers(enabled_bps, disabled_bps):
+            # Swap the lines in here, and not on the worker: breakpoint
+            # changes queued on the UI thread before lldb gave us its
+            # lines are already part of them, and must not be applied
+            # again on top.
+            with self.__bp_lock:
+                self.__enabled_bps = enabled_bps
+                self.__disabled_bps = disabled_bps
+            v = self.base_view()
+            for ((line, is_enabled), name) in self.__bp_markers.items():
+                regions = v.get_regions(name)
+                if not regions or v.rowcol(regions[0].begin())[0] != line - 1:
+                    v.erase_regions(name)
+                    del self.__bp_markers[(line, is_enabled)]
+            self.__update_bps()
+        pre_update_pool().submit(session_callback(load))
+
+    def update_bps(self, changes):
+        """Applies several breakpoint changes, and only then updates the
+            breakpoint markers. changes is a list of (kind, line, is_enabled)
+            tuples, with kind being one of eBreakpoint{Added,Changed,Removed}."""
+        for (kind, line, is_enabled) in changes:
+            if kind == self.eBreakpointAdded:
+                self.__add_bps([line], is_enabled)
+            elif kind == self.eBreakpointChanged:
+                self.__change_bp(line, is_enabled)
+            elif kind == self.eBreakpointRemoved:
+                self.__remove_bps([line], is_enabled)
+        self.__update_bps()
 
     ##########################################
     # Update mechanism implementation.
@@ -308,38 +456,24 @@ class LLDBCodeView(LLDBView):
         # read-only properties!!).
         # This 'full' hack is here to make us wait for the on_load() call
         # on the LLDBUIListener.
-        # This variable will make us keep __needs_update == 'full' if it was
-        # like that before we ran this function.
+        # The refresh we're part of may be cancelled before update() runs,
+        # so we keep whatever update() didn't render yet (including 'full'),
+        # and compare with the PC line the view shows, not with the last
+        # one we got.
         old_needs_update = self.__needs_update
-        self.__needs_update = False
+        debug(debugViews, 'shown pc_line: %s' % str(self.__shown_pc_line))
+
+        pc_line = None
+        snapshot = self.__driver.snapshot()
+        thread = snapshot.selected_thread()
+        if thread:
+            pc_line = snapshot.frame_lines(thread).get(self.__canonical_file_name)
 
-        old_pc_line = self.__pc_line
-        self.__pc_line = None
-        debug(debugViews, 'old pc_line: %s' % str(old_pc_line))
-
-        thread = self.__driver.current_thread()
-        if not thread:
-            debug(debugViews, 'new pc_line: %s' % str(self.__pc_line))
-            if self.__pc_line != old_pc_line:
-                self.__needs_update = old_needs_update or True
-            return False
-
-        for frame in thread:
-            line_entry = frame.GetLineEntry()
-            filespec = line_entry.GetFileSpec()
-            if filespec:
-                filename = filespec.GetDirectory() + '/' + filespec.GetFilename()
-                if filename == self.file_name():
-                    self.__pc_line = line_entry.GetLine()
-                    debug(debugViews, 'new pc_line: %s' % str(self.__pc_line))
-                    if self.__pc_line != old_pc_line or old_needs_update == 'full':
-                        self.__needs_update = old_needs_update or True
-                    return True
-
-        debug(debugViews, 'new pc_line: %s' % str(self.__pc_line))
-        if self.__pc_line != old_pc_line or old_needs_update == 'full':
+        self.__pc_line = pc_line
+        debug(debugViews, 'new pc_line: %s' % str(pc_line))
+        if pc_line != self.__shown_pc_line:
             self.__needs_update = old_needs_update or True
-        return False
+        return pc_line is not None
 
     def update(self):
         debug(debugViews, 'Updating LLDBCodeView. needs_update: %s' % str(self.__needs_update))
@@ -348,10 +482,12 @@ class LLDBCodeView(LLDBView):
             if self.__needs_update == 'full':
                 self.__update_bps()
 
-            if self.__pc_line is not None:
-                self.__mark_pc(self.__pc_line - 1, True)
+            pc_line = self.__pc_line
+            if pc_line is not None:
+                self.__mark_pc(pc_line - 1, True)
             else:
                 self.__mark_pc(None)
+            self.__shown_pc_line = pc_line
             # For now, bp-marking functions will immediately update the
             # view. We don't need to update it when the view is dirty.
             # self.__update_bps()
@@ -361,27 +497,40 @@ class LLDBCodeView(LLDBView):
 
     def stop(self):
         self.pre_update()  # This will set pc_line to None
-        self.__enabled_bps = {}
-        self.__disabled_bps = {}
+        with self.__bp_lock:
+            self.__enabled_bps = {}
+            self.__disabled_bps = {}
 
         def to_ui():
             debug(debugViews, 'executing UI code for LLDBCodeView.stop()')
             self.update()
             self.__update_bps()
-        sublime.set_timeout(to_ui, 0)
+        run_on_ui_thread(to_ui)
 
     ##########################################
     # Private LLDBCodeView methods
+    def __load(self):
+        """Background phase of the view's construction."""
+        # Get info on current breakpoints for this file
+        self.__populate_breakpoint_lists()
+        self.pre_update()
+        run_on_ui_thread(session_callback(self.__loaded))
+
+    def __loaded(self):
+        """UI phase of the view's construction: add the markers."""
+        if not self.base_view().is_loading():
+            self.__update_bps()
+            self.update()
+        else:
+            debug(debugViews, 'Skipped LLDBCodeView.__update_bps() because view.is_loading is True')
+            self.__needs_update = 'full'  # Horrible hack to update the bp
+                                        # markers as well as the pc marker when the on_load
+                                        # method calls update on this object
+
     def __mark_regions(self, regions, type):
         if type == self.eRegionPC:
             self.__mark_or_delete_regions(self.eMarkerPCName, regions, self.eMarkerPCScope,
                                           self.eMarkerPCIcon, sublime.HIDDEN)
-        elif type == self.eRegionBreakpointEnabled:
-            self.__mark_or_delete_regions(self.eMarkerBreakpointEnabledName, regions, self.eMarkerBreakpointEnabledScope,
-                                          self.eMarkerBreakpointEnabledIcon, sublime.HIDDEN)
-        elif type == self.eRegionBreakpointDisabled:
-            self.__mark_or_delete_regions(self.eMarkerBreakpointDisabledName, regions, self.eMarkerBreakpointDisabledScope,
-                                          self.eMarkerBreakpointDisabledIcon, sublime.HIDDEN)
 
     def __mark_or_delete_regions(self, name, regions, scope, icon, options):
         if len(regions) > 0:
@@ -403,19 +552,13 @@ class LLDBCodeView(LLDBView):
             self.show(to_mark[0], True)
 
     def __populate_breakpoint_lists(self):
-        file_bp_locs = self.__driver.get_breakpoint_locations_for_file(self.file_name())
-
-        def line_from_bp_loc(bp_loc):
-            line_entry = bp_loc.GetAddress().GetLineEntry()
-            return line_entry.GetLine()
-
         enabled_bp_lines = []
         disabled_bp_lines = []
-        for bp_loc in file_bp_locs:
-            if bp_loc.IsEnabled():
-                enabled_bp_lines.append(line_from_bp_loc(bp_loc))
+        for (line, is_enabled) in self.__driver.get_breakpoint_lines_for_file(self.file_name()):
+            if is_enabled:
+                enabled_bp_lines.append(line)
             else:
-                disabled_bp_lines.append(line_from_bp_loc(bp_loc))
+                disabled_bp_lines.append(line)
 
         self.__add_bps(enabled_bp_lines, True)
         self.__add_bps(disabled_bp_lines, False)
@@ -426,12 +569,14 @@ class LLDBCodeView(LLDBView):
         if len(lines) > 0:
             self.__needs_update = True
 
-        if are_enabled:
-            add_to = self.__enabled_bps
-        else:
-            add_to = self.__disabled_bps
-
         with self.__bp_lock:
+            # reconcile_bps() may replace the dicts, so pick ours under the
+            # lock.
+            if are_enabled:
+                add_to = self.__enabled_bps
+            else:
+                add_to = self.__disabled_bps
+
             # We shouldn't have that many breakpoints for this to be a
             # problem. If the lock becomes a problem, we can lock for each
             # breakpoint.
@@ -449,25 +594,78 @@ class LLDBCodeView(LLDBView):
         if len(lines) > 0:
             self.__needs_update = True
 
-        if are_enabled:
-            remove_from = self.__enabled_bps
-        else:
-            remove_from = self.__disabled_bps
-
         with self.__bp_lock:
+            if are_enabled:
+                remove_from = self.__enabled_bps
+            else:
+                remove_from = self.__disabled_bps
+
             for line in lines:
-                existing = remove_from[line]
-                if existing == 1:
-                    del remove_from[line]
-                else:
+                # We may not know about it, if we were reconciled or
+                # reloaded in the meantime.
+                existing = remove_from.pop(line, None)
+                if existing is None:
+                    debug(debugViews, '%s: no breakpoint to remove on line %d' % (self.file_name(), line))
+                elif existing > 1:
                     remove_from[line] = existing - 1
 
+    def __change_bp(self, line, is_enabled):
+        """Moves a breakpoint from the enabled to the disabled list (or vice
+            versa). __update_bps() must be called afterwards to refresh the
+            UI."""
+        with self.__bp_lock:
+            if is_enabled:
+                remove_from = self.__disabled_bps
+                add_to = self.__enabled_bps
+            else:
+                remove_from = self.__enabled_bps
+                add_to = self.__disabled_bps
+
+            # The breakpoint should exist in remove_from, unless we were
+            # reconciled or reloaded in the meantime.
+            existing = remove_from.pop(line, None)
+            if existing is None:
+                debug(debugViews, '%s: no breakpoint to change on line %d' % (self.file_name(), line))
+            elif existing > 1:
+                remove_from[line] = existing - 1
+
+            if line in add_to:
+                existing = add_to[line]
+            else:
+                existing = 0
+            add_to[line] = existing + 1
+
     def __update_bps(self):
+        """Adds and erases the breakpoint markers which changed since the
+            last call. Each breakpoint line has its own region, which
+            Sublime Text keeps on the same text while the file is edited."""
+        with self.__bp_lock:
+            wanted = set([(line, True) for line in self.__enabled_bps]) \
+                | set([(line, False) for line in self.__disabled_bps])
+
         v = self.base_view()
-        regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__enabled_bps.keys())
-        self.__mark_regions(regions, self.eRegionBreakpointEnabled)
-        regions = map(lambda line: v.line(v.text_point(line - 1, 0)), self.__disabled_bps.keys())
-        self.__mark_regions(regions, self.eRegionBreakpointDisabled)
+        for key in set(self.__bp_markers) - wanted:
+            name = self.__bp_markers.pop(key)
+            debug(debugViews, 'erasing region: %s' % name)
+            v.erase_regions(name)
+
+        for (line, is_enabled) in wanted - set(self.__bp_markers):
+            region = v.line(v.text_point(line - 1, 0))
+            if is_enabled:
+                name = '%s.%d' % (self.eMarkerBreakpointEnabledName, line)
+                v.add_regions(name, [region], self.eMarkerBreakpointEnabledScope,
+                              self.eMarkerBreakpointEnabledIcon, sublime.HIDDEN)
+            else:
+                name = '%s.%d' % (self.eMarkerBreakpointDisabledName, line)
+                v.add_regions(name, [region], self.eMarkerBreakpointDisabledScope,
+                              self.eMarkerBreakpointDisabledIcon, sublime.HIDDEN)
+            debug(debugViews, '(%s) adding region: %s' % (self.file_name(), name))
+            self.__bp_markers[(line, is_enabled)] = name
+
+    def __erase_bp_markers(self, are_enabled):
+        v = self.base_view()
+        for key in [k for k in self.__bp_markers if k[1] == are_enabled]:
+            v.erase_regions(self.__bp_markers.pop(key))
 
 
 class LLDBRegisterView(LLDBReadOnlyView):
@@ -489,23 +687,21 @@ class LLDBRegisterView(LLDBReadOnlyView):
             return 'Invalid thread. Has it finished its work?'
         target = thread.GetProcess().GetTarget()
 
-        frame = thread.GetSelectedFrame()
-        registerList = frame.GetRegisters()
+        registerList = driver_instance().snapshot().registers(thread)
         result = 'Frame registers:'
-        for value in registerList:
-            #print value
-            result = result + ('\n%s (number of registers = %d):\n' % (value.GetName(), value.GetNumChildren()))
-            for child in value:
-                if child.GetValue() is not None:
-                    # Let's assume no register name is bigger than 10 chars, for now.
-                    # 18 chars are needed for 64 bit values: 0x0000000000000000
-                    addr = lldb.SBAddress(child.GetValueAsUnsigned(), target)
-                    desc = lldbutil.get_description(addr)
-                    if re.match('0x[0-9A-Fa-f]+|^$', desc):
-                        desc = ''
-                    else:
-                        desc = '; ' + desc
-                    result = result + ('%10.10s = %.18s%s\n' % (child.GetName(), child.GetValue(), desc))
+        for (set_name, n_registers, registers) in registerList:
+            self.check_cancelled()
+            result = result + ('\n%s (number of registers = %d):\n' % (set_name, n_registers))
+            for (name, value, unsigned_value) in registers:
+                # Let's assume no register name is bigger than 10 chars, for now.
+                # 18 chars are needed for 64 bit values: 0x0000000000000000
+                addr = lldb.SBAddress(unsigned_value, target)
+                desc = lldbutil.get_description(addr)
+                if re.match('0x[0-9A-Fa-f]+|^$', desc):
+                    desc = ''
+                else:
+                    desc = '; ' + desc
+                result = result + ('%10.10s = %.18s%s\n' % (name, value, desc))
 
         return result
 
@@ -592,8 +788,9 @@ class LLDBThreadDisassemblyView(LLDBReadOnlyView):
         if not thread.IsValid():
             return 'Invalid thread. Has it finished its work?'
 
+        snapshot = driver_instance().snapshot()
         target = thread.GetProcess().GetTarget()
-        pc = thread.GetSelectedFrame().GetPCAddress()
+        pc = snapshot.selected_frame(thread).GetPCAddress()
         function = pc.GetFunction()
         symbol = pc.GetSymbol()
         if function.IsValid():
@@ -606,11 +803,12 @@ class LLDBThreadDisassemblyView(LLDBReadOnlyView):
             name = pc.GetModule().GetFileSpec().GetFilename()
             start_addr = pc.GetLoadAddress(target)
 
-        instrs = driver_instance().disassemble_frame(thread.GetSelectedFrame())
+        instrs = snapshot.disassembly(thread)
+        self.check_cancelled()
         if not instrs:
             return 'Error getting instructions for thread 0x%x: No instructions available.' % thread.GetThreadID()
 
-        pc = driver_instance().get_PC()
+        pc = snapshot.pc()
 
         def get_max_sizes(accum, next):
             return (max(accum[0], len(next[1])), max(accum[1], len(next[2])))
@@ -657,11 +855,11 @@ class LLDBVariableView(LLDBReadOnlyView):
         if not thread.IsValid():
             return 'Invalid thread. Has it finished its work?'
 
-        frame = thread.GetSelectedFrame()
         # TODO: Allow users to configure which variables to get.
-        variables = frame.GetVariables(True, True, True, True)
+        variables = driver_instance().snapshot().variables(thread)
         result = 'Frame variables:\n'
         for var in variables:
+            self.check_cancelled()
             result = result + ('%s = ' % self.__name_for(var))
             if var.GetNumChildren() == 0:
                 result = result + self.__value_for(var) + '\n'